@@ -1,151 +1,238 @@
 import logging
-import os
+import itertools
+import math
 import random
-import sys
-import xml.etree.ElementTree as ET
+from collections import defaultdict
+from typing import Optional
 
-from utility import distance, firstn, position_on_edge
+import numpy as np
 
-if 'SUMO_HOME' in os.environ:
-    tools = os.path.join(os.environ['SUMO_HOME'], 'tools')
-    sys.path.append(tools)
-else:
-    sys.exit("Please declare environment variable 'SUMO_HOME' to use sumolib")
+from citystats import Stats
+from geometry import EdgeGeometry, SegmentIndex
+from utility import distance, firstn
 
-import sumolib
 
-
-def setup_bus_stops(net: sumolib.net.Net, stats: ET.ElementTree, min_distance, k):
+def setup_bus_stops(geometry: EdgeGeometry, stats: Stats, min_distance, k, sampling="network", rng=random,
+                    active_near: Optional[np.ndarray] = None):
     """
-    Generates bus stops from net, and writes them into stats.
+    Generates bus stops from the edges in geometry, and writes them into stats.
+    :param sampling: how candidates are drawn, see bus_stop_generator
+    :param rng: the random number generator to use, e.g. a random.Random
+    :param active_near: array of shape (n, 2) with the points where the network changed since the bus stops in stats
+        were generated. If given, only existing bus stops near these points look for new bus stops around them
     """
-    logging.debug(f"[bus-stops] Using min_distance: {min_distance}, and k (attempts): {k}")
-    edges = net.getEdges()
-
-    city = stats.getroot()
-    bus_stations = city.find("busStations")
-    seed_bus_stops = []
-    if bus_stations is None:
-        bus_stations = ET.SubElement(city, "busStations")
-    else:
-        for station in bus_stations.findall("busStation"):
-            assert "edge" in station.attrib, "BusStation isn't placed on an edge"
-            edge_id = station.attrib["edge"]
-            assert "pos" in station.attrib, "BusStation doesn't have a position along the edge"
-            along = float(station.attrib["pos"])
-
-            edge = net.getEdge(edge_id)
-            if edge is None:
-                logging.warning("BusStation in stat file reference edge (id=\"{}\") that doesn't exist in the road "
-                                "network".format(edge_id))
-                continue
-
-            pos = position_on_edge(edge, along)
-
-            seed_bus_stops.append([
-                pos[0],
-                pos[1],
-                edge,
-                along])
-
-    for i, busstop in enumerate(bus_stop_generator(edges, min_distance, min_distance * 2, k, seeds=seed_bus_stops)):
+    logging.debug(f"[bus-stops] Using min_distance: {min_distance}, k (attempts): {k}, and sampling: {sampling}")
+
+    bus_stations = stats.table("busStations", create=True)
+    seed_edges = geometry.indices_of(bus_stations["edge"].tolist())
+    for edge_id in bus_stations["edge"][seed_edges < 0].tolist():
+        logging.warning("BusStation in stat file reference edge (id=\"{}\") that doesn't exist in the road "
+                        "network".format(edge_id))
+    seed_offsets = bus_stations["pos"][seed_edges >= 0]
+    seed_edges = seed_edges[seed_edges >= 0]
+
+    positions = geometry.positions_on_edges(seed_edges, seed_offsets)
+    seed_bus_stops = [[pos[0], pos[1], edge, along]
+                      for pos, edge, along in zip(positions.tolist(), seed_edges.tolist(), seed_offsets.tolist())]
+
+    active = None
+    if active_near is not None:
+        # New bus stops are at most 2 * min_distance from the stop they are found around, so the existing bus stops in
+        # or next to a cell of that size with a change are active
+        cell_size = min_distance * 2
+        changed_cells = np.floor(np.asarray(active_near).reshape(-1, 2) / cell_size).astype(np.int64).tolist()
+        near_cells = {(x + dx, y + dy) for x, y in changed_cells for dx in (-1, 0, 1) for dy in (-1, 0, 1)}
+        active = [(math.floor(seed[0] / cell_size), math.floor(seed[1] / cell_size)) in near_cells
+                  for seed in seed_bus_stops]
+        logging.debug(f"[bus-stops] {sum(active)} of {len(seed_bus_stops)} existing bus stops are near changes")
+
+    # Ids of new bus stops are numbers not used by existing bus stops
+    used_ids = set(bus_stations["id"].tolist())
+    new_ids = (str(i) for i in itertools.count() if str(i) not in used_ids)
+
+    stops = {"id": [], "edge": [], "pos": []}
+    for busstop in bus_stop_generator(geometry, min_distance, min_distance * 2, k, seeds=seed_bus_stops,
+                                      sampling=sampling, rng=rng, active=active):
         edge = busstop[2]
         dist_along = busstop[3]
-        ET.SubElement(bus_stations, "busStation", attrib={
-            "id": str(i),
-            "edge": edge.getID(),
-            "pos": str(dist_along),
-        })
+        stops["id"].append(next(new_ids))
+        stops["edge"].append(geometry.ids[edge])
+        stops["pos"].append(dist_along)
+    bus_stations.append(**stops)
 
 
-def _road_point_generator(roads):
+def _road_point_generator(geometry: EdgeGeometry, batch_size: int = 4096, rng=random):
     """
-    Picks a random point on on a road from roads
+    Picks random points on roads from the edges in geometry. Points are drawn uniformly along the combined length of
+    all roads in batches of batch_size, and yielded one at a time.
     """
-    assert len(roads) > 0
+    assert len(geometry) > 0
+    # Distance along the combined stretch of road to the end of each road
+    cum_lengths = np.cumsum(geometry.lengths)
+    total_length = cum_lengths[-1]
 
-    # Length of all roads combined
-    total_length = sum(map(lambda road: road.getLength(), roads))
+    # Derive the NumPy generator from rng, such that the points are given by --seed
+    np_rng = np.random.default_rng(rng.getrandbits(64))
 
     while True:
-        # Select a point on the combined stretch of road
-        distance = random.uniform(0, total_length)
-
-        # Find the selected road
-        length_sum = 0.0
-        found_road = False
-        for road in roads:
-            if (length_sum + road.getLength()) >= distance:
-                # Compute the exact point on the selected road
-
-                # Distance along the road segment
-                remaining = distance - length_sum
-                pos = position_on_edge(road, remaining)
-
-                yield [
-                    pos[0],
-                    pos[1],
-                    road,
-                    remaining]
-                found_road = True
-                break
-            else:
-                length_sum += road.getLength()
-
-        if not found_road:
-            raise AssertionError("Failed to pick a road. A distance beyond the last road must have been erroneously "
-                                 "picked: {} (length sum: {}) (total length: {})".format(distance, length_sum,
-                                                                                         total_length))
-
-
-def bus_stop_generator(roads, inner_r, outer_r, k=10, seeds=None):
+        # Select points on the combined stretch of road
+        distances = np_rng.uniform(0, total_length, batch_size)
+
+        # Find the selected roads, i.e. the first road whose end is at or beyond the selected distance
+        roads = np.minimum(np.searchsorted(cum_lengths, distances), len(geometry) - 1)
+
+        # Distance along the road segments
+        remaining = distances - (cum_lengths[roads] - geometry.lengths[roads])
+        positions = geometry.positions_on_edges(roads, remaining)
+
+        for pos, road, along in zip(positions.tolist(), roads.tolist(), remaining.tolist()):
+            yield [
+                pos[0],
+                pos[1],
+                road,
+                along]
+
+
+def _annulus_point_generator(geometry: EdgeGeometry, index: SegmentIndex, centre, inner_r, outer_r, n: int,
+                             np_rng: np.random.Generator):
+    """
+    Picks n random points on roads within the annulus inner_r..outer_r around centre. Points are drawn uniformly along
+    the parts of the road segments inside the annulus. Nothing is yielded if no road passes through the annulus.
     """
-    Bus stop placement using the poisson-disc algorithm
+    segments = index.segments_near(centre, outer_r)
+    start = geometry.vertices[segments]
+    direction = geometry.vertices[segments + 1] - start
+    segment_lengths = np.sqrt((direction ** 2).sum(axis=1))
+
+    def circle_interval(radius):
+        # Solve |start + t * direction - centre| = radius for t, such that the segment is within the circle for t in
+        # the interval. Segments not crossing the circle get the empty interval [inf, inf]
+        rel = start - np.asarray(centre)
+        a = (direction ** 2).sum(axis=1)
+        b = 2 * (rel * direction).sum(axis=1)
+        c = (rel ** 2).sum(axis=1) - radius ** 2
+        disc = b ** 2 - 4 * a * c
+        crosses = (disc >= 0) & (a > 0)
+        root = np.sqrt(np.where(crosses, disc, 0.0))
+        a = np.where(crosses, a, 1.0)
+        return np.where(crosses, (-b - root) / (2 * a), np.inf), np.where(crosses, (-b + root) / (2 * a), np.inf)
+
+    # The parts of each segment within the annulus are within the outer circle, before and after the inner circle
+    outer_low, outer_high = circle_interval(outer_r)
+    outer_low, outer_high = np.maximum(outer_low, 0.0), np.minimum(outer_high, 1.0)
+    inner_low, inner_high = circle_interval(inner_r)
+    low = np.concatenate((outer_low, np.maximum(outer_low, inner_high)))
+    high = np.concatenate((np.minimum(outer_high, inner_low), outer_high))
+    pieces = np.concatenate((segments, segments))
+    piece_segment_lengths = np.concatenate((segment_lengths, segment_lengths))
+    piece_lengths = np.maximum(high - low, 0.0) * piece_segment_lengths
+
+    cum_lengths = np.cumsum(piece_lengths)
+    if len(cum_lengths) == 0 or cum_lengths[-1] <= 0:
+        return
+
+    # Select points on the combined stretch of road inside the annulus, and find the piece of each point
+    distances = np_rng.uniform(0, cum_lengths[-1], n)
+    chosen = np.minimum(np.searchsorted(cum_lengths, distances, side="right"), len(cum_lengths) - 1)
+    # Chosen pieces have a positive length, so their segment does too
+    t = low[chosen] + (distances - (cum_lengths[chosen] - piece_lengths[chosen])) / piece_segment_lengths[chosen]
+    t = np.clip(t, low[chosen], high[chosen])
+
+    vertex = pieces[chosen]
+    positions = geometry.vertices[vertex] + (geometry.vertices[vertex + 1] - geometry.vertices[vertex]) * t[:, None]
+    roads = index.segment_edges[vertex]
+    # Distance along the road, which cannot be beyond the end of the road
+    along = np.minimum(geometry.cum_lengths[vertex] + t * (geometry.cum_lengths[vertex + 1] -
+                                                           geometry.cum_lengths[vertex]), geometry.lengths[roads])
+
+    for pos, road, dist_along in zip(positions.tolist(), roads.tolist(), along.tolist()):
+        yield [
+            pos[0],
+            pos[1],
+            road,
+            dist_along]
+
+
+def bus_stop_generator(geometry: EdgeGeometry, inner_r, outer_r, k=10, seeds=None, sampling="network", rng=random,
+                       active=None):
+    """
+    Bus stop placement using the poisson-disc algorithm on the edges in geometry
+    :param sampling: "network" to draw candidates from all roads and reject those outside the annulus around the
+        centre, or "annulus" to only draw candidates from the roads passing through the annulus
+    :param rng: the random number generator to use, e.g. a random.Random
+    :param active: whether to search for new points around each seed, by default around all seeds. Inactive seeds are
+        still kept at a distance
     """
     assert inner_r < outer_r
+    assert sampling in ("network", "annulus"), f"Unknown bus stop sampling mode: {sampling}"
     if seeds is None:
         seeds = []
 
+    # Background grid of the points placed so far, such that only points in neighbouring cells need to be checked
+    # when testing if a candidate is too close to another point. With cells of size inner_r/sqrt(2), points within
+    # inner_r of a candidate are at most two cells away from the cell of the candidate
+    cell_size = inner_r / math.sqrt(2)
+    grid = defaultdict(list)
+
+    def cell_of(p):
+        return math.floor(p[0] / cell_size), math.floor(p[1] / cell_size)
+
+    def add_point(p):
+        grid[cell_of(p)].append(p)
+
+    def check_dist(p, limit=inner_r):
+        """
+        Return true if any of the placed points is within the limit distance of P
+        """
+        cx, cy = cell_of(p)
+        for nx in range(cx - 2, cx + 3):
+            for ny in range(cy - 2, cy + 3):
+                for test_point in grid.get((nx, ny), ()):
+                    if distance((p[0], p[1]), (test_point[0], test_point[1])) < limit:
+                        # p is within limit distance
+                        return True
+        # p is not within the limit distance of of the placed points
+        return False
+
     all_points = list(seeds)
+    for seed in all_points:
+        add_point(seed)
 
-    road_points_gen = _road_point_generator(roads)
+    road_points_gen = _road_point_generator(geometry, rng=rng)
     if not all_points:  # Check if all_points is empty
         road = tuple(next(road_points_gen))
         yield road
         all_points.append(road)  # Seed point
+        add_point(road)
 
-    active_points = list(all_points)  # Use a list because random.choice require a sequence
+    # Use a list because rng.choice require a sequence
+    active_points = list(all_points) if active is None or not seeds \
+        else [seed for seed, is_active in zip(seeds, active) if is_active]
 
-    def check_dist(p, test_points, limit=inner_r):
-        """
-        Return true if any of the test_points is within the limit distance of P
-        """
-        for test_point in test_points:
-            if distance((p[0], p[1]), (test_point[0], test_point[1])) < limit:
-                # p is within limit distance
-                return True
-        # p is not within the limit distance of of the test points
-        return False
+    if sampling == "annulus":
+        segment_index = SegmentIndex(geometry, outer_r)
+        np_rng = np.random.default_rng(rng.getrandbits(64))
 
     while len(active_points) > 0:
         # Pick a random point from the set of active points to be the center of the poisson disc
-        center = random.choice(active_points)
+        center = rng.choice(active_points)
         # Limit the search to K points
-        gen = firstn(k, filter(
-            lambda point: inner_r <= distance((center[0], center[1]), (point[0], point[1])) <= outer_r, road_points_gen))
+        in_annulus = lambda point: inner_r <= distance((center[0], center[1]), (point[0], point[1])) <= outer_r
+        if sampling == "annulus":
+            gen = filter(in_annulus, _annulus_point_generator(geometry, segment_index, (center[0], center[1]), inner_r,
+                                                              outer_r, k, np_rng))
+        else:
+            gen = firstn(k, filter(in_annulus, road_points_gen))
 
         # Search for candidate point
         try:
             # Search for a point, or raise StopIteration is none can be found
-            point = next(filter(
-                lambda p: not check_dist(p, iter(all_points)),
-                gen))
-
-            assert not check_dist(point, all_points)
+            point = next(filter(lambda p: not check_dist(p), gen))
 
             # A new point was found
             active_points.append(point)
             all_points.append(tuple(point))
+            add_point(tuple(point))
 
             yield point
         except StopIteration:
@@ -0,0 +1,449 @@
+import copy
+import io
+import math
+import operator
+import uuid
+import xml.etree.ElementTree as ET
+from contextlib import nullcontext
+from typing import Dict, Iterable, List, Optional, Set
+
+import numpy as np
+
+from streams import open_input, open_output
+
+# Missing values of int columns, float columns use NaN and str columns None
+MISSING_INT = np.iinfo(np.int64).min
+
+# The sections of a statistics file stored as tables; the tag of their elements and the kind of each attribute, in the
+# order they are written. Other attributes found when reading are kept as str columns
+TABLES = {
+    "streets": ("street", {"edge": "str", "population": "float", "workPosition": "float"}),
+    "cityGates": ("entrance", {"edge": "str", "incoming": "float", "outgoing": "float", "pos": "float"}),
+    "schools": ("school", {"edge": "str", "pos": "float", "beginAge": "int", "endAge": "int", "capacity": "int",
+                           "opening": "int", "closing": "int"}),
+    "busStations": ("busStation", {"id": "str", "edge": "str", "pos": "float"}),
+}
+
+# Number of rows converted to or from XML at a time
+CHUNK_ROWS = 1 << 16
+
+
+def _column(kind: str, values: Iterable) -> np.ndarray:
+    if kind == "float":
+        return np.asarray(values, dtype=np.float64)
+    if kind == "int":
+        return np.asarray(values, dtype=np.int64)
+    column = np.empty(len(values), dtype=object)
+    column[:] = list(values)
+    return column
+
+
+def _missing(kind: str, n: int) -> np.ndarray:
+    if kind == "float":
+        return np.full(n, np.nan)
+    if kind == "int":
+        return np.full(n, MISSING_INT, dtype=np.int64)
+    return np.full(n, None, dtype=object)
+
+
+def _parse(kind: str, name: str, rows: List[dict]) -> np.ndarray:
+    """
+    :return: the column of the attribute with the given name of rows, which are attribute dicts of elements
+    """
+    try:
+        # All rows usually have the attribute
+        values = list(map(operator.itemgetter(name), rows))
+    except KeyError:
+        values = None
+    if kind == "float":
+        if values is not None:
+            return np.array(list(map(float, values)), dtype=np.float64).reshape(len(rows))
+        return np.fromiter((float(row[name]) if name in row else math.nan for row in rows), dtype=np.float64,
+                           count=len(rows))
+    if kind == "int":
+        if values is not None:
+            return np.array(list(map(int, values)), dtype=np.int64).reshape(len(rows))
+        return np.fromiter((int(row[name]) if name in row else MISSING_INT for row in rows), dtype=np.int64,
+                           count=len(rows))
+    return _column(kind, values if values is not None else [row.get(name) for row in rows])
+
+
+def _escape(value: str) -> str:
+    # Like ElementTree escapes attribute values
+    if any(c in value for c in '&<>"\n\r\t'):
+        value = value.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace('"', "&quot;") \
+            .replace("\r", "&#13;").replace("\n", "&#10;").replace("\t", "&#09;")
+    return value
+
+
+def _template(kind: str, name: str, precision: Optional[int]) -> str:
+    """
+    :return: %-format of the attribute with the given name, e.g. ' pos="%r"'
+    """
+    if kind == "float":
+        return f' {name}="%r"' if precision is None else f' {name}="%.{precision}f"'
+    return f' {name}="%d"' if kind == "int" else f' {name}="%s"'
+
+
+def _values(kind: str, column: np.ndarray) -> Optional[list]:
+    """
+    :return: the values of the column ready for its template, or None if any value is missing
+    """
+    if kind == "float":
+        return None if np.isnan(column).any() else column.tolist()
+    if kind == "int":
+        return None if (column == MISSING_INT).any() else column.tolist()
+    values = column.tolist()
+    if None in values:
+        return None
+    return [_escape(value) for value in values] if _escape("".join(values)) != "".join(values) else values
+
+
+def _int_text(value) -> Optional[str]:
+    """
+    :return: the text of value if it is an int, e.g. "0", otherwise None
+    """
+    return str(value) if isinstance(value, (int, np.integer)) and not isinstance(value, bool) else None
+
+
+def _given_text(values) -> Optional[np.ndarray]:
+    """
+    :param values: the values given for a float column
+    :return: the text of the values that are ints, None for the others, or None if there are no ints
+    """
+    if isinstance(values, np.ndarray):
+        if not np.issubdtype(values.dtype, np.integer):
+            return None
+        return _column("str", list(map(str, values.tolist())))
+    text = list(map(_int_text, values))
+    return _column("str", text) if any(value is not None for value in text) else None
+
+
+def _float_strings(column: np.ndarray, text: np.ndarray) -> List[Optional[str]]:
+    """
+    :param text: the text each value of the float column was read or given as, or None
+    :return: the text of each value if the value is still the one of the text, otherwise its shortest exact
+        representation, and None where the value is missing
+    """
+    has_text = np.not_equal(text, None)
+    read = np.full(len(column), np.nan)
+    read[has_text] = np.array(text[has_text].tolist(), dtype=np.float64)
+    same = has_text & ((read == column) | (np.isnan(read) & np.isnan(column)))
+    if same.all():
+        return text.tolist()
+    return [value_text if is_same else (repr(value) if value == value else None)
+            for value_text, is_same, value in zip(text.tolist(), same.tolist(), column.tolist())]
+
+
+def _format(kind: str, name: str, column: np.ndarray, precision: Optional[int]) -> List[str]:
+    """
+    :return: the attribute with the given name of each row, e.g. ' pos="12.5"', or '' where the value is missing
+    """
+    if kind == "float":
+        if precision is None:
+            return [f' {name}="{value!r}"' if value == value else "" for value in column.tolist()]
+        return [f' {name}="{value:.{precision}f}"' if value == value else "" for value in column.tolist()]
+    if kind == "int":
+        return [f' {name}="{value}"' if value != MISSING_INT else "" for value in column.tolist()]
+    return [f' {name}="{_escape(value)}"' if value is not None else "" for value in column.tolist()]
+
+
+class Table:
+    """
+    The elements of a section of a statistics file, e.g. the street elements of streets, stored as one NumPy array
+    per attribute. Values are missing where an element does not have the attribute; NaN in float columns, MISSING_INT
+    in int columns and None in str columns. Missing values are not written.
+
+    Float values keep the text they were read as, or given as if they were ints, and are written as that text as long
+    as they are not changed. Statistics that are read and written thus keep the numbers of rows that were not changed
+    as they were, e.g. pos="0" instead of pos="0.0"
+    """
+
+    def __init__(self, tag: str, kinds: Dict[str, str], columns: Optional[Dict[str, np.ndarray]] = None,
+                 text: Optional[Dict[str, np.ndarray]] = None):
+        """
+        :param tag: the tag of the elements
+        :param kinds: the kind of each attribute, "str", "int" or "float"
+        :param columns: the values of each attribute, by default there are no rows
+        :param text: the text of the values of float attributes by attribute, None where a value has no text
+        """
+        self.tag = tag
+        self.kinds = dict(kinds)
+        self.columns = {name: _missing(kind, 0) for name, kind in kinds.items()} if columns is None else columns
+        self.text = {} if text is None else text
+
+    def __len__(self):
+        return len(next(iter(self.columns.values()))) if self.columns else 0
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.columns[name]
+
+    def append(self, **values):
+        """
+        Append rows given by the values of each attribute, e.g. edge=[...], pos=[...]. Attributes that are not given are
+        missing in the new rows
+        """
+        assert set(values).issubset(self.kinds), f"Unknown attributes of {self.tag}: {set(values) - set(self.kinds)}"
+        n = len(next(iter(values.values())))
+        old_n = len(self)
+        for name, kind in self.kinds.items():
+            new = _column(kind, values[name]) if name in values else _missing(kind, n)
+            assert len(new) == n, f"Attributes of new {self.tag} rows have different lengths"
+            self.columns[name] = np.concatenate((self.columns[name], new))
+            new_text = _given_text(values[name]) if kind == "float" and name in values else None
+            if new_text is not None or name in self.text:
+                self.text[name] = np.concatenate((self.text.get(name, _missing("str", old_n)),
+                                                  new_text if new_text is not None else _missing("str", n)))
+
+    def insert(self, before: np.ndarray, **values):
+        """
+        Insert rows given by the values of each attribute, like append, in the same way as np.insert
+        :param before: for each new row, the index of the existing row it is inserted before, or len(self) to insert it
+            at the end. New rows before the same row are inserted in the order they are given
+        """
+        n = len(self)
+        self.append(**values)
+        order = np.insert(np.arange(n), before, np.arange(n, len(self)))
+        self.columns = {name: column[order] for name, column in self.columns.items()}
+        self.text = {name: text[order] for name, text in self.text.items()}
+
+    def set(self, name: str, rows, values):
+        """
+        Set the values of an attribute in the given rows, like table[name][rows] = values, keeping the text of ints
+        given for a float attribute
+        :param rows: index, indices or boolean mask of rows
+        :param values: a value, or the values of the rows
+        """
+        self.columns[name][rows] = values
+        if self.kinds[name] == "float":
+            text = self.text.setdefault(name, _missing("str", len(self)))
+            text[rows] = _int_text(values) if np.isscalar(values) else list(map(_int_text, values))
+
+    def take(self, rows: np.ndarray) -> "Table":
+        """
+        :param rows: indices or boolean mask of rows
+        :return: a new table with the given rows
+        """
+        return Table(self.tag, self.kinds, {name: column[rows] for name, column in self.columns.items()},
+                     {name: text[rows] for name, text in self.text.items()})
+
+    def remove(self, rows: np.ndarray) -> "Table":
+        """
+        Remove the given rows
+        :param rows: boolean mask of the rows to remove
+        :return: a new table with the removed rows
+        """
+        removed = self.take(rows)
+        self.columns = {name: column[~rows] for name, column in self.columns.items()}
+        self.text = {name: text[~rows] for name, text in self.text.items()}
+        return removed
+
+    def clear(self):
+        """
+        Remove all rows
+        """
+        self.columns = {name: _missing(kind, 0) for name, kind in self.kinds.items()}
+        self.text = {}
+
+    def edge_in(self, edge_ids: Set[str]) -> np.ndarray:
+        """
+        :return: boolean mask of the rows whose edge is one of edge_ids
+        """
+        return np.fromiter((edge in edge_ids for edge in self.columns["edge"].tolist()), dtype=bool, count=len(self))
+
+    def format_rows(self, precision: Optional[int] = None) -> Iterable[str]:
+        """
+        :param precision: number of decimals of floats, or None for the shortest exact representation
+        :return: the rows as XML in chunks of CHUNK_ROWS rows
+        """
+        # Float values with text are written as str, unless they are rounded to the given precision
+        text = self.text if precision is None else {}
+        kinds = {name: "str" if name in text else kind for name, kind in self.kinds.items()}
+        template = f"<{self.tag}{''.join(_template(kind, name, precision) for name, kind in kinds.items())} />"
+        for start in range(0, len(self), CHUNK_ROWS):
+            columns = {name: column[start:start + CHUNK_ROWS] for name, column in self.columns.items()}
+            for name, column_text in text.items():
+                columns[name] = _column("str", _float_strings(columns[name], column_text[start:start + CHUNK_ROWS]))
+            values = [_values(kind, columns[name]) for name, kind in kinds.items()]
+            if all(column is not None for column in values):
+                # Formatting each row with one template is much faster than formatting each attribute
+                yield "".join(map(template.__mod__, zip(*values)))
+                continue
+            attributes = [_format(kind, name, columns[name], precision) for name, kind in kinds.items()]
+            yield "".join(f"<{self.tag}{''.join(row)} />" for row in zip(*attributes))
+
+    @classmethod
+    def from_rows(cls, tag: str, kinds: Dict[str, str], rows: List[dict]) -> "Table":
+        """
+        :param rows: the attributes of each element. Attributes not in kinds are kept as str columns
+        """
+        kinds = dict(kinds)
+        if not set(kinds).issuperset(set().union(*rows)):
+            for name in dict.fromkeys(name for row in rows for name in row):
+                kinds.setdefault(name, "str")
+        return cls(tag, kinds, {name: _parse(kind, name, rows) for name, kind in kinds.items()},
+                   {name: _parse("str", name, rows) for name, kind in kinds.items() if kind == "float"})
+
+    @classmethod
+    def concatenate(cls, tables: List["Table"]) -> "Table":
+        """
+        :param tables: tables with the same tag, which must not be empty. Their attributes need not be the same
+        :return: a table with the rows of all tables in order
+        """
+        kinds = {}
+        for table in tables:
+            for name, kind in table.kinds.items():
+                kinds.setdefault(name, kind)
+        return cls(tables[0].tag, kinds, {
+            name: np.concatenate([table.columns[name] if name in table.columns else _missing(kind, len(table))
+                                  for table in tables]) for name, kind in kinds.items()}, {
+            name: np.concatenate([table.text[name] if name in table.text else _missing("str", len(table))
+                                  for table in tables]) for name in dict.fromkeys(name for table in tables for name in table.text)})
+
+
+class Stats:
+    """
+    A statistics file of a city, as read by ActivityGen. The streets, city gates, schools and bus stations, of which
+    there may be hundreds of thousands, are stored as Tables. The rest, e.g. general and population, is kept as an
+    ElementTree, in which the sections of the tables are empty elements that mark where their rows are written.
+    Use Stats.read to parse a file and write to serialize it; both handle the tables in large chunks
+    """
+
+    def __init__(self, root: ET.Element, tables: Optional[Dict[str, Table]] = None):
+        """
+        :param root: the city element, which must not contain the elements of the tables
+        :param tables: the tables by section, whose sections are in root
+        """
+        self._root = root
+        self._tables = {} if tables is None else tables
+
+    def getroot(self) -> ET.Element:
+        return self._root
+
+    def find(self, path: str) -> Optional[ET.Element]:
+        return self._root.find(path)
+
+    def table(self, section: str, create: bool = False) -> Optional[Table]:
+        """
+        :param section: the section of the table, one of TABLES, e.g. "streets"
+        :param create: add the section, if the statistics do not have it
+        :return: the table of the section, or None if the statistics do not have the section
+        """
+        if self._root.find(section) is None:
+            if not create:
+                return None
+            ET.SubElement(self._root, section)
+        if section not in self._tables:
+            tag, kinds = TABLES[section]
+            self._tables[section] = Table(tag, kinds)
+        return self._tables[section]
+
+    @classmethod
+    def read(cls, source) -> "Stats":
+        """
+        :param source: path or binary file object of a statistics file. A file at a path may be gzip compressed
+        """
+        with open_input(source) if isinstance(source, str) else nullcontext(source) as f:
+            return cls._read(f)
+
+    @classmethod
+    def _read(cls, source) -> "Stats":
+        rows = {section: [] for section in TABLES}
+        chunks = {section: [] for section in TABLES}
+        sections = {}
+        root = section = row_tag = None
+        depth = 0
+        for event, element in ET.iterparse(source, events=("start", "end")):
+            if event == "start":
+                depth += 1
+                if depth == 1:
+                    root = element
+                elif depth == 2:
+                    section = element
+                    row_tag = TABLES[element.tag][0] if element.tag in TABLES else None
+                continue
+            depth -= 1
+            if depth == 2:
+                if element.tag == row_tag:
+                    # Elements of tables are removed as soon as they are read, so large files are never held as
+                    # elements. An element is the last child of its section when it ends
+                    section_rows = rows[section.tag]
+                    section_rows.append(element.attrib)
+                    del section[-1]
+                    if len(section_rows) == CHUNK_ROWS:
+                        chunks[section.tag].append(Table.from_rows(*TABLES[section.tag], section_rows))
+                        rows[section.tag] = []
+            elif depth == 1 and row_tag is not None:
+                if element.tag in sections:
+                    # Elements of a repeated section are added to the first one
+                    root.remove(element)
+                else:
+                    sections[element.tag] = element
+                # Whitespace between the removed elements
+                element.text = None if len(element) == 0 else element.text
+                row_tag = None
+        return cls(root, {section: Table.concatenate(chunks[section] + [Table.from_rows(*TABLES[section], rows[section])])
+                          for section in sections})
+
+    @classmethod
+    def fromstring(cls, text) -> "Stats":
+        """
+        :param text: the content of a statistics file, as str or bytes
+        """
+        return cls.read(io.BytesIO(text.encode("utf-8") if isinstance(text, str) else text))
+
+    @classmethod
+    def from_tree(cls, tree: ET.ElementTree) -> "Stats":
+        """
+        :param tree: a parsed statistics file, which is not modified
+        """
+        root = copy.deepcopy(tree.getroot())
+        tables = {}
+        for section in TABLES:
+            element = root.find(section)
+            if element is not None:
+                tag, kinds = TABLES[section]
+                tables[section] = Table.from_rows(tag, kinds, [child.attrib for child in element.findall(tag)])
+                element[:] = [child for child in element if child.tag != tag]
+                element.text = None if len(element) == 0 else element.text
+        return cls(root, tables)
+
+    def write(self, file, precision: Optional[int] = None):
+        """
+        Write the statistics as XML in the same format as ElementTree, i.e. US-ASCII without an XML declaration
+        :param file: path or binary file object to write to. A path ending in .gz is gzip compressed, and - is standard
+            output, see open_output
+        :param precision: number of decimals of floats, or None for the shortest exact representation
+        """
+        # Checked before anything is written, as the rows are formatted after the head of the file
+        if precision is not None and precision < 0:
+            raise ValueError(f"precision must be >= 0, got {precision}")
+        # The tree is written with a unique marker in each section with rows, which is replaced by the rows
+        marker = f"@@rows-{uuid.uuid4().hex}@@"
+        marked = []
+        for element in self._root:
+            table = self._tables.get(element.tag)
+            if table is not None and len(table) > 0 and element is self._root.find(element.tag):
+                marked.append((element, element.text, table))
+                element.text = marker
+        try:
+            parts = ET.tostring(self._root, encoding="unicode").split(marker)
+        finally:
+            for element, text, _ in marked:
+                element.text = text
+
+        with open_output(file) if isinstance(file, str) else nullcontext(file) as f:
+            f.write(parts[0].encode("ascii", "xmlcharrefreplace"))
+            for (_, _, table), part in zip(marked, parts[1:]):
+                for chunk in table.format_rows(precision):
+                    f.write(chunk.encode("ascii", "xmlcharrefreplace"))
+                f.write(part.encode("ascii", "xmlcharrefreplace"))
+
+    def to_tree(self) -> ET.ElementTree:
+        """
+        :return: the statistics as an ElementTree, e.g. for code working on elements
+        """
+        buffer = io.BytesIO()
+        self.write(buffer)
+        buffer.seek(0)
+        return ET.parse(buffer)
@@ -1,46 +1,53 @@
 import logging
-import os
 import random
 import math
-import sys
+from typing import Optional
 
 import numpy as np
-import xml.etree.ElementTree as ET
 
-if 'SUMO_HOME' in os.environ:
-    tools = os.path.join(os.environ['SUMO_HOME'], 'tools')
-    sys.path.append(tools)
-else:
-    sys.exit("Please declare environment variable 'SUMO_HOME' to use sumolib")
+from citystats import Stats
+from network import Network
 
-import sumolib
 
-
-def setup_city_gates(net: sumolib.net.Net, stats: ET.ElementTree, gate_count: str, city_radius: float):
+def setup_city_gates(net: Network, stats: Stats, gate_count: Optional[int], city_radius: float, rng=random,
+                     skip_existing: bool = False):
     """
     Generate the requested amount of city gates based on the network and insert them into stats.
+    :param gate_count: the number of city gates, or None to find it from city_radius
+    :param rng: the random number generator to use, e.g. a random.Random
+    :param skip_existing: do not place new gates at dead ends that already have a gate, e.g. when gates are generated
+        again for the changed edges of an incremental run, whose other gates were generated by the tool
     """
 
-    gate_count = find_gate_count_auto(city_radius) if gate_count == "auto" else int(gate_count)
+    gate_count = find_gate_count_auto(city_radius) if gate_count is None else gate_count
     assert gate_count >= 0, "Number of city gates cannot be negative"
 
     # Find existing gates to determine how many we need to insert
-    xml_gates = stats.find("cityGates")
-    if xml_gates is None:
-        xml_gates = ET.SubElement(stats.getroot(), "cityGates")
-    xml_entrances = xml_gates.findall("entrance")
-    n = gate_count - len(xml_entrances)
+    xml_gates = stats.table("cityGates", create=True)
+    n = gate_count - len(xml_gates)
     if n < 0:
         logging.debug(
-            f"[gates] {gate_count} city gate were requested, but there are already {len(xml_entrances)} defined")
+            f"[gates] {gate_count} city gate were requested, but there are already {len(xml_gates)} defined")
     if n <= 0:
         return
 
     # Find all nodes that are dead ends, i.e. nodes that only have one neighbouring node
     # and at least one of the connecting edges is a road (as opposed to path) and allows private vehicles
-    dead_ends = [node for node in net.getNodes() if len(node.getNeighboringNodes()) == 1
-                 and any([any([lane.allows("private") for lane in edge.getLanes()]) for edge in
-                          node.getIncoming() + node.getOutgoing()])]
+    private_lanes = np.add.reduceat(net.lane_allows("private").astype(np.int64), net.lane_offsets[:-1]) \
+        if len(net.lane_permissions) > 0 else np.zeros(len(net.edge_ids), dtype=np.int64)
+    incoming_lanes = np.bincount(net.edge_to, weights=private_lanes, minlength=len(net.node_ids))
+    outgoing_lanes = np.bincount(net.edge_from, weights=private_lanes, minlength=len(net.node_ids))
+    private_access = (incoming_lanes + outgoing_lanes) > 0
+    dead_ends = np.flatnonzero((net.node_degrees() == 1) & private_access)
+
+    if skip_existing:
+        # Dead ends that already have a gate are not used again. A gate is at the start of an outgoing edge or at the
+        # end of an incoming edge of its node
+        existing_edges = [(net.edge_index(edge), pos) for edge, pos in
+                          zip(xml_gates["edge"].tolist(), np.nan_to_num(xml_gates["pos"]).tolist())]
+        existing_gates = [int(net.edge_from[edge]) if pos == 0 else int(net.edge_to[edge])
+                          for edge, pos in existing_edges if edge is not None]
+        dead_ends = dead_ends[~np.isin(dead_ends, existing_gates)]
 
     # The user cannot get more gates than there are dead ends
     n = min(n, len(dead_ends))
@@ -54,39 +61,41 @@ def setup_city_gates(net: sumolib.net.Net, stats: ET.ElementTree, gate_count: st
     # W<---o--->E
     #      |
     #      S
-    base_rad = random.random() * math.tau
+    base_rad = rng.random() * math.tau
     rads = [(base_rad + i * math.tau / n) % math.tau for i in range(0, n)]
-    directions = [(math.cos(rad), math.sin(rad)) for rad in rads]
+    directions = np.array([(math.cos(rad), math.sin(rad)) for rad in rads]).reshape(n, 2)
 
-    for direction in directions:
-        # Find the dead ends furthest in each direction using the dot product and argmax. Those nodes will be our gates.
-        # Dead ends are removed from the list to avoid duplicates.
-        gate_index = int(np.argmax([np.dot(node.getCoord(), direction) for node in dead_ends]))
-        gate = dead_ends[gate_index]
-        dead_ends.remove(gate)
+    # Project every dead end onto every direction using the dot product
+    coords = net.node_coords[dead_ends]
+    projections = coords[:, 0, None] * directions[None, :, 0] + coords[:, 1, None] * directions[None, :, 1]
+
+    entrances = {"edge": [], "incoming": [], "outgoing": [], "pos": []}
+    for d in range(n):
+        # Find the dead end furthest in each direction using argmax. That node will be our gate.
+        # Chosen dead ends are masked to avoid duplicates.
+        gate_index = int(np.argmax(projections[:, d]))
+        projections[gate_index, :] = -np.inf
+        gate = int(dead_ends[gate_index])
 
         # Decide proportion of the incoming and outgoing vehicles coming through this gate
         # These numbers are relatively to the values of the other gates
         # The number is proportional to the number of lanes allowing private vehicles
-        incoming_lanes = sum(
-            [len([lane for lane in edge.getLanes() if lane.allows("private")]) for edge in gate.getIncoming()])
-        outgoing_lanes = sum(
-            [len([lane for lane in edge.getLanes() if lane.allows("private")]) for edge in gate.getOutgoing()])
-        incoming_traffic = (1 + random.random()) * outgoing_lanes
-        outgoing_traffic = (1 + random.random()) * incoming_lanes
+        incoming_traffic = (1 + rng.random()) * int(outgoing_lanes[gate])
+        outgoing_traffic = (1 + rng.random()) * int(incoming_lanes[gate])
 
         # Add entrance to stats file
-        edge, pos = (gate.getOutgoing()[0], 0) if len(gate.getOutgoing()) > 0 \
-            else (gate.getIncoming()[0], gate.getIncoming()[0].getLength())
+        outgoing, incoming = net.outgoing_edges(gate), net.incoming_edges(gate)
+        edge, pos = (int(outgoing[0]), 0) if len(outgoing) > 0 \
+            else (int(incoming[0]), float(net.edge_lengths[incoming[0]]))
         logging.debug(
-            f"[gates] Adding entrance to statistics, edge: {edge.getID()}, incoming traffic: {incoming_traffic}, outgoing "
-            f"traffic: {outgoing_traffic}")
-        ET.SubElement(xml_gates, "entrance", attrib={
-            "edge": edge.getID(),
-            "incoming": str(incoming_traffic),
-            "outgoing": str(outgoing_traffic),
-            "pos": str(pos)
-        })
+            f"[gates] Adding entrance to statistics, edge: {net.edge_ids[edge]}, incoming traffic: {incoming_traffic}, "
+            f"outgoing traffic: {outgoing_traffic}")
+        entrances["edge"].append(net.edge_ids[edge])
+        entrances["incoming"].append(incoming_traffic)
+        entrances["outgoing"].append(outgoing_traffic)
+        entrances["pos"].append(pos)
+
+    xml_gates.append(**entrances)
 
 
 def find_gate_count_auto(city_radius: float) -> int:
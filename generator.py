@@ -0,0 +1,172 @@
+"""
+The generator as a library, for programs that already have the network and statistics in memory:
+
+    net = load_net("in/example.net.xml")
+    stats = generate(net, Stats.read("in/example.stat.xml"), Options(seed=2, bus_stop=True))
+
+randomActivityGen.py is a command line wrapper around it, which reads and writes the files.
+"""
+import copy
+import logging
+import random
+from typing import Optional, Set, Tuple
+
+import numpy as np
+
+from citystats import TABLES, Stats, Table
+from gates import setup_city_gates
+from geometry import EdgeGeometry
+from incremental import Changes
+from network import Network
+from options import Options
+from perlin import setup_streets, update_streets, NoiseField, NoiseSampler
+from profiling import StageProfiler
+from school import replace_schools, setup_schools
+from utility import find_city_centre, verify_stats, radius_of_network
+# The bus module is imported by the stage using it, so runs without bus stops do not pay for importing it
+
+
+def create_rng(options: Options) -> random.Random:
+    """
+    :return: a random number generator initialised with options.seed, or from the system if it is None
+    """
+    return random.Random(options.seed)
+
+
+def find_centre(net: Network, options: Options) -> Tuple[float, float]:
+    return find_city_centre(net) if options.centre_pos is None else options.centre_pos
+
+
+def create_noise(net: Network, geometry: EdgeGeometry, options: Options, rng: random.Random,
+                 centre: Optional[Tuple[float, float]] = None, radius: Optional[float] = None) \
+        -> Tuple[NoiseSampler, NoiseSampler]:
+    """
+    Create the population and work noise samplers given by options. Their offsets into the noise are the first random
+    numbers drawn from rng
+    :param centre: the centre of the city, by default the one given by options
+    :param radius: the radius of the city, by default the distance from the centre to the outermost node
+    :return: the population and work noise
+    """
+    # Find offsets into the noise
+    pop_offset = 65_536 * rng.random()
+    work_offset = 65_536 * rng.random()
+    while pop_offset == work_offset:
+        work_offset = 65_536 * rng.random()
+    logging.debug(f"[main] Using pop_offset: {pop_offset}, work_offset: {work_offset}")
+
+    if centre is None:
+        centre = find_centre(net, options)
+    if radius is None:
+        radius = radius_of_network(net, centre)
+
+    # Prepare noise sampling
+    pop_noise = NoiseSampler(centre, options.centre_pop_weight, radius, pop_offset)
+    work_noise = NoiseSampler(centre, options.centre_work_weight, radius, work_offset)
+
+    if options.noise_field_resolution is not None:
+        resolution = options.noise_field_resolution
+        pop_noise = NoiseField.load(pop_noise, net.getBoundary(), resolution, options.noise_field_dir)
+        work_noise = NoiseField.load(work_noise, net.getBoundary(), resolution, options.noise_field_dir)
+        logging.info(f"[main] Using noise fields with {resolution} m resolution, max error at streets: "
+                     f"{pop_noise.max_error(geometry.centroids):.2e} (population), "
+                     f"{work_noise.max_error(geometry.centroids):.2e} (work)")
+
+    logging.debug(f"[main] Using centre: {centre}, "
+                  f"radius: {radius}, "
+                  f"centre.pop-weight: {options.centre_pop_weight}, "
+                  f"centre.work-weight: {options.centre_work_weight}")
+    return pop_noise, work_noise
+
+
+def populate(net: Network, geometry: EdgeGeometry, stats: Stats, options: Options, rng: random.Random,
+             profiler: Optional[StageProfiler] = None, changes: Optional[Changes] = None) \
+        -> Tuple[Tuple[float, float], float, Tuple[NoiseSampler, NoiseSampler]]:
+    """
+    Insert streets, city gates, schools, and bus stops into stats, which must have been verified with verify_stats
+    :param rng: the random number generator of this run, all random choices are drawn from it
+    :param profiler: the profiler to record the stages in
+    :param changes: the changes of the network since the earlier run that generated stats, in which case only the
+        parts of stats on changed edges are generated again. By default, everything is generated
+    :return: the centre and radius of the city, and the population and work noise
+    """
+    if profiler is None:
+        profiler = StageProfiler()
+
+    with profiler.stage("centre_radius"):
+        # The centre and radius of the earlier run are kept, so the noise of unchanged edges does not change
+        if changes is not None:
+            centre, radius = changes.centre, changes.radius
+        else:
+            centre = find_centre(net, options)
+            radius = radius_of_network(net, centre)
+
+    # Insert streets, gates, and schools
+    with profiler.stage("streets"):
+        pop_noise, work_noise = create_noise(net, geometry, options, rng, centre, radius)
+        logging.info("[main] Setting up streets with population and workplaces")
+        if changes is not None:
+            populations = update_streets(geometry, stats, pop_noise, work_noise, changes.stale, options.workers)
+        else:
+            populations, _ = setup_streets(geometry, stats, pop_noise, work_noise, options.workers)
+
+    with profiler.stage("gates"):
+        logging.debug(f"[main] Setting up city gates")
+        if changes is not None:
+            _remove_stale(stats, "cityGates", changes.stale)
+        setup_city_gates(net, stats, options.gates_count, radius, rng, skip_existing=changes is not None)
+
+    with profiler.stage("schools"):
+        logging.info("[main] Setting up schools")
+        if changes is not None:
+            replace_schools(geometry, stats, changes.stale, populations, changes.schools, rng)
+        else:
+            setup_schools(options, geometry, stats, populations, rng)
+
+    with profiler.stage("bus_stops"):
+        if options.bus_stop:
+            from bus import setup_bus_stops
+            logging.debug(f"[main] Setting up bus-stops")
+            active_near = None
+            if changes is not None:
+                # Only look for new bus stops where stops were removed or edges were added or changed
+                removed = _remove_stale(stats, "busStations", changes.stale)
+                removed_positions = [changes.bus_stops[key] for key in
+                                     zip(removed["edge"].tolist(), removed["pos"].tolist())
+                                     if key in changes.bus_stops]
+                active_near = np.vstack((np.array(removed_positions).reshape(-1, 2), geometry.centroids[changes.dirty]))
+            setup_bus_stops(geometry, stats, options.bus_stop_distance, options.bus_stop_k, options.bus_stop_sampling,
+                            rng, active_near)
+
+    return centre, radius, (pop_noise, work_noise)
+
+
+def _remove_stale(stats: Stats, section: str, stale: Set[str]) -> Table:
+    """
+    Remove the rows of the given section whose edge is stale
+    :return: the removed rows
+    """
+    table = stats.table(section)
+    if table is None:
+        return Table(*TABLES[section])
+    return table.remove(table.edge_in(stale))
+
+
+def generate(net: Network, stats: Stats, options: Optional[Options] = None, geometry: Optional[EdgeGeometry] = None,
+             rng: Optional[random.Random] = None) -> Stats:
+    """
+    Generate the statistics of a city for a loaded network. Nothing is read or written, except for noise grids if
+    options.noise_field_dir is given
+    :param net: the network, e.g. from load_net or read_net
+    :param stats: the statistics to start from, e.g. Stats.fromstring(text). It is not modified
+    :param options: the options of the generator, by default those of the command line
+    :param geometry: the geometry of net, computed if not given. Pass it when generating for the same network often
+    :param rng: the random number generator to draw from, by default one initialised with options.seed
+    :return: the generated statistics, a copy of stats with streets, city gates, schools, and bus stops inserted
+    """
+    if options is None:
+        options = Options()
+    stats = copy.deepcopy(stats)
+    verify_stats(stats)
+    populate(net, geometry if geometry is not None else EdgeGeometry(net), stats, options,
+             rng if rng is not None else create_rng(options))
+    return stats
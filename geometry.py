@@ -0,0 +1,191 @@
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from citystats import Table
+from network import Network, NetworkEdge
+from utility import distance
+
+
+class EdgeGeometry:
+    """
+    Index of the shapes of all edges in a network stored as flat NumPy arrays. It is built once after the network is
+    read, such that each geometric quantity is only computed once per run. Edges are referred to by their index, which
+    is their position in net.getEdges().
+    """
+
+    # Names of the arrays computed from the network, see arrays()
+    ARRAYS = ("travelled", "cum_lengths", "centroids", "shape_lengths")
+
+    def __init__(self, net: Network, arrays: Optional[Dict[str, np.ndarray]] = None):
+        """
+        :param net: the network to index
+        :param arrays: the arrays returned by arrays() of an earlier EdgeGeometry of the same network, e.g.
+            memory-mapped from disk, such that they are not computed again
+        """
+        self._net = net
+        self.ids = net.edge_ids
+
+        # The vertices of edge i are vertices[offsets[i]:offsets[i + 1]]
+        self.offsets = net.shape_offsets
+        self.vertices = net.shape_vertices
+        self.lengths = net.edge_lengths
+
+        if arrays is not None:
+            self._travelled = arrays["travelled"]
+            self.cum_lengths = arrays["cum_lengths"]
+            self.centroids = arrays["centroids"]
+            self.shape_lengths = arrays["shape_lengths"]
+            return
+
+        counts = np.diff(self.offsets)
+        assert np.all(counts > 0), "Cannot index edges without a shape"
+
+        # Length of the segment between each vertex and the next, zero where the next vertex belongs to another edge
+        segments = distance(self.vertices[:-1].T, self.vertices[1:].T)
+        segments[self.offsets[1:-1] - 1] = 0.0
+
+        # Distance travelled along the shape of its edge to reach each vertex. The distance travelled along all edges
+        # before it is also kept, as it is increasing across edges and can thus be binary searched
+        self._travelled = np.concatenate(([0.0], np.cumsum(segments)))
+        self.cum_lengths = self._travelled - np.repeat(self._travelled[self.offsets[:-1]], counts)
+
+        self.centroids = np.add.reduceat(self.vertices, self.offsets[:-1], axis=0) / counts[:, None]
+        self.shape_lengths = self.cum_lengths[self.offsets[1:] - 1]
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        """
+        :return: the arrays computed from the network by name, which can be given to the constructor to skip computing
+            them
+        """
+        return {"travelled": self._travelled, "cum_lengths": self.cum_lengths, "centroids": self.centroids,
+                "shape_lengths": self.shape_lengths}
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def edges(self) -> List[NetworkEdge]:
+        return self._net.getEdges()
+
+    def index_of(self, edge_id: str) -> Optional[int]:
+        """
+        :return: the index of the edge with the given id, or None if no such edge exists
+        """
+        return self._net.edge_index(edge_id)
+
+    def indices_of(self, edge_ids: Iterable[str]) -> np.ndarray:
+        """
+        :return: the index of each of the edges with the given ids, -1 where no such edge exists
+        """
+        return np.array([-1 if index is None else index for index in map(self._net.edge_index, edge_ids)],
+                        dtype=np.int64)
+
+    def allows(self, vclass: str) -> np.ndarray:
+        """
+        :return: boolean array telling whether each edge has a lane which allows the given vehicle class
+        """
+        return self._net.edge_allows(vclass)
+
+    def shape(self, index: int) -> np.ndarray:
+        """
+        :return: the vertices of the shape of the edge with the given index as an array of shape (n, 2)
+        """
+        return self.vertices[self.offsets[index]:self.offsets[index + 1]]
+
+    def position_on_edge(self, index: int, pos: float) -> Tuple[float, float]:
+        """
+        :return: coordinate achieved by moving along the edge with the given index by pos meters.
+        """
+        x, y = self.positions_on_edges(np.array([index]), np.array([pos], dtype=np.float64))[0]
+        return float(x), float(y)
+
+    def element_positions(self, elements: Table) -> np.ndarray:
+        """
+        :param elements: statistics elements placed on an edge, i.e. with edge and pos attributes, e.g. schools
+        :return: array of shape (n, 2) with the coordinates of the elements
+        """
+        return self.positions_on_edges(self.indices_of(elements["edge"].tolist()), elements["pos"])
+
+    def positions_on_edges(self, edge_idx: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+        """
+        Vectorized position_on_edge.
+        :param edge_idx: array of n edge indices
+        :param offsets: array of n distances to move along the corresponding edges
+        :return: array of shape (n, 2) with the coordinates achieved by moving along edge_idx[i] by offsets[i] meters
+        """
+        edge_idx = np.asarray(edge_idx, dtype=np.int64)
+        offsets = np.asarray(offsets, dtype=np.float64)
+        starts, ends = self.offsets[edge_idx], self.offsets[edge_idx + 1]
+        assert np.all(ends - starts >= 2), "Edge shape has less than two coordinates, cannot get position on edge"
+
+        # Find the segment where, if we travel through it, we have moved the offset or more in total. Offsets beyond
+        # the end of the shape are found by extending the last segment
+        segments = np.searchsorted(self._travelled, self._travelled[starts] + offsets) - 1
+        segments = np.clip(segments, starts, ends - 2)
+        coord1, coord2 = self.vertices[segments], self.vertices[segments + 1]
+        segment_lengths = self.cum_lengths[segments + 1] - self.cum_lengths[segments]
+
+        # Move the remaining distance from coord1 towards coord2
+        remaining = offsets - self.cum_lengths[segments]
+        fraction = np.divide(remaining, segment_lengths, out=np.zeros_like(remaining), where=segment_lengths > 0)
+        return coord1 + (coord2 - coord1) * fraction[:, None]
+
+
+class SegmentIndex:
+    """
+    Spatial index of the segments of the shapes in an EdgeGeometry. Segments are registered in every cell of a uniform
+    grid that their bounding box overlaps, such that segments near a point can be found by only looking at the cells
+    around it. A segment is referred to by the index of its first vertex in geometry.vertices.
+    """
+
+    def __init__(self, geometry: EdgeGeometry, cell_size: float):
+        assert cell_size > 0
+        self.geometry = geometry
+        self.cell_size = cell_size
+
+        # Every vertex starts a segment, except the last vertex of each edge
+        is_start = np.ones(len(geometry.vertices), dtype=bool)
+        is_start[geometry.offsets[1:] - 1] = False
+        segments = np.flatnonzero(is_start)
+        self.segment_edges = np.repeat(np.arange(len(geometry)), np.diff(geometry.offsets))
+
+        # Range of cells covered by the bounding box of each segment
+        cells = np.floor(geometry.vertices / cell_size).astype(np.int64)
+        low = np.minimum(cells[segments], cells[segments + 1])
+        high = np.maximum(cells[segments], cells[segments + 1])
+        self._origin = low.min(axis=0) if len(segments) > 0 else np.zeros(2, dtype=np.int64)
+        self._rows = int(high[:, 1].max() - self._origin[1] + 1) if len(segments) > 0 else 1
+        low -= self._origin
+        high -= self._origin
+
+        # Expand each segment into one (cell, segment) pair per covered cell
+        size = high - low + 1
+        counts = size[:, 0] * size[:, 1]
+        owner = np.repeat(np.arange(len(segments)), counts)
+        local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        cx = low[owner, 0] + local // size[owner, 1]
+        cy = low[owner, 1] + local % size[owner, 1]
+
+        # Pairs are sorted by cell key, which is column-major, such that a column of cells is a contiguous range
+        keys = cx * self._rows + cy
+        order = np.argsort(keys, kind="stable")
+        self._keys = keys[order]
+        self._segments = segments[owner[order]]
+
+    def segments_near(self, centre: Tuple[float, float], radius: float) -> np.ndarray:
+        """
+        :return: sorted array of the segments whose bounding box overlaps the bounding box of the circle with the given
+            centre and radius
+        """
+        low = np.floor((np.asarray(centre) - radius) / self.cell_size).astype(np.int64) - self._origin
+        high = np.floor((np.asarray(centre) + radius) / self.cell_size).astype(np.int64) - self._origin
+        low[1], high[1] = max(low[1], 0), min(high[1], self._rows - 1)
+        if low[1] > high[1]:
+            return np.empty(0, dtype=np.int64)
+
+        columns = np.arange(max(low[0], 0), high[0] + 1)
+        starts = np.searchsorted(self._keys, columns * self._rows + low[1], side="left")
+        ends = np.searchsorted(self._keys, columns * self._rows + high[1], side="right")
+        found = [self._segments[start:end] for start, end in zip(starts.tolist(), ends.tolist()) if start < end]
+        return np.unique(np.concatenate(found)) if found else np.empty(0, dtype=np.int64)
@@ -0,0 +1,171 @@
+import hashlib
+import json
+import logging
+import os
+from dataclasses import dataclass
+from typing import Dict, Optional, Set, Tuple
+
+import numpy as np
+
+from citystats import Stats, Table
+from geometry import EdgeGeometry
+from netcache import net_file_hash
+from network import Network
+
+# Bump when the contents of a manifest changes, such that old manifests are not used
+MANIFEST_VERSION = 2
+
+# Options that do not change the generated statistics, so they may differ between incremental runs
+IGNORED_OPTIONS = ("--output-file", "--net-file", "--net-cache", "--no-net-cache", "--display", "--log", "--quiet",
+                   "--verbose", "--profile", "--workers", "--batch", "--incremental", "--noise-field.dir", "--serve",
+                   "--help", "--version")
+
+
+def _mix(x: np.ndarray) -> np.ndarray:
+    """
+    The splitmix64 finaliser, which scrambles the bits of each uint64 such that similar inputs give unrelated outputs
+    """
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> np.uint64(31))
+
+
+def _hash_groups(values: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """
+    :param values: uint64 array of shape (n,) or (n, 2)
+    :param offsets: group i is values[offsets[i]:offsets[i + 1]], groups must not be empty
+    :return: a 64-bit hash of each group, which depends on the order of the values within the group
+    """
+    local = (np.arange(len(values)) - np.repeat(offsets[:-1], np.diff(offsets))).astype(np.uint64)
+    hashed = _mix(local)
+    for column in values.reshape(len(values), -1).T:
+        hashed = _mix(column ^ hashed)
+    return np.bitwise_xor.reduceat(hashed, offsets[:-1]) if len(offsets) > 1 else np.zeros(0, dtype=np.uint64)
+
+
+def edge_fingerprints(net: Network) -> np.ndarray:
+    """
+    :return: uint64 array with a fingerprint of each edge of the network, which changes when the shape, length or lane
+        permissions of the edge changes
+    """
+    vertices = np.ascontiguousarray(net.shape_vertices, dtype=np.float64).view(np.uint64)
+    shapes = _hash_groups(vertices, np.asarray(net.shape_offsets))
+    lanes = _hash_groups(np.asarray(net.lane_permissions, dtype=np.uint64), np.asarray(net.lane_offsets))
+    lengths = np.ascontiguousarray(net.edge_lengths, dtype=np.float64).view(np.uint64)
+    return _mix(shapes ^ _mix(lanes ^ _mix(lengths)))
+
+
+def options_key(args) -> str:
+    """
+    :return: hex digest of the options that change the generated statistics and of the content of the statistics file
+    """
+    options = {key: value for key, value in args.items() if not key.startswith(IGNORED_OPTIONS)}
+    digest = hashlib.blake2b(json.dumps(options, sort_keys=True).encode("utf-8"), digest_size=20)
+    digest.update(net_file_hash(args["--stat-file"]).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def manifest_path(args) -> str:
+    return f"{args['--output-file']}.manifest.json" if args["--incremental.manifest"] == "auto" \
+        else args["--incremental.manifest"]
+
+
+def read_manifest(args) -> Optional[dict]:
+    """
+    Read the manifest of an earlier run with the same options, if there is one and its output file still exists
+    :return: the manifest, or None if the statistics must be generated from scratch
+    """
+    path = manifest_path(args)
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        logging.info(f"[incremental] No manifest found at {path}, generating all statistics")
+        return None
+    if manifest.get("version") != MANIFEST_VERSION or manifest.get("options") != options_key(args):
+        logging.info(f"[incremental] Manifest {path} is from another version or other options, generating all "
+                     f"statistics")
+        return None
+    if not os.path.exists(args["--output-file"]):
+        logging.info(f"[incremental] Output of manifest {path} is missing, generating all statistics")
+        return None
+    return manifest
+
+
+@dataclass
+class Changes:
+    """
+    The changes of the network since an earlier incremental run, and what that run placed, see find_changes
+    """
+    # The centre and radius of the city in the earlier run
+    centre: Tuple[float, float]
+    radius: float
+    # Indices of the edges that were added or changed
+    dirty: np.ndarray
+    # Ids of the edges that were changed or removed, i.e. the edges whose streets, gates, schools and bus stops are stale
+    stale: Set[str]
+    # The coordinates of the schools and bus stops of the earlier run, by edge and pos
+    schools: Dict[Tuple[str, float], Tuple[float, float]]
+    bus_stops: Dict[Tuple[str, float], Tuple[float, float]]
+
+
+def find_changes(manifest: dict, geometry: EdgeGeometry, fingerprints: np.ndarray) -> Changes:
+    """
+    Compare the edges of the network with those of the run that wrote the manifest
+    """
+    old = manifest["edges"]
+    dirty = [i for i, (eid, fingerprint) in enumerate(zip(geometry.ids, fingerprints.tolist()))
+             if old.get(eid) != fingerprint]
+    changed = {geometry.ids[i] for i in dirty if geometry.ids[i] in old}
+    removed = set(old).difference(geometry.ids)
+    logging.info(f"[incremental] {len(dirty) - len(changed)} edges added, {len(changed)} changed, "
+                 f"{len(removed)} removed since the last run")
+    return Changes(centre=(manifest["centre"][0], manifest["centre"][1]), radius=manifest["radius"],
+                   dirty=np.array(dirty, dtype=np.int64), stale=changed | removed,
+                   schools=_positions(manifest, "schools"), bus_stops=_positions(manifest, "bus_stops"))
+
+
+def _placed(geometry: EdgeGeometry, table: Optional[Table], precision: Optional[int]) -> list:
+    """
+    :param precision: the precision the statistics are written with, see Stats.write
+    :return: [edge, pos, x, y] of each row of table whose edge is in the network, with pos as it is read back from the
+        written statistics
+    """
+    if table is None:
+        return []
+    table = table.take(geometry.indices_of(table["edge"].tolist()) >= 0)
+    positions = geometry.element_positions(table).tolist()
+    written = table["pos"].tolist() if precision is None else \
+        [float(f"{pos:.{precision}f}") for pos in table["pos"].tolist()]
+    return [[edge, pos, x, y] for edge, pos, (x, y) in zip(table["edge"].tolist(), written, positions)]
+
+
+def _positions(manifest: dict, kind: str) -> Dict[Tuple[str, float], Tuple[float, float]]:
+    """
+    :param kind: "schools" or "bus_stops"
+    :return: the coordinates of the elements of the given kind when the manifest was written, by edge and pos
+    """
+    return {(edge, pos): (x, y) for edge, pos, x, y in manifest[kind]}
+
+
+def write_manifest(args, geometry: EdgeGeometry, fingerprints: np.ndarray, centre: Tuple[float, float], radius: float,
+                   stats: Stats, precision: Optional[int] = None):
+    """
+    Write the manifest of this run next to the output file, such that the next incremental run can find what changed
+    :param precision: the precision the statistics were written with, see Stats.write
+    """
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "options": options_key(args),
+        "centre": [float(centre[0]), float(centre[1])],
+        "radius": float(radius),
+        "edges": dict(zip(geometry.ids, fingerprints.tolist())),
+        "schools": _placed(geometry, stats.table("schools"), precision),
+        "bus_stops": _placed(geometry, stats.table("busStations"), precision),
+    }
+    path = manifest_path(args)
+    tmp = f"{path}.tmp-{os.getpid()}"
+    with open(tmp, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp, path)
+    logging.debug(f"[incremental] Wrote manifest of {len(geometry)} edges to {path}")
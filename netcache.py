@@ -0,0 +1,224 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from geometry import EdgeGeometry
+from network import Network, read_net
+from utility import find_city_centre, radius_of_network
+
+# Bump when the contents of a snapshot changes, such that old snapshots are not used
+SNAPSHOT_VERSION = 1
+
+_ARRAYS = ("edge_from", "edge_to", "edge_lengths", "shape_offsets", "shape_vertices", "lane_offsets",
+           "lane_permissions", "node_coords", "boundary")
+
+
+def default_cache_dir(kind: str = "networks") -> str:
+    """
+    :param kind: what is cached, e.g. "networks" for network snapshots. Each kind has its own directory
+    :return: the directory to store cached files in when none is given, following the XDG base directory spec
+    """
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "randomActivityGen", kind)
+
+
+def net_file_hash(path: str) -> str:
+    """
+    :return: hex digest of the content of the file at path
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _cached_net_file_hash(path: str, cache_dir: str) -> str:
+    """
+    Content hash of the file at path. Hashes are remembered by path, size and modification time in cache_dir, so
+    unchanged files are not hashed again.
+    """
+    stat = os.stat(path)
+    stamp = f"{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}"
+    index_file = os.path.join(cache_dir, "hashes.json")
+    try:
+        with open(index_file) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        index = {}
+    if stamp in index:
+        return index[stamp]
+
+    digest = net_file_hash(path)
+    # Forget hashes of snapshots that no longer exist
+    index = {key: value for key, value in index.items() if os.path.isdir(os.path.join(cache_dir, value))}
+    index[stamp] = digest
+    tmp = f"{index_file}.tmp-{os.getpid()}-{threading.get_ident()}"
+    with open(tmp, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp, index_file)
+    return digest
+
+
+def _save_strings(directory: str, name: str, strings: List[str]):
+    # SUMO ids are XML attribute values, which cannot contain NUL, so it is safe as a separator
+    blob = "\0".join(strings).encode("utf-8")
+    np.save(os.path.join(directory, f"{name}.npy"), np.frombuffer(blob, dtype=np.uint8))
+
+
+def _load_strings(directory: str, name: str) -> List[str]:
+    blob = np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r")
+    return blob.tobytes().decode("utf-8").split("\0") if len(blob) > 0 else []
+
+
+def write_snapshot(net: Network, directory: str):
+    """
+    Write the arrays of net and values derived from it, e.g. the centre and radius, to a snapshot directory.
+    The snapshot is written to a temporary directory first, such that readers never see a partial snapshot.
+    """
+    # Make sure the derived values are computed, so they are stored too
+    radius_of_network(net, find_city_centre(net))
+
+    tmp = f"{directory}.tmp-{os.getpid()}-{threading.get_ident()}"
+    os.makedirs(tmp)
+    try:
+        for name in _ARRAYS:
+            np.save(os.path.join(tmp, f"{name}.npy"), getattr(net, name))
+        _save_strings(tmp, "edge_ids", net.edge_ids)
+        _save_strings(tmp, "node_ids", net.node_ids)
+        with open(os.path.join(tmp, "meta.json"), "w") as f:
+            json.dump({"version": SNAPSHOT_VERSION, "derived": net.derived}, f)
+        os.rename(tmp, directory)
+    finally:
+        # If another process wrote the same snapshot first, ours is discarded
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def read_snapshot(directory: str) -> Network:
+    """
+    Read a network from a snapshot directory. Arrays are memory-mapped rather than read.
+    """
+    with open(os.path.join(directory, "meta.json")) as f:
+        meta = json.load(f)
+    if meta.get("version") != SNAPSHOT_VERSION:
+        raise ValueError(f"Snapshot has version {meta.get('version')}, expected {SNAPSHOT_VERSION}")
+
+    arrays = {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r") for name in _ARRAYS}
+    net = Network(edge_ids=_load_strings(directory, "edge_ids"), node_ids=_load_strings(directory, "node_ids"),
+                  **arrays)
+    net.derived.update(meta["derived"])
+    return net
+
+
+def publish_network(net: Network, geometry: EdgeGeometry, directory: str):
+    """
+    Write the arrays of net and geometry to directory, such that other processes can attach to them with
+    attach_network without parsing the network or computing its geometry. The directory must not exist.
+    """
+    write_snapshot(net, directory)
+    for name, array in geometry.arrays().items():
+        np.save(os.path.join(directory, f"geometry_{name}.npy"), array)
+
+
+def attach_network(directory: str) -> Tuple[Network, EdgeGeometry]:
+    """
+    Attach to a network published with publish_network. The arrays are memory-mapped, so processes attached to the
+    same directory share their memory.
+    :return: the network and its geometry
+    """
+    net = read_snapshot(directory)
+    arrays = {name: np.load(os.path.join(directory, f"geometry_{name}.npy"), mmap_mode="r")
+              for name in EdgeGeometry.ARRAYS}
+    return net, EdgeGeometry(net, arrays)
+
+
+def _dir_size(directory: str) -> int:
+    return sum(entry.stat().st_size for entry in os.scandir(directory) if entry.is_file())
+
+
+def evict(cache_dir: str, max_bytes: int, max_age: float, keep: Optional[str] = None):
+    """
+    Remove snapshots that have not been used for max_age seconds, then the least recently used snapshots until the
+    total size of the cache is at most max_bytes.
+    :param keep: a snapshot directory that must not be removed, e.g. the one in use
+    """
+    now = time.time()
+    snapshots = []
+    for entry in os.scandir(cache_dir):
+        # Snapshots being written by other processes are left alone
+        if entry.is_dir() and ".tmp-" not in entry.name and entry.path != keep:
+            snapshots.append((entry.stat().st_mtime, _dir_size(entry.path), entry.path))
+    total = _dir_size(keep) if keep is not None and os.path.isdir(keep) else 0
+
+    # Newest first, so the least recently used snapshots are the ones exceeding the size limit
+    for last_used, size, path in sorted(snapshots, reverse=True):
+        if now - last_used > max_age or total + size > max_bytes:
+            logging.debug(f"[netcache] Evicting network snapshot {path}")
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            total += size
+
+
+def load_net(path: str, cache_dir: Optional[str] = None, max_bytes: int = 1 << 30,
+             max_age: float = 30 * 24 * 3600) -> Network:
+    """
+    Read the network at path, using a snapshot from cache_dir when the network file has been read before.
+    Snapshots are keyed by the content hash of the network file.
+    :param path: path to the .net.xml file
+    :param cache_dir: directory with network snapshots, or None to always parse the network file
+    :param max_bytes: maximum total size of the snapshots in cache_dir
+    :param max_age: maximum time in seconds since a snapshot was last used before it is removed
+    :return: the Network
+    """
+    if cache_dir is None:
+        return read_net(path)
+
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        snapshot = os.path.join(cache_dir, _cached_net_file_hash(path, cache_dir))
+    except OSError as e:
+        logging.warning(f"[netcache] Cannot use network snapshot directory {cache_dir}: {e}")
+        return read_net(path)
+
+    if os.path.isdir(snapshot):
+        try:
+            net = read_snapshot(snapshot)
+            # Mark the snapshot as recently used
+            os.utime(snapshot)
+            logging.debug(f"[netcache] Using network snapshot {snapshot}")
+            return net
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"[netcache] Discarding unusable network snapshot {snapshot}: {e}")
+            shutil.rmtree(snapshot, ignore_errors=True)
+
+    net = read_net(path)
+    try:
+        if not os.path.isdir(snapshot):
+            write_snapshot(net, snapshot)
+            logging.debug(f"[netcache] Wrote network snapshot {snapshot}")
+        evict(cache_dir, max_bytes, max_age, keep=snapshot)
+    except OSError as e:
+        logging.warning(f"[netcache] Could not write network snapshot to {cache_dir}: {e}")
+    return net
+
+
+def load_network(path: str, cache_dir: Optional[str] = None, max_bytes: int = 1 << 30,
+                 max_age: float = 30 * 24 * 3600) -> Tuple[Network, EdgeGeometry]:
+    """
+    Read the network at path like load_net does and index its geometry
+    :param path: path to the .net.xml file
+    :param cache_dir: directory with network snapshots, or None to always parse the network file
+    :param max_bytes: maximum total size of the snapshots in cache_dir
+    :param max_age: maximum time in seconds since a snapshot was last used before it is removed
+    :return: the Network and its EdgeGeometry
+    """
+    logging.debug(f"[netcache] Reading network from: {path}")
+    net = load_net(path, cache_dir, max_bytes, max_age)
+    return net, EdgeGeometry(net)
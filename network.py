@@ -0,0 +1,339 @@
+import logging
+import xml.etree.ElementTree as ET
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from streams import open_input
+
+# Vehicle classes known by SUMO, see sumolib.net.lane. The position in this tuple is the bit used in permission masks
+VEHICLE_CLASSES = (
+    "private", "emergency", "authority", "army", "vip", "passenger", "hov", "taxi", "bus", "coach", "delivery", "truck",
+    "trailer", "tram", "rail_urban", "rail", "rail_electric", "motorcycle", "moped", "bicycle", "pedestrian",
+    "evehicle", "ship", "container", "cable_car", "subway", "aircraft", "wheelchair", "scooter", "drone", "custom1",
+    "custom2",
+    # Deprecated classes
+    "public_emergency", "public_authority", "public_army", "public_transport", "transport", "lightrail", "cityrail",
+    "rail_slow", "rail_fast")
+
+_VEHICLE_CLASS_BITS = {vclass: np.uint64(1 << i) for i, vclass in enumerate(VEHICLE_CLASSES)}
+ALL_VEHICLE_CLASSES = np.uint64((1 << len(VEHICLE_CLASSES)) - 1)
+
+
+def vehicle_class_mask(vclasses: Iterable[str]) -> np.uint64:
+    """
+    :return: the permission mask with the bits of the given vehicle classes set. Unknown classes are ignored
+    """
+    mask = np.uint64(0)
+    for vclass in vclasses:
+        mask |= _VEHICLE_CLASS_BITS.get(vclass, np.uint64(0))
+    return mask
+
+
+def permission_mask(allow: Optional[str], disallow: Optional[str]) -> np.uint64:
+    """
+    Normalise the allow and disallow attributes of a lane to a permission mask in the same way as sumolib does
+    """
+    if allow is None and disallow is None:
+        return ALL_VEHICLE_CLASSES
+    elif disallow is None:
+        return vehicle_class_mask(allow.split())
+    elif disallow == "all":
+        return np.uint64(0)
+    else:
+        return ALL_VEHICLE_CLASSES & ~vehicle_class_mask(disallow.split())
+
+
+def _parse_shape(shape: str) -> List[Tuple[float, float]]:
+    return [tuple(map(float, pos.split(",")[:2])) for pos in shape.split()]
+
+
+def _edge_shape(lane_shapes: List[List[Tuple[float, float]]]) -> List[Tuple[float, float]]:
+    """
+    The shape of an edge is the shape of its middle lane, or the average of its lanes if there is an even number of
+    lanes. This mirrors sumolib.net.edge.Edge.rebuildShape
+    """
+    if len(lane_shapes) % 2 == 1:
+        return lane_shapes[len(lane_shapes) // 2]
+    shape = []
+    for i in range(min(map(len, lane_shapes))):
+        x, y = 0., 0.
+        for lane_shape in lane_shapes:
+            x += lane_shape[i][0]
+            y += lane_shape[i][1]
+        shape.append((x / float(len(lane_shapes)), y / float(len(lane_shapes))))
+    return shape
+
+
+class Network:
+    """
+    The parts of a SUMO network used by the generator stored in compact arrays; edge ids, shapes, lengths, from and to
+    nodes, node coordinates, lane permissions and the boundary. Only normal edges are included, i.e. no internal edges.
+    Edges and nodes are referred to by their index, which follows the order of sumolib.net.readNet.
+
+    A small sumolib-like adapter (getEdges, getEdge, getNodes, getBoundary and the views they return) is provided for
+    code that works on edges and nodes as objects.
+    """
+
+    def __init__(self, edge_ids: List[str], edge_from: np.ndarray, edge_to: np.ndarray, edge_lengths: np.ndarray,
+                 shape_offsets: np.ndarray, shape_vertices: np.ndarray, lane_offsets: np.ndarray,
+                 lane_permissions: np.ndarray, node_ids: List[str], node_coords: np.ndarray, boundary: np.ndarray):
+        self.edge_ids = edge_ids
+        self.edge_from = edge_from
+        self.edge_to = edge_to
+        self.edge_lengths = edge_lengths
+        # The shape of edge i is shape_vertices[shape_offsets[i]:shape_offsets[i + 1]]
+        self.shape_offsets = shape_offsets
+        self.shape_vertices = shape_vertices
+        # The lanes of edge i are lane_permissions[lane_offsets[i]:lane_offsets[i + 1]]
+        self.lane_offsets = lane_offsets
+        self.lane_permissions = lane_permissions
+        self.node_ids = node_ids
+        self.node_coords = node_coords
+        self.boundary = boundary
+        # Values derived from the network, e.g. its centre, which are stored alongside it in snapshots
+        self.derived = {}
+
+        self._edge_index = {eid: i for i, eid in enumerate(edge_ids)}
+        self._edges = None
+        self._nodes = None
+        self._incoming = None
+        self._outgoing = None
+
+    def edge_index(self, edge_id: str) -> Optional[int]:
+        """
+        :return: the index of the edge with the given id, or None if no such edge exists
+        """
+        return self._edge_index.get(edge_id)
+
+    def edge_permissions(self) -> np.ndarray:
+        """
+        :return: the union of the lane permission masks of each edge
+        """
+        if len(self.lane_permissions) == 0:
+            return np.zeros(len(self.edge_ids), dtype=np.uint64)
+        return np.bitwise_or.reduceat(self.lane_permissions, self.lane_offsets[:-1])
+
+    def edge_allows(self, vclass: str) -> np.ndarray:
+        """
+        :return: boolean array telling whether each edge has a lane which allows the given vehicle class
+        """
+        return (self.edge_permissions() & vehicle_class_mask([vclass])) != 0
+
+    def lane_allows(self, vclass: str) -> np.ndarray:
+        """
+        :return: boolean array telling whether each lane allows the given vehicle class
+        """
+        return (self.lane_permissions & vehicle_class_mask([vclass])) != 0
+
+    def node_degrees(self) -> np.ndarray:
+        """
+        :return: the number of distinct neighbouring nodes of each node, i.e. nodes connected to it by an edge in either
+            direction. Edges from a node to itself are ignored
+        """
+        pairs = np.concatenate((np.stack((self.edge_from, self.edge_to), axis=1),
+                                np.stack((self.edge_to, self.edge_from), axis=1))).astype(np.int64)
+        pairs = pairs[pairs[:, 0] != pairs[:, 1]]
+        pairs = np.unique(pairs[:, 0] * len(self.node_ids) + pairs[:, 1])
+        return np.bincount(pairs // max(len(self.node_ids), 1), minlength=len(self.node_ids))
+
+    def incoming_edges(self, node: int) -> np.ndarray:
+        if self._incoming is None:
+            self._incoming = _group_by(self.edge_to, len(self.node_ids))
+        order, offsets = self._incoming
+        return order[offsets[node]:offsets[node + 1]]
+
+    def outgoing_edges(self, node: int) -> np.ndarray:
+        if self._outgoing is None:
+            self._outgoing = _group_by(self.edge_from, len(self.node_ids))
+        order, offsets = self._outgoing
+        return order[offsets[node]:offsets[node + 1]]
+
+    # sumolib-like adapter
+
+    def getEdges(self) -> List["NetworkEdge"]:
+        if self._edges is None:
+            self._edges = [NetworkEdge(self, i) for i in range(len(self.edge_ids))]
+        return self._edges
+
+    def getEdge(self, edge_id: str) -> "NetworkEdge":
+        return self.getEdges()[self._edge_index[edge_id]]
+
+    def hasEdge(self, edge_id: str) -> bool:
+        return edge_id in self._edge_index
+
+    def getNodes(self) -> List["NetworkNode"]:
+        if self._nodes is None:
+            self._nodes = [NetworkNode(self, i) for i in range(len(self.node_ids))]
+        return self._nodes
+
+    def getBoundary(self) -> List[float]:
+        return self.boundary.tolist()
+
+
+def _group_by(keys: np.ndarray, n: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    :return: the indices of keys sorted by key (stable), and the offsets of each of the n keys into them
+    """
+    order = np.argsort(keys, kind="stable")
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(keys, minlength=n), out=offsets[1:])
+    return order, offsets
+
+
+class NetworkLane:
+    """ View of a lane in a Network """
+
+    def __init__(self, net: Network, index: int):
+        self._net = net
+        self._index = index
+
+    def allows(self, vclass: str) -> bool:
+        return bool(self._net.lane_permissions[self._index] & vehicle_class_mask([vclass]))
+
+
+class NetworkEdge:
+    """ View of an edge in a Network """
+
+    def __init__(self, net: Network, index: int):
+        self._net = net
+        self._index = index
+
+    def getID(self) -> str:
+        return self._net.edge_ids[self._index]
+
+    def getLength(self) -> float:
+        return float(self._net.edge_lengths[self._index])
+
+    def getShape(self) -> List[Tuple[float, float]]:
+        net = self._net
+        return [tuple(pos) for pos in
+                net.shape_vertices[net.shape_offsets[self._index]:net.shape_offsets[self._index + 1]].tolist()]
+
+    def getLanes(self) -> List[NetworkLane]:
+        net = self._net
+        return [NetworkLane(net, i) for i in range(net.lane_offsets[self._index], net.lane_offsets[self._index + 1])]
+
+    def allows(self, vclass: str) -> bool:
+        return any(lane.allows(vclass) for lane in self.getLanes())
+
+    def getFromNode(self) -> "NetworkNode":
+        return self._net.getNodes()[self._net.edge_from[self._index]]
+
+    def getToNode(self) -> "NetworkNode":
+        return self._net.getNodes()[self._net.edge_to[self._index]]
+
+
+class NetworkNode:
+    """ View of a node in a Network """
+
+    def __init__(self, net: Network, index: int):
+        self._net = net
+        self._index = index
+
+    def getID(self) -> str:
+        return self._net.node_ids[self._index]
+
+    def getCoord(self) -> Tuple[float, float]:
+        return tuple(self._net.node_coords[self._index].tolist())
+
+    def getIncoming(self) -> List[NetworkEdge]:
+        edges = self._net.getEdges()
+        return [edges[i] for i in self._net.incoming_edges(self._index)]
+
+    def getOutgoing(self) -> List[NetworkEdge]:
+        edges = self._net.getEdges()
+        return [edges[i] for i in self._net.outgoing_edges(self._index)]
+
+    def getNeighboringNodes(self) -> List["NetworkNode"]:
+        neighbouring = []
+        for node in [edge.getFromNode() for edge in self.getIncoming()] + \
+                    [edge.getToNode() for edge in self.getOutgoing()]:
+            if node not in neighbouring and node is not self:
+                neighbouring.append(node)
+        return neighbouring
+
+
+def read_net(path: str) -> Network:
+    """
+    Read a SUMO network by streaming through the XML file with iterparse, keeping only what the generator uses.
+    The file may be gzip compressed.
+    Elements are cleared as soon as they have been processed, so the XML tree is never held in memory.
+    :param path: path to the .net.xml or .net.xml.gz file
+    :return: the Network
+    """
+    edge_ids, edge_from, edge_to, edge_lengths = [], [], [], []
+    shape_counts, shape_vertices = [], []
+    lane_counts, lane_permissions = [], []
+    node_index, node_coords = {}, []
+    boundary = None
+
+    def node(node_id: str) -> int:
+        if node_id not in node_index:
+            node_index[node_id] = len(node_index)
+            node_coords.append((np.nan, np.nan))
+        return node_index[node_id]
+
+    in_edge = False
+    lane_shapes, first_lane_length = [], None
+    depth = 0
+    root = None
+    with open_input(path) as source:
+        for event, elem in ET.iterparse(source, events=("start", "end")):
+            if event == "start":
+                if root is None:
+                    root = elem
+                depth += 1
+                tag = elem.tag
+                if tag == "edge":
+                    # Only normal edges are used, i.e. no internal edges, crossings, walking areas or connectors
+                    in_edge = elem.get("function", "") == ""
+                    if in_edge:
+                        edge_ids.append(elem.get("id"))
+                        edge_from.append(node(elem.get("from")))
+                        edge_to.append(node(elem.get("to")))
+                        lane_shapes, first_lane_length = [], None
+                elif tag == "lane" and in_edge:
+                    lane_shapes.append(_parse_shape(elem.get("shape", "")))
+                    lane_permissions.append(permission_mask(elem.get("allow"), elem.get("disallow")))
+                    if first_lane_length is None:
+                        first_lane_length = float(elem.get("length"))
+                elif tag == "junction" and elem.get("id")[0] != ":":
+                    node_coords[node(elem.get("id"))] = (float(elem.get("x")), float(elem.get("y")))
+                elif tag == "location":
+                    boundary = tuple(map(float, elem.get("convBoundary").split(",")))
+            else:
+                depth -= 1
+                if elem.tag == "edge" and in_edge:
+                    assert len(lane_shapes) > 0, f"Edge {edge_ids[-1]} has no lanes"
+                    shape = _edge_shape(lane_shapes)
+                    shape_counts.append(len(shape))
+                    shape_vertices.extend(shape)
+                    lane_counts.append(len(lane_shapes))
+                    edge_lengths.append(first_lane_length)
+                    in_edge = False
+                if depth == 1:
+                    # A child of the root has been processed, so everything parsed so far can be freed
+                    root.clear()
+
+    assert boundary is not None, "Network is missing <location>, cannot determine boundary"
+
+    def offsets(counts: List[int]) -> np.ndarray:
+        result = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=result[1:])
+        return result
+
+    net = Network(
+        edge_ids=edge_ids,
+        edge_from=np.array(edge_from, dtype=np.int32),
+        edge_to=np.array(edge_to, dtype=np.int32),
+        edge_lengths=np.array(edge_lengths, dtype=np.float64),
+        shape_offsets=offsets(shape_counts),
+        shape_vertices=np.array(shape_vertices, dtype=np.float64).reshape(-1, 2),
+        lane_offsets=offsets(lane_counts),
+        lane_permissions=np.array(lane_permissions, dtype=np.uint64),
+        node_ids=list(node_index),
+        node_coords=np.array(node_coords, dtype=np.float64).reshape(-1, 2),
+        boundary=np.array(boundary, dtype=np.float64))
+    logging.debug(f"[network] Read {len(edge_ids)} edges and {len(node_index)} nodes from {path}")
+    return net
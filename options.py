@@ -0,0 +1,163 @@
+import os
+from dataclasses import dataclass, field
+from typing import Optional, Tuple, Union
+
+from netcache import default_cache_dir
+
+# Names of the school types, as used in the options and log messages
+SCHOOL_TYPES = ("primary-school", "high-school", "college")
+
+
+def _pair(value: str, option: str) -> Tuple[int, int]:
+    """
+    :param value: two integers given on the command line, e.g. the range "7,10"
+    :param option: the option value was given for, named in the error
+    :return: the two integers
+    :raises ValueError: if value is not two integers separated by a comma
+    """
+    try:
+        first, second = value.split(",")
+        return int(first), int(second)
+    except (AttributeError, ValueError):
+        raise ValueError(f"{option} must be two integers like 7,10, got {value!r}") from None
+
+
+def _non_negative(value: str, option: str) -> int:
+    """
+    :param value: an integer given on the command line
+    :param option: the option value was given for, named in the error
+    :return: the integer
+    :raises ValueError: if value is not an integer >= 0
+    """
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        number = None
+    if number is None or number < 0:
+        raise ValueError(f"{option} must be an integer >= 0, got {value!r}")
+    return number
+
+
+@dataclass
+class NetCacheOptions:
+    """
+    Where and how long network snapshots are cached, see the --net-cache options of randomActivityGen.py
+    """
+    # Directory with network snapshots, or None to always parse the network file
+    cache_dir: Optional[str] = None
+    max_bytes: int = 1 << 30
+    # Maximum time in seconds since a snapshot was last used
+    max_age: float = 30 * 24 * 3600
+
+    @classmethod
+    def from_args(cls, args) -> "NetCacheOptions":
+        """
+        :param args: the arguments of randomActivityGen.py as given by docopt
+        """
+        cache_dir = None
+        if not args["--no-net-cache"]:
+            cache_dir = default_cache_dir() if args["--net-cache.dir"] == "auto" else args["--net-cache.dir"]
+        return cls(cache_dir=cache_dir, max_bytes=int(float(args["--net-cache.max-size"]) * 1024 ** 2),
+                   max_age=float(args["--net-cache.max-age"]) * 24 * 3600)
+
+
+@dataclass
+class SchoolOptions:
+    """
+    Options of the schools of one school type. Ranges are inclusive
+    """
+    # Number of schools, or None to find it from ratio and the number of inhabitants
+    count: Optional[int]
+    # Number of schools per 1000 inhabitants
+    ratio: float
+    begin_age: Tuple[int, int]
+    end_age: Tuple[int, int]
+    capacity: Tuple[int, int]
+
+    @classmethod
+    def from_args(cls, args, school_type: str) -> "SchoolOptions":
+        def pair(option: str) -> Tuple[int, int]:
+            return _pair(args[f"--{school_type}.{option}"], f"--{school_type}.{option}")
+
+        count = args[f"--{school_type}.count"]
+        return cls(count=None if count == "auto" else int(count), ratio=float(args[f"--{school_type}.ratio"]),
+                   begin_age=pair("begin-age"), end_age=pair("end-age"), capacity=pair("capacity"))
+
+
+@dataclass
+class Options:
+    """
+    The options of generating statistics, see the options of randomActivityGen.py of the same names. The defaults are
+    those of the command line
+    """
+    # The coordinates of the city centre, or None for the mean position of all nodes
+    centre_pos: Optional[Tuple[float, float]] = None
+    centre_pop_weight: float = 0.5
+    centre_work_weight: float = 0.1
+    # Number of city gates, or None to find it from the radius of the city
+    gates_count: Optional[int] = None
+    # Opening and closing hours of schools, in hours on a 24h clock
+    schools_stepsize: float = 0.25
+    schools_open: Tuple[int, int] = (7, 10)
+    schools_close: Tuple[int, int] = (13, 17)
+    schools_kmeans_iter: int = 100
+    schools_kmeans_tol: float = 1e-4
+    primary_school: SchoolOptions = field(
+        default_factory=lambda: SchoolOptions(None, 0.2, (6, 14), (12, 16), (100, 500)))
+    high_school: SchoolOptions = field(
+        default_factory=lambda: SchoolOptions(None, 0.04, (15, 18), (18, 23), (500, 1000)))
+    college: SchoolOptions = field(
+        default_factory=lambda: SchoolOptions(None, 0.015, (19, 25), (24, 29), (1000, 2000)))
+    bus_stop: bool = False
+    bus_stop_distance: int = 500
+    bus_stop_k: int = 10
+    bus_stop_sampling: str = "network"
+    # Distance between the points of the noise grids, or None to sample the noise exactly at each street
+    noise_field_resolution: Optional[float] = None
+    # Directory to store and reuse noise grids in, or None to not store them
+    noise_field_dir: Optional[str] = None
+    # Number of processes to sample noise for streets with
+    workers: int = 1
+    # Any seed accepted by random.Random, or None to seed from the system. Note that the string "31415" given on the
+    # command line seeds differently than the integer 31415
+    seed: Union[int, str, None] = "31415"
+    # Number of decimals floats are written with, or None for the shortest representation that reads back exactly
+    precision: Optional[int] = None
+
+    def school(self, school_type: str) -> SchoolOptions:
+        """
+        :param school_type: one of SCHOOL_TYPES
+        """
+        return getattr(self, school_type.replace("-", "_"))
+
+    @classmethod
+    def from_args(cls, args) -> "Options":
+        """
+        :param args: the arguments of randomActivityGen.py as given by docopt
+        """
+        noise_field_dir = None
+        if args["--noise-field"]:
+            noise_field_dir = default_cache_dir("noise-fields") if args["--noise-field.dir"] == "auto" \
+                else args["--noise-field.dir"]
+        return cls(
+            centre_pos=None if args["--centre.pos"] == "auto" else _pair(args["--centre.pos"], "--centre.pos"),
+            centre_pop_weight=float(args["--centre.pop-weight"]),
+            centre_work_weight=float(args["--centre.work-weight"]),
+            gates_count=None if args["--gates.count"] == "auto" else int(args["--gates.count"]),
+            schools_stepsize=float(args["--schools.stepsize"]),
+            schools_open=_pair(args["--schools.open"], "--schools.open"),
+            schools_close=_pair(args["--schools.close"], "--schools.close"),
+            schools_kmeans_iter=int(args["--schools.kmeans-iter"]),
+            schools_kmeans_tol=float(args["--schools.kmeans-tol"]),
+            **{school_type.replace("-", "_"): SchoolOptions.from_args(args, school_type)
+               for school_type in SCHOOL_TYPES},
+            bus_stop=bool(args["--bus-stop"]),
+            bus_stop_distance=int(args["--bus-stop.distance"]),
+            bus_stop_k=int(args["--bus-stop.k"]),
+            bus_stop_sampling=args["--bus-stop.sampling"],
+            noise_field_resolution=float(args["--noise-field.resolution"]) if args["--noise-field"] else None,
+            noise_field_dir=noise_field_dir,
+            workers=(os.cpu_count() or 1) if args["--workers"] == "auto" else int(args["--workers"]),
+            seed=None if args["--random"] else args["--seed"],
+            precision=None if args["--precision"] is None else _non_negative(args["--precision"], "--precision"),
+        )
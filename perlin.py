@@ -1,22 +1,121 @@
+import concurrent.futures
+import hashlib
+import json
 import logging
+import math
 import os
-import sys
-import xml.etree.ElementTree as ET
-from typing import List, Tuple
-from xml.etree import ElementTree
+import shutil
+import threading
+from typing import List, Optional, Set, Tuple
 
-import noise
 import numpy as np
 
-from utility import distance, radius_of_network, smoothstep
+from citystats import Stats
+from geometry import EdgeGeometry
+from netcache import evict
+from utility import distance, smoothstep
 
-if 'SUMO_HOME' in os.environ:
-    tools = os.path.join(os.environ['SUMO_HOME'], 'tools')
-    sys.path.append(tools)
-else:
-    sys.exit("Please declare environment variable 'SUMO_HOME' to use sumolib")
+# Smallest number of positions worth sampling in another process
+PARALLEL_MIN_CHUNK = 4096
 
-import sumolib
+# Ken Perlin's reference permutation, repeated twice to avoid wrapping indices. Same table as the 'noise' lib uses
+_PERM = np.array([
+    151, 160, 137, 91, 90, 15, 131, 13, 201, 95, 96, 53, 194, 233, 7, 225, 140, 36, 103, 30, 69, 142, 8, 99, 37, 240,
+    21, 10, 23, 190, 6, 148, 247, 120, 234, 75, 0, 26, 197, 62, 94, 252, 219, 203, 117, 35, 11, 32, 57, 177, 33, 88,
+    237, 149, 56, 87, 174, 20, 125, 136, 171, 168, 68, 175, 74, 165, 71, 134, 139, 48, 27, 166, 77, 146, 158, 231, 83,
+    111, 229, 122, 60, 211, 133, 230, 220, 105, 92, 41, 55, 46, 245, 40, 244, 102, 143, 54, 65, 25, 63, 161, 1, 216, 80,
+    73, 209, 76, 132, 187, 208, 89, 18, 169, 200, 196, 135, 130, 116, 188, 159, 86, 164, 100, 109, 198, 173, 186, 3, 64,
+    52, 217, 226, 250, 124, 123, 5, 202, 38, 147, 118, 126, 255, 82, 85, 212, 207, 206, 59, 227, 47, 16, 58, 17, 182,
+    189, 28, 42, 223, 183, 170, 213, 119, 248, 152, 2, 44, 154, 163, 70, 221, 153, 101, 155, 167, 43, 172, 9, 129, 22,
+    39, 253, 19, 98, 108, 110, 79, 113, 224, 232, 178, 185, 112, 104, 218, 246, 97, 228, 251, 34, 242, 193, 238, 210,
+    144, 12, 191, 179, 162, 241, 81, 51, 145, 235, 249, 14, 239, 107, 49, 192, 214, 31, 181, 199, 106, 157, 184, 84,
+    204, 176, 115, 121, 50, 45, 127, 4, 150, 254, 138, 236, 205, 93, 222, 114, 67, 29, 24, 72, 243, 141, 128, 195, 78,
+    66, 215, 61, 156, 180] * 2, dtype=np.intp)
+
+# Gradient directions of improved Perlin noise, indexed by the lowest 4 bits of a hash
+_GRAD3 = np.array([
+    [1, 1, 0], [-1, 1, 0], [1, -1, 0], [-1, -1, 0],
+    [1, 0, 1], [-1, 0, 1], [1, 0, -1], [-1, 0, -1],
+    [0, 1, 1], [0, -1, 1], [0, 1, -1], [0, -1, -1],
+    [1, 0, -1], [-1, 0, -1], [0, -1, 1], [0, 1, 1]], dtype=np.float32)
+
+
+def _grad3(hash: np.ndarray, x: np.ndarray, y: np.ndarray, z: np.ndarray) -> np.ndarray:
+    g = _GRAD3[hash & 15]
+    return x * g[:, 0] + y * g[:, 1] + z * g[:, 2]
+
+
+def _lerp(t: np.ndarray, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    return a + t * (b - a)
+
+
+def _fade(t: np.ndarray) -> np.ndarray:
+    return t * t * t * (t * (t * np.float32(6) - np.float32(15)) + np.float32(10))
+
+
+def _noise3(x: np.ndarray, y: np.ndarray, z: np.ndarray, repeat: int) -> np.ndarray:
+    """
+    A single octave of improved Perlin noise for arrays of float32 coordinates. This is a port of noise3 from the
+    'noise' lib (_perlin.c) and mirrors its float32 arithmetic step by step, such that results are identical.
+    """
+    rep = np.float32(repeat)
+    i = np.floor(np.fmod(x, rep)).astype(np.intp)
+    j = np.floor(np.fmod(y, rep)).astype(np.intp)
+    k = np.floor(np.fmod(z, rep)).astype(np.intp)
+    ii = np.fmod(i + 1, repeat) & 255
+    jj = np.fmod(j + 1, repeat) & 255
+    kk = np.fmod(k + 1, repeat) & 255
+    i &= 255
+    j &= 255
+    k &= 255
+
+    x = x - np.floor(x)
+    y = y - np.floor(y)
+    z = z - np.floor(z)
+    fx, fy, fz = _fade(x), _fade(y), _fade(z)
+    one = np.float32(1)
+
+    a = _PERM[i]
+    aa = _PERM[a + j]
+    ab = _PERM[a + jj]
+    b = _PERM[ii]
+    ba = _PERM[b + j]
+    bb = _PERM[b + jj]
+
+    return _lerp(fz, _lerp(fy, _lerp(fx, _grad3(_PERM[aa + k], x, y, z),
+                                         _grad3(_PERM[ba + k], x - one, y, z)),
+                               _lerp(fx, _grad3(_PERM[ab + k], x, y - one, z),
+                                         _grad3(_PERM[bb + k], x - one, y - one, z))),
+                     _lerp(fy, _lerp(fx, _grad3(_PERM[aa + kk], x, y, z - one),
+                                         _grad3(_PERM[ba + kk], x - one, y, z - one)),
+                               _lerp(fx, _grad3(_PERM[ab + kk], x, y - one, z - one),
+                                         _grad3(_PERM[bb + kk], x - one, y - one, z - one))))
+
+
+def pnoise3_many(x: np.ndarray, y: np.ndarray, z: float, octaves: int = 1, persistence: float = 0.5,
+                 lacunarity: float = 2.0, repeat: int = 1024) -> np.ndarray:
+    """
+    Vectorized equivalent of noise.pnoise3 sampling all points (x[i], y[i], z) at once.
+    :param x: array of x coordinates
+    :param y: array of y coordinates
+    :param z: the z coordinate shared by all points, i.e. the offset of the 2d slice
+    :param octaves: the octaves to use when sampling
+    :return: float64 array of noise values in the range [-1:1], equal to what noise.pnoise3 returns for each point
+    """
+    assert octaves > 0, "Expected octaves value > 0"
+    x = np.asarray(x, dtype=np.float64).astype(np.float32)
+    y = np.asarray(y, dtype=np.float64).astype(np.float32)
+    z = np.full_like(x, np.float32(z))
+
+    freq, amp = np.float32(1), np.float32(1)
+    total = np.zeros_like(x)
+    max_amp = np.float32(0)
+    for _ in range(octaves):
+        total += _noise3(x * freq, y * freq, z * freq, int(repeat * freq)) * amp
+        max_amp += amp
+        freq *= np.float32(lacunarity)
+        amp *= np.float32(persistence)
+    return (total / max_amp).astype(np.float64)
 
 
 class NoiseSampler:
@@ -37,65 +136,254 @@ class NoiseSampler:
         :param pos: the position to sample at
         :return: a float in the range [0,1)
         """
+        return float(self.sample_many(np.array([pos], dtype=np.float64))[0])
+
+    def sample_many(self, xy: np.ndarray) -> np.ndarray:
+        """
+        Samples the noise at all the given positions at once
+        :param xy: array of shape (n, 2) with the positions to sample at
+        :return: array of n floats in the range [0,1), equal to calling sample on each position
+        """
+        xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
         scale = 4 / self._radius
-        noise01 = (noise.pnoise3(pos[0] * scale, pos[1] * scale, self._offset, octaves=self._octaves) + 1) / 2
-        gradient = (1 - (distance(pos, self._centre) / self._radius))
+        noise01 = (pnoise3_many(xy[:, 0] * scale, xy[:, 1] * scale, self._offset, octaves=self._octaves) + 1) / 2
+        gradient = (1 - (distance((xy[:, 0], xy[:, 1]), self._centre) / self._radius))
         return (smoothstep(noise01) + gradient * self._centre_weight) / (1 + self._centre_weight)
 
+    @property
+    def parameters(self) -> dict:
+        """
+        :return: the parameters that determine the noise of this sampler
+        """
+        return {"centre": [float(self._centre[0]), float(self._centre[1])], "centre_weight": float(self._centre_weight),
+                "radius": float(self._radius), "offset": float(self._offset), "octaves": int(self._octaves)}
+
 
-def get_edge_pair_centroid(coords: List[Tuple[float, float]]) -> Tuple[float, float]:
+class NoiseField:
     """
-    Centroid of rectangle (edge_pair) = (width/2, height/2)
-    :param coords: [(x_1,y_1), (x_2,y_2), ... , (x_n,y_n)]
-    :return: Centroid of given shape
+    A NoiseSampler evaluated once on a regular grid over an area, typically the boundary of the network. Samples are
+    bilinearly interpolated between the grid points, which is cheaper than exact sampling when the noise is sampled
+    many times, e.g. across runs. Positions outside the grid are sampled exactly.
     """
-    x_avg = np.mean([pos[0] for pos in coords])
-    y_avg = np.mean([pos[1] for pos in coords])
-    return float(x_avg), float(y_avg)
 
+    # Number of grid points sampled at once when evaluating the grid, to limit the memory used
+    _CHUNK = 1 << 18
+
+    def __init__(self, sampler: NoiseSampler, boundary: List[float], resolution: float, grid: np.ndarray = None):
+        """
+        :param sampler: the NoiseSampler to evaluate
+        :param boundary: the area to evaluate it in as [xmin, ymin, xmax, ymax]
+        :param resolution: the distance in meters between grid points
+        :param grid: the already evaluated grid of shape (rows, columns), if any
+        """
+        assert resolution > 0, "Noise field resolution must be positive"
+        self.sampler = sampler
+        self.boundary = [float(v) for v in boundary]
+        self.resolution = float(resolution)
+        self._columns = int(math.ceil((self.boundary[2] - self.boundary[0]) / self.resolution)) + 1
+        self._rows = int(math.ceil((self.boundary[3] - self.boundary[1]) / self.resolution)) + 1
+
+        if grid is None:
+            xs = self.boundary[0] + np.arange(self._columns) * self.resolution
+            ys = self.boundary[1] + np.arange(self._rows) * self.resolution
+            points = np.stack(np.meshgrid(xs, ys), axis=-1).reshape(-1, 2)
+            grid = np.empty(len(points), dtype=np.float32)
+            for start in range(0, len(points), self._CHUNK):
+                grid[start:start + self._CHUNK] = sampler.sample_many(points[start:start + self._CHUNK])
+            grid = grid.reshape(self._rows, self._columns)
+        assert grid.shape == (self._rows, self._columns), "Noise field grid does not match its boundary"
+        self.grid = grid
+
+    @property
+    def key(self) -> str:
+        """
+        :return: hex digest identifying the sampler parameters, boundary and resolution of this field
+        """
+        return noise_field_key(self.sampler, self.boundary, self.resolution)
+
+    @classmethod
+    def load(cls, sampler: NoiseSampler, boundary: List[float], resolution: float, cache_dir: Optional[str] = None,
+             max_bytes: int = 1 << 30, max_age: float = 30 * 24 * 3600) -> "NoiseField":
+        """
+        Create the NoiseField of sampler, reusing the grid stored in cache_dir by an earlier run with the same
+        parameters. New grids are stored in cache_dir.
+        :param cache_dir: directory with stored grids, or None to always evaluate the grid
+        :param max_bytes: maximum total size of the grids in cache_dir
+        :param max_age: maximum time in seconds since a grid was last used before it is removed
+        :return: the NoiseField
+        """
+        if cache_dir is None:
+            return cls(sampler, boundary, resolution)
+
+        directory = os.path.join(cache_dir, noise_field_key(sampler, boundary, resolution))
+        if os.path.isdir(directory):
+            try:
+                field = cls(sampler, boundary, resolution, grid=np.load(os.path.join(directory, "grid.npy"),
+                                                                        mmap_mode="r"))
+                # Mark the grid as recently used
+                os.utime(directory)
+                logging.debug(f"[perlin] Using noise field {directory}")
+                return field
+            except (OSError, ValueError, AssertionError) as e:
+                logging.warning(f"[perlin] Discarding unusable noise field {directory}: {e}")
+                shutil.rmtree(directory, ignore_errors=True)
 
-def get_perlin_noise(x: float, y: float, offset: float, scale: float, octaves: int) -> float:
+        field = cls(sampler, boundary, resolution)
+        # The grid is written to a temporary directory first, such that readers never see a partial grid
+        tmp = f"{directory}.tmp-{os.getpid()}-{threading.get_ident()}"
+        try:
+            os.makedirs(tmp)
+            np.save(os.path.join(tmp, "grid.npy"), field.grid)
+            os.rename(tmp, directory)
+            logging.debug(f"[perlin] Wrote noise field {directory}")
+            evict(cache_dir, max_bytes, max_age, keep=directory)
+        except OSError as e:
+            logging.warning(f"[perlin] Could not write noise field to {cache_dir}: {e}")
+        finally:
+            # If another process wrote the same grid first, ours is discarded
+            shutil.rmtree(tmp, ignore_errors=True)
+        return field
+
+    def sample(self, pos: Tuple[float, float]) -> float:
+        """
+        Samples the noise at the given position
+        :param pos: the position to sample at
+        :return: a float in the range [0,1)
+        """
+        return float(self.sample_many(np.array([pos], dtype=np.float64))[0])
+
+    def sample_many(self, xy: np.ndarray) -> np.ndarray:
+        """
+        Samples the noise at all the given positions at once by bilinear interpolation in the grid
+        :param xy: array of shape (n, 2) with the positions to sample at
+        :return: array of n floats in the range [0,1)
+        """
+        xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+        gx = (xy[:, 0] - self.boundary[0]) / self.resolution
+        gy = (xy[:, 1] - self.boundary[1]) / self.resolution
+        inside = (gx >= 0) & (gx <= self._columns - 1) & (gy >= 0) & (gy <= self._rows - 1)
+
+        # Lower left grid point of the cell of each position, and the position within the cell
+        i = np.clip(np.floor(gx), 0, max(self._columns - 2, 0)).astype(np.intp)
+        j = np.clip(np.floor(gy), 0, max(self._rows - 2, 0)).astype(np.intp)
+        i1, j1 = np.minimum(i + 1, self._columns - 1), np.minimum(j + 1, self._rows - 1)
+        tx, ty = np.clip(gx - i, 0, 1), np.clip(gy - j, 0, 1)
+
+        grid = self.grid
+        bottom = grid[j, i] * (1 - tx) + grid[j, i1] * tx
+        top = grid[j1, i] * (1 - tx) + grid[j1, i1] * tx
+        values = bottom * (1 - ty) + top * ty
+
+        if not np.all(inside):
+            values[~inside] = self.sampler.sample_many(xy[~inside])
+        return values
+
+    def max_error(self, xy: np.ndarray, max_points: int = 10_000) -> float:
+        """
+        :param xy: array of shape (n, 2) with positions to compare interpolated and exact sampling at. At most
+            max_points evenly spread positions are used
+        :return: the largest absolute difference between sample_many and exact sampling at the positions
+        """
+        xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+        if len(xy) == 0:
+            return 0.0
+        xy = xy[np.linspace(0, len(xy) - 1, min(len(xy), max_points)).astype(np.intp)]
+        return float(np.max(np.abs(self.sample_many(xy) - self.sampler.sample_many(xy))))
+
+
+def noise_field_key(sampler: NoiseSampler, boundary: List[float], resolution: float) -> str:
     """
-    The 'noise' lib returns a value in the range of [-1:1]. The noise value is scaled to the range of [0:1].
-    :param x: the sample point for x
-    :param y: the sample point for y
-    :param offset: the offset for the 2d slice
-    :param scale: the scale to multiply to each coordinate, default is 0.005
-    :param octaves: the octaves to use when sampling, default is 3
-    :return: a normalised float of the sample in noisemap
+    :return: hex digest identifying a NoiseField by its sampler parameters, boundary and resolution
     """
-    return (noise.pnoise3(x=x * scale, y=y * scale, z=offset, octaves=octaves) + 1) / 2
+    params = dict(sampler.parameters, boundary=[float(v) for v in boundary], resolution=float(resolution))
+    return hashlib.blake2b(json.dumps(params, sort_keys=True).encode("utf-8"), digest_size=20).hexdigest()
 
 
-def setup_streets(net: sumolib.net.Net, xml: ElementTree, pop_noise: NoiseSampler, work_noise: NoiseSampler):
+def _sample_chunk(sampler: NoiseSampler, xy: np.ndarray) -> np.ndarray:
+    return sampler.sample_many(xy)
+
+
+def sample_many_parallel(samplers: List[NoiseSampler], xy: np.ndarray, workers: int = 1) -> List[np.ndarray]:
+    """
+    Samples each of the samplers at all the given positions, splitting the positions into chunks that are sampled by
+    a pool of worker processes. Only the samplers and the coordinates of each chunk are sent to the workers.
+    Sampling is done point by point, so the results are identical to calling sample_many on each sampler.
+    :param samplers: the NoiseSamplers to sample
+    :param xy: array of shape (n, 2) with the positions to sample at
+    :param workers: number of worker processes, 1 samples in this process
+    :return: an array of n samples for each sampler
+    """
+    xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+    # A few chunks per worker evens out the load, but tiny chunks are not worth sending to another process
+    chunk_count = min(4 * workers, len(xy) // PARALLEL_MIN_CHUNK)
+    if workers <= 1 or chunk_count <= 1:
+        return [sampler.sample_many(xy) for sampler in samplers]
+
+    chunks = np.array_split(xy, chunk_count)
+    logging.debug(f"[perlin] Sampling {len(samplers)} noise layers in {chunk_count} chunks using {workers} workers")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [[executor.submit(_sample_chunk, sampler, chunk) for chunk in chunks]
+                   if isinstance(sampler, NoiseSampler) else None for sampler in samplers]
+        # Interpolating a NoiseField is cheap compared to sending its grid to the workers, so it is done here
+        return [np.concatenate([future.result() for future in sampler_futures])
+                if sampler_futures is not None else sampler.sample_many(xy)
+                for sampler, sampler_futures in zip(samplers, futures)]
+
+
+def setup_streets(geometry: EdgeGeometry, xml: Stats, pop_noise: NoiseSampler, work_noise: NoiseSampler,
+                  workers: int = 1) -> Tuple[np.ndarray, np.ndarray]:
     """
     Create a street for each edge in the network and calculate its population and workplaces based on
     modified Perlin noise from NoiseSamplers
-    :param net: the SUMO network
-    :param xml: the statistics XML for the network
+    :param geometry: the edge geometry of the SUMO network
+    :param xml: the statistics for the network
     :param pop_noise: NoiseSampler to use for population
     :param work_noise: NoiseSample to use for workplaces
+    :param workers: number of worker processes to sample the noise with
+    :return: the population and workplace noise of every edge in the network, indexed like geometry
     """
 
-    streets = xml.find("streets")
-    if streets is None:
-        streets = ET.SubElement(xml.getroot(), "streets")
+    streets = xml.table("streets", create=True)
 
     # Some edges might already have a street, so we want to ignore those
-    known_streets = {street.attrib["edge"]: street for street in streets.findall("street")}
-
-    for edge in net.getEdges():
-        eid = edge.getID()
-        if eid not in known_streets:
-            # This edge is missing a street entry. Find population and industry for this edge
-            pos = get_edge_pair_centroid(edge.getShape())
-            population = pop_noise.sample(pos)
-            industry = work_noise.sample(pos)
-
-            logging.debug(
-                f"[perlin] Adding street with eid: {eid},\t population: {population:.4f}, industry: {industry:.4f}")
-            ET.SubElement(streets, "street", {
-                "edge": eid,
-                "population": str(population),
-                "workPosition": str(industry)
-            })
+    known_streets = set(streets["edge"].tolist())
+
+    # Sample population and industry for the whole network in one pass
+    populations, industries = sample_many_parallel([pop_noise, work_noise], geometry.centroids, workers)
+
+    missing = np.fromiter((eid not in known_streets for eid in geometry.ids), dtype=bool, count=len(geometry))
+    logging.debug(f"[perlin] Adding {np.count_nonzero(missing)} streets")
+    streets.append(edge=[eid for eid, new in zip(geometry.ids, missing.tolist()) if new],
+                   population=populations[missing], workPosition=industries[missing])
+
+    return populations, industries
+
+
+def update_streets(geometry: EdgeGeometry, xml: Stats, pop_noise: NoiseSampler, work_noise: NoiseSampler,
+                   stale: Set[str], workers: int = 1) -> np.ndarray:
+    """
+    Update the streets of statistics generated for an earlier version of the network. The streets of changed and
+    removed edges are dropped, and only edges without a street are sampled, i.e. added and changed edges
+    :param stale: the ids of the edges that were changed or removed since the statistics were generated
+    :return: the population of every edge in the network, indexed like geometry. Edges that kept their street use
+        the population of the street
+    """
+    streets = xml.table("streets", create=True)
+    streets.remove(streets.edge_in(stale))
+
+    populations = np.full(len(geometry), np.nan)
+    edges = geometry.indices_of(streets["edge"].tolist())
+    populations[edges[edges >= 0]] = streets["population"][edges >= 0]
+
+    missing = np.flatnonzero(np.isnan(populations))
+    logging.debug(f"[perlin] Sampling {len(missing)} new streets")
+    new_populations, new_industries = sample_many_parallel([pop_noise, work_noise], geometry.centroids[missing],
+                                                           workers)
+    populations[missing] = new_populations
+
+    # A new street is inserted after the last street of an edge before it in the network, so the streets the tool
+    # generated stay in the order of the network, as in a run that is not incremental
+    last_before = np.minimum.accumulate(edges[::-1])[::-1]
+    streets.insert(np.searchsorted(last_before, missing), edge=[geometry.ids[edge] for edge in missing.tolist()],
+                   population=new_populations, workPosition=new_industries)
+    return populations
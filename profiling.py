@@ -0,0 +1,84 @@
+import cProfile
+import io
+import json
+import logging
+import os
+import platform
+import pstats
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import List
+
+# Number of functions listed in the log when profiling with cProfile
+CPROFILE_TOP = 25
+
+
+class StageProfiler:
+    """
+    Records the wall time, CPU time, and optionally the peak memory allocated through Python, of each stage of a run.
+    Memory is traced with tracemalloc, which makes allocations slower, so it is only traced when asked for.
+    CPU time is that of the current process, so time spent in worker processes is not included.
+    """
+
+    def __init__(self, trace_memory: bool = False):
+        self.stages: List[dict] = []
+        self.trace_memory = trace_memory
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Measure the code run in the with-block as the stage with the given name
+        """
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            record = {"stage": name, "wall": time.perf_counter() - wall, "cpu": time.process_time() - cpu}
+            if self.trace_memory:
+                record["peak_memory"] = tracemalloc.get_traced_memory()[1]
+            self.stages.append(record)
+            logging.debug(f"[profile] Stage {name} took {record['wall']:.3f} s wall, {record['cpu']:.3f} s CPU")
+
+
+def write_report(path: str, stages: List[dict], args):
+    """
+    Write the stages recorded by StageProfilers to path as JSON, together with a description of the run
+    :param stages: the records of all stages of the run, in the order they were run
+    """
+    report = {
+        "net-file": args["--net-file"],
+        "stat-file": args["--stat-file"],
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "stages": stages,
+        "total": {"wall": sum(record["wall"] for record in stages),
+                  "cpu": sum(record["cpu"] for record in stages)},
+    }
+    if all("peak_memory" in record for record in stages):
+        report["total"]["peak_memory"] = max((record["peak_memory"] for record in stages), default=0)
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    logging.info(f"[profile] Wrote profile report of {len(stages)} stages to {path}")
+
+
+@contextmanager
+def cprofiled(stats_file: str):
+    """
+    Profile the code run in the with-block with cProfile. The statistics are dumped to stats_file, which can be read
+    with pstats or e.g. snakeviz, and the functions with the most cumulative time are logged
+    """
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        profile.dump_stats(stats_file)
+        listing = io.StringIO()
+        pstats.Stats(profile, stream=listing).sort_stats("cumulative").print_stats(CPROFILE_TOP)
+        logging.info(f"[profile] Wrote cProfile statistics to {stats_file}, hottest functions:\n{listing.getvalue()}")
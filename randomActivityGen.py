@@ -1,20 +1,32 @@
 """Usage:
-    randomActivityGen.py --net-file=FILE --stat-file=FILE --output-file=FILE [--centre.pos=args]
-    [--centre.pop-weight=F] [--centre.work-weight=F] [--gates.count=N] [--schools.stepsize=F] [--schools.open=args]
-    [--schools.close=args]  [--primary-school.begin-age=args] [--primary-school.end-age=args] [--primary-school.count=N]
-    [--primary-school.ratio=F] [--primary-school.capacity=args] [--high-school.begin-age=args]
-    [--high-school.end-age=args] [--high-school.count=N] [--high-school.ratio=F] [--high-school.capacity=args]
-    [--college.begin-age=args] [--college.end-age=args] [--college.count=N] [--college.ratio=F]
-    [--college.capacity=args] [--bus-stop] [--bus-stop.distance=N] [--bus-stop.k=N] [--display] [--display.size=N]
-    [--seed=S | --random] ([--quiet] | [--verbose] | [--log-level=LEVEL]) [--log-file=FILENAME]
-    randomActivityGen.py --net-file=FILE --stat-file=FILE [--output-file=FILE] --display-only
+    randomActivityGen.py --net-file=FILE --stat-file=FILE (--output-file=FILE | --batch=FILE [--batch.summary=FILE]
+    [--batch.workers=N]) [--centre.pos=args] [--centre.pop-weight=F] [--centre.work-weight=F] [--gates.count=N]
+    [--schools.stepsize=F] [--schools.open=args] [--schools.close=args] [--schools.kmeans-iter=N]
+    [--schools.kmeans-tol=F] [--primary-school.begin-age=args] [--primary-school.end-age=args]
+    [--primary-school.count=N] [--primary-school.ratio=F] [--primary-school.capacity=args]
+    [--high-school.begin-age=args] [--high-school.end-age=args] [--high-school.count=N] [--high-school.ratio=F]
+    [--high-school.capacity=args] [--college.begin-age=args] [--college.end-age=args] [--college.count=N]
+    [--college.ratio=F] [--college.capacity=args] [--bus-stop] [--bus-stop.distance=N] [--bus-stop.k=N]
+    [--bus-stop.sampling=MODE] [--display] [--display.size=N] [--display.output=FILE] [--display.heatmap]
+    [--seed=S | --random] ([--quiet] | [--verbose] | [--log-level=LEVEL]) [--log-file=FILENAME] [--no-net-cache]
+    [--net-cache.dir=DIR] [--net-cache.max-size=MB] [--net-cache.max-age=DAYS] [--noise-field]
+    [--noise-field.resolution=M] [--noise-field.dir=DIR] [--workers=N] [--profile-report=FILE] [--profile=MODE]
+    [--profile.stats=FILE] [--incremental] [--incremental.manifest=FILE] [--precision=N]
+    randomActivityGen.py --net-file=FILE --stat-file=FILE [--output-file=FILE] --display-only [--display.size=N]
+    [--display.output=FILE] [--display.heatmap] [--centre.pos=args] [--centre.pop-weight=F] [--centre.work-weight=F]
+    [--seed=S] [--noise-field] [--noise-field.resolution=M] [--noise-field.dir=DIR] [--no-net-cache]
+    [--net-cache.dir=DIR] [--profile-report=FILE] [--profile=MODE] [--profile.stats=FILE]
+    randomActivityGen.py --serve=ADDRESS --serve.networks=DIR [--serve.cache-size=MB] [--no-net-cache]
+    [--net-cache.dir=DIR] [--net-cache.max-size=MB] [--net-cache.max-age=DAYS] [--noise-field.dir=DIR]
+    ([--quiet] | [--verbose] | [--log-level=LEVEL]) [--log-file=FILENAME]
 
 Input Options:
-    -n, --net-file FILE         Input road network file to create activity for
-    -s, --stat-file FILE        Input statistics file to modify
+    -n, --net-file FILE         Input road network file to create activity for, which may be gzip compressed
+    -s, --stat-file FILE        Input statistics file to modify, which may be gzip compressed
 
 Output Options:
-    -o, --output-file FILE      Write modified statistics to FILE
+    -o, --output-file FILE      Write modified statistics to FILE, gzip compressed if FILE ends in .gz, or to standard output if FILE is -
+    --precision=N               Write floats with N decimals instead of the shortest representation that reads back exactly.
 
 Other Options:
     --centre.pos=args           The coordinates for the city's centre, e.g. "300,500" or "auto". [default: auto]
@@ -24,6 +36,8 @@ Other Options:
     --schools.stepsize=F        Step size in opening/closing hours, in parts of an hour, e.g 0.25 is every 15 mins. [default: 0.25]
     --schools.open=args         The interval at which the schools opens (24h clock). [default: 7,10]
     --schools.close=args        The interval at which the schools closes (24h clock). [default: 13,17]
+    --schools.kmeans-iter=N     Maximum number of k-means iterations when dividing the city into school districts. [default: 100]
+    --schools.kmeans-tol=F      Stop k-means when the districts move less than F relative to the size of the city. On networks with more than 100000 edges, mini-batch k-means is used first and stops when the mean squared distance of edges to their district improves by less than a fraction F. [default: 1e-4]
     --primary-school.count=N           Number of schools in the city, if not used, number of schools is based on population. [default: auto]
     --primary-school.ratio=F           Number of schools per 1000 inhabitants. [default: 0.2]
     --primary-school.begin-age=args    The range of ages at which students start going to school. [default: 6,14]
@@ -42,107 +56,283 @@ Other Options:
     --bus-stop                  Do experimental bus-stop generation
     --bus-stop.distance=N       Minimum distance between bus stops. [default: 500]
     --bus-stop.k=N              Placement attempts in the poisson-disc algorithm. [default: 10]
+    --bus-stop.sampling=MODE    Draw placement attempts from the whole network, or only from roads near the previous stop {network, annulus}. [default: network]
     --display                   Display an image of city elements and the noise used to generate them when done.
     --display.size=N            Set max width and height of image to display to N. [default: 800]
+    --display.output=FILE       Save the image to FILE, e.g. a .png, instead of opening it in an image viewer. Implies --display.
+    --display.heatmap           Draw the population and work noise under the streets. With --display-only the noise is found from --seed.
     --display-only              Display an image of city elements from existing statistics file. If given uses --stat-file for input.
     --verbose                   Set log-level to DEBUG
     --quiet                     Set log-level to ERROR
     --log-level=LEVEL           Set log-level {DEBUG, INFO, WARN, ERROR, CRITICAL}. [default: INFO]
     --log-file=FILENAME         Set log filename. [default: randomActivityGen-log.txt]
+    --no-net-cache              Always parse the network file instead of using or writing cached network snapshots.
+    --net-cache.dir=DIR         Directory for cached network snapshots, "auto" is ~/.cache/randomActivityGen/networks. [default: auto]
+    --net-cache.max-size=MB     Maximum total size of cached network snapshots in megabytes. [default: 1024]
+    --net-cache.max-age=DAYS    Remove cached network snapshots not used for this many days. [default: 30]
+    --noise-field               Interpolate noise from grids that are evaluated once and stored, instead of sampling it exactly at each street.
+    --noise-field.resolution=M  Distance in meters between the points of the noise grids. [default: 10]
+    --noise-field.dir=DIR       Directory for stored noise grids, "auto" is ~/.cache/randomActivityGen/noise-fields. [default: auto]
+    --workers=N                 Number of processes to sample noise for streets with, "auto" is one per CPU. [default: 1]
+    --batch=FILE                Generate statistics for each job in FILE, a JSON list of options for each job, e.g. [{"seed": 2, "output-file": "out/2.stat.xml"}]. The network is loaded once for all jobs.
+    --batch.summary=FILE        Write the time spent in each stage of each batch job to FILE as CSV, "auto" is the batch file with .summary.csv appended. [default: auto]
+    --batch.workers=N           Number of processes to run batch jobs in, "auto" is one per CPU. The processes share the memory of the network. [default: 1]
+    --incremental               Update the output file of an earlier run with the same options where the network has changed since, instead of generating all statistics again. Cannot be used with --random.
+    --incremental.manifest=FILE  Fingerprints of the edges of the last run, used to find changes, "auto" is the output file with .manifest.json appended. [default: auto]
+    --serve=ADDRESS             Serve generation requests over HTTP on ADDRESS, e.g. localhost:8080, keeping the networks in memory between requests. See service.py for the requests.
+    --serve.networks=DIR        Directory with the networks the service generates statistics for, the network NAME is the file NAME.net.xml or NAME.net.xml.gz.
+    --serve.cache-size=MB       Maximum total size in megabytes of the networks the service keeps in memory. [default: 1024]
+    --profile-report=FILE       Write the wall time, CPU time, and peak memory allocated through Python of each stage to FILE as JSON. Tracing memory makes the run slower.
+    --profile=MODE              Also profile the functions of the run {none, cprofile}. With cprofile the hottest functions are logged. Batch worker processes are not profiled. [default: none]
+    --profile.stats=FILE        Write the cProfile statistics of --profile=cprofile to FILE, which can be read with pstats. [default: randomActivityGen.pstats]
     --seed S                    Initialises the random number generator with the given value S. [default: 31415]
     --random                    Initialises the random number generator with the current system time. [default: false]
     -h, --help                  Show this screen.
     --version                   Show version.
 """
 
+import concurrent.futures
+import csv
+import json
 import logging
 import os
-import random
 import sys
-import xml.etree.ElementTree as ET
+import tempfile
+from contextlib import nullcontext
+from typing import Iterable, List, Optional, Tuple
 
 from docopt import docopt
 
-from bus import setup_bus_stops
-from gates import setup_city_gates
-from perlin import setup_streets, NoiseSampler
-from render import display_network
-from school import setup_schools
-from utility import find_city_centre, verify_stats, setup_logging, radius_of_network
+from citystats import Stats
+from generator import create_noise, create_rng, find_centre, populate
+from geometry import EdgeGeometry
+from incremental import edge_fingerprints, find_changes, read_manifest, write_manifest
+from netcache import attach_network, load_network, publish_network
+from network import Network
+from options import NetCacheOptions, Options
+from profiling import StageProfiler, cprofiled, write_report
+from streams import STDOUT
+from utility import verify_stats, setup_logging
+# The render module is imported by the stages using it, so runs without an image do not pay for importing PIL
 
-if 'SUMO_HOME' in os.environ:
-    tools = os.path.join(os.environ['SUMO_HOME'], 'tools')
-    sys.path.append(tools)
-else:
-    sys.exit("Please declare environment variable 'SUMO_HOME' to use sumolib")
 
-import sumolib
+# Options that cannot differ between the jobs of a batch, as they are used to load the network
+BATCH_SHARED_OPTIONS = {"--net-file", "--no-net-cache", "--net-cache.dir", "--net-cache.max-size",
+                        "--net-cache.max-age", "--batch", "--batch.summary", "--batch.workers",
+                        "--display-only", "--log-level", "--quiet",
+                        "--verbose", "--log-file", "--profile-report", "--profile", "--profile.stats"}
 
+# Stages of generate_file, in the order they are run
+GENERATE_STAGES = ("changes", "stats_parse", "centre_radius", "streets", "gates", "schools", "bus_stops", "write",
+                   "manifest", "render")
 
-def main():
-    args = docopt(__doc__, version="RandomActivityGen v0.1")
 
-    setup_logging(args)
+def generate_file(args, net: Network, geometry: EdgeGeometry, profiler: Optional[StageProfiler] = None) -> List[dict]:
+    """
+    Generate the statistics file requested by args for an already loaded network, see generator.generate.
+    The statistics file is parsed anew, so runs do not share any state except for the network
+    :param profiler: the profiler to record the stages in, by default a new one, which traces memory if
+        --profile-report is given
+    :return: the records of the stages of this run, see StageProfiler
+    """
+    if profiler is None:
+        profiler = StageProfiler(trace_memory=bool(args["--profile-report"]))
+    first_stage = len(profiler.stages)
+    options = Options.from_args(args)
 
-    # Parse random and seed arguments
-    if not args["--random"]:
-        random.seed(args["--seed"])
-    pop_offset = 65_536 * random.random()
-    work_offset = 65_536 * random.random()
-    while pop_offset == work_offset:
-        work_offset = 65_536 * random.random()
-    logging.debug(f"[main] Using pop_offset: {pop_offset}, work_offset: {work_offset}")
-
-    # Read SUMO network
-    logging.debug(f"[main] Reading network from: {args['--net-file']}")
-    net = sumolib.net.readNet(args["--net-file"])
+    # In incremental mode, the output of the last run is updated where the network changed since then
+    changes = None
+    if args["--incremental"]:
+        assert not args["--random"], "--incremental cannot be used with --random, as the noise must stay the same"
+        assert args["--output-file"] != STDOUT, "--incremental cannot write to standard output, as it reads its output"
+        with profiler.stage("changes"):
+            fingerprints = edge_fingerprints(net)
+            manifest = read_manifest(args)
+            if manifest is not None:
+                changes = find_changes(manifest, geometry, fingerprints)
 
     # Parse statistics configuration
-    logging.debug(f"[main] Parsing stat file: {args['--stat-file']}")
-    stats = ET.parse(args["--stat-file"])
-    verify_stats(stats)
+    with profiler.stage("stats_parse"):
+        stat_file = args["--output-file"] if changes is not None else args["--stat-file"]
+        logging.debug(f"[main] Parsing stat file: {stat_file}")
+        stats = Stats.read(stat_file)
+        verify_stats(stats)
+
+    centre, radius, noise = populate(net, geometry, stats, options, create_rng(options), profiler, changes)
+
+    # Write statistics back
+    with profiler.stage("write"):
+        logging.debug(f"[main] Writing statistics file to {args['--output-file']}")
+        stats.write(args["--output-file"], options.precision)
+
+    if args["--incremental"]:
+        with profiler.stage("manifest"):
+            write_manifest(args, geometry, fingerprints, centre, radius, stats, options.precision)
+
+    if args["--display"] or args["--display.output"]:
+        with profiler.stage("render"):
+            from render import display_network
+            max_display_size = int(args["--display.size"])
+            logging.debug(f"[main] Displaying network as image of max size {max_display_size}x{max_display_size}")
+            display_network(net, geometry, stats, max_display_size, centre, args["--net-file"],
+                            args["--display.output"], noise if args["--display.heatmap"] else None)
+
+    return profiler.stages[first_stage:]
+
+
+def batch_jobs(args) -> List[dict]:
+    """
+    Read the jobs of the batch file given by --batch. Each job is an object of options, with or without the leading
+    dashes, that override the options given on the command line, e.g. {"seed": 2, "output-file": "out/2.stat.xml"}
+    :return: the arguments of each job
+    """
+    with open(args["--batch"]) as f:
+        jobs = json.load(f)
+    assert isinstance(jobs, list), "Batch file must contain a JSON list of jobs"
+
+    jobs_args = []
+    for i, job in enumerate(jobs):
+        assert isinstance(job, dict), f"Batch job {i} is not an object of options"
+        job_args = dict(args)
+        for key, value in job.items():
+            option = key if key.startswith("--") else f"--{key}"
+            assert option in args, f"Batch job {i} has unknown option {key}"
+            assert option not in BATCH_SHARED_OPTIONS, f"Batch job {i} cannot change {option}, it is shared by all jobs"
+            # Flags are booleans, other options are strings as given by docopt
+            job_args[option] = value if isinstance(value, bool) or value is None else str(value)
+        assert job_args["--output-file"], f"Batch job {i} has no output file"
+        assert job_args["--output-file"] != STDOUT, f"Batch job {i} cannot write to standard output"
+        jobs_args.append(job_args)
+    return jobs_args
+
+
+# The network and geometry of a batch worker process, attached when the process starts
+_worker_network = None
+
+
+def _init_batch_worker(directory: str, log_level: int):
+    global _worker_network
+    # Worker processes that are not forked do not inherit the logging setup
+    logging.basicConfig(level=log_level, format="%(levelname)-8s %(message)s")
+    _worker_network = attach_network(directory)
 
-    max_display_size = int(args["--display.size"])
 
-    centre = find_city_centre(net) if args["--centre.pos"] == "auto" else tuple(map(int, args["--centre.pos"].split(",")))
-    radius = radius_of_network(net, centre)
+def _run_batch_job(job_args: dict) -> List[dict]:
+    net, geometry = _worker_network
+    return generate_file(job_args, net, geometry)
+
+
+def run_batch(args, net: Network, geometry: EdgeGeometry) -> List[dict]:
+    """
+    Generate the statistics of every job in the batch file on the same network. Each job has its own random number
+    generator, so a job gives the same statistics as when run on its own with the same options.
+    With more than one worker, the network is published as memory-mapped files that the worker processes attach to,
+    such that they share its memory instead of each reading a copy.
+    The time spent in each stage of each job is written to the summary file.
+    :return: the records of the stages of all jobs, see StageProfiler, with the index of their job added
+    """
+    jobs = batch_jobs(args)
+    summary_file = f"{args['--batch']}.summary.csv" if args["--batch.summary"] == "auto" else args["--batch.summary"]
+    workers = (os.cpu_count() or 1) if args["--batch.workers"] == "auto" else int(args["--batch.workers"])
+    workers = max(1, min(workers, len(jobs)))
+    logging.info(f"[batch] Running {len(jobs)} jobs using {workers} worker(s)")
+
+    if workers == 1:
+        results = (generate_file(job_args, net, geometry) for job_args in jobs)
+        summary, stages = _summarise_batch(jobs, results)
+    else:
+        with tempfile.TemporaryDirectory(prefix="randomActivityGen-") as tmp:
+            directory = os.path.join(tmp, "network")
+            publish_network(net, geometry, directory)
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_batch_worker,
+                                                        initargs=(directory, logging.getLogger().level)) as executor:
+                summary, stages = _summarise_batch(jobs, executor.map(_run_batch_job, jobs))
+
+    with open(summary_file, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=["job", "seed", "output-file", *GENERATE_STAGES, "total"])
+        writer.writeheader()
+        writer.writerows(summary)
+    logging.info(f"[batch] Wrote summary of {len(jobs)} jobs to {summary_file}")
+    return stages
+
+
+def _summarise_batch(jobs: List[dict], results: Iterable[List[dict]]) -> Tuple[List[dict], List[dict]]:
+    """
+    Collect the stages of each job as they finish, in job order
+    :return: a row of the summary for each job, and the records of the stages of all jobs
+    """
+    summary = []
+    stages = []
+    for i, (job_args, records) in enumerate(zip(jobs, results)):
+        stages.extend({"job": i, **record} for record in records)
+        timings = {record["stage"]: record["wall"] for record in records}
+        timings["total"] = sum(timings.values())
+        logging.info(f"[batch] Job {i} wrote {job_args['--output-file']} in {timings['total']:.2f} s")
+        summary.append({"job": i, "seed": "random" if job_args["--random"] else job_args["--seed"],
+                        "output-file": job_args["--output-file"], **{k: f"{v:.4f}" for k, v in timings.items()}})
+    return summary, stages
+
+
+def run(args):
+    """
+    Load the network and do what args asks for, i.e. render an existing statistics file, run a batch, or generate
+    a single statistics file. The stages are profiled, and written to --profile-report if given
+    """
+    profiler = StageProfiler(trace_memory=bool(args["--profile-report"]))
+    with profiler.stage("net_load"):
+        cache = NetCacheOptions.from_args(args)
+        net, geometry = load_network(args["--net-file"], cache.cache_dir, cache.max_bytes, cache.max_age)
 
-    # If display-only, load stat-file as input and exit after rendering
     if args["--display-only"]:
-        # Try the output file first, as, if given, it contains a computed statistics file, otherwise try the input
-        stats = ET.parse(args["--output-file"] or args["--stat-file"])
-        logging.debug(f"[main] Displaying network as image of max size {max_display_size}x{max_display_size}")
-        display_network(net, stats, max_display_size, centre, args["--net-file"])
-        exit(0)
-
-    # Prepare noise sampling
-    pop_noise = NoiseSampler(centre, float(args['--centre.pop-weight']), radius, pop_offset)
-    work_noise = NoiseSampler(centre, float(args['--centre.work-weight']), radius, work_offset)
-
-    logging.debug(f"[main] Using centre: {centre}, "
-                  f"radius: {radius}, "
-                  f"centre.pop-weight: {float(args['--centre.pop-weight'])}, "
-                  f"centre.work-weight: {float(args['--centre.work-weight'])}")
-
-    # Insert streets, gates, and schools
-    logging.info("[main] Setting up streets with population and workplaces")
-    setup_streets(net, stats, pop_noise, work_noise)
-    logging.debug(f"[main] Setting up city gates")
-    setup_city_gates(net, stats, args["--gates.count"], radius)
-    logging.info("[main] Setting up schools")
-    setup_schools(args, net, stats, pop_noise)
-
-    if args["--bus-stop"]:
-        logging.debug(f"[main] Setting up bus-stops")
-        setup_bus_stops(net, stats, int(args["--bus-stop.distance"]), int(args["--bus-stop.k"]))
+        # Load stat-file as input and render it. Try the output file first, as, if given, it contains a computed
+        # statistics file, otherwise try the input
+        with profiler.stage("stats_parse"):
+            output_file = args["--output-file"] if args["--output-file"] != STDOUT else None
+            stats = Stats.read(output_file or args["--stat-file"])
+        options = Options.from_args(args)
+        with profiler.stage("centre_radius"):
+            centre = find_centre(net, options)
+        with profiler.stage("render"):
+            from render import display_network
+            max_display_size = int(args["--display.size"])
+            logging.debug(f"[main] Displaying network as image of max size {max_display_size}x{max_display_size}")
+            # The noise is found from --seed like when the statistics were generated
+            noise = create_noise(net, geometry, options, create_rng(options)) if args["--display.heatmap"] else None
+            display_network(net, geometry, stats, max_display_size, centre, args["--net-file"],
+                            args["--display.output"], noise)
+        stages = profiler.stages
+    elif args["--batch"]:
+        stages = profiler.stages + run_batch(args, net, geometry)
+    else:
+        generate_file(args, net, geometry, profiler)
+        stages = profiler.stages
 
-    # Write statistics back
-    logging.debug(f"[main] Writing statistics file to {args['--output-file']}")
-    stats.write(args["--output-file"])
+    if args["--profile-report"]:
+        write_report(args["--profile-report"], stages, args)
+
+
+def main():
+    args = docopt(__doc__, version="RandomActivityGen v0.1")
+
+    setup_logging(args)
+
+    if args["--serve"]:
+        from service import serve
+        serve(args)
+        return
 
-    if args["--display"]:
-        logging.debug(f"[main] Displaying network as image of max size {max_display_size}x{max_display_size}")
-        display_network(net, stats, max_display_size, centre, args["--net-file"])
+    assert args["--profile"] in ("none", "cprofile"), f"Unknown profile mode {args['--profile']}"
+    try:
+        with cprofiled(args["--profile.stats"]) if args["--profile"] == "cprofile" else nullcontext():
+            run(args)
+    except BrokenPipeError:
+        if args["--output-file"] != STDOUT:
+            raise
+        # The program reading the statistics from stdout stopped, e.g. head. Stdout is pointed at devnull, as Python
+        # would otherwise fail again when flushing it at exit
+        logging.error("[main] Standard output was closed before all statistics were written")
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -1,36 +1,77 @@
 import logging
-import os
-import sys
-import xml.etree.ElementTree as ET
-from typing import Tuple
+import math
+from typing import Optional, Tuple
 
+import numpy as np
 from PIL import Image, ImageDraw, ImageFont
 from PIL.Image import FLIP_TOP_BOTTOM
 
-from utility import position_on_edge
-
-if 'SUMO_HOME' in os.environ:
-    tools = os.path.join(os.environ['SUMO_HOME'], 'tools')
-    sys.path.append(tools)
-else:
-    sys.exit("Please declare environment variable 'SUMO_HOME' to use sumolib")
-
-import sumolib
+from citystats import Stats
+from geometry import EdgeGeometry
+from network import Network
+from perlin import NoiseSampler
 
 COLOUR_CITY_GATE = (255, 0, 0)
 COLOUR_BUS_STOP = (250, 146, 0, 128)
 COLOUR_SCHOOL = (255, 0, 216, 160)
 COLOUR_CENTRE = (255, 0, 0, 128)
 
+# How strongly the heatmap is coloured, 0 is white and 1 is the colour of the streets
+HEATMAP_STRENGTH = 0.35
+# The noise of the heatmap is sampled at most this many times along each axis, and scaled to the size of the image
+HEATMAP_MAX_SAMPLES = 1024
+
 
-def display_network(net: sumolib.net.Net, stats: ET.ElementTree, max_size: int, centre: Tuple[float, float],
-                    network_name: str):
+def noise_colours(population: np.ndarray, industry: np.ndarray) -> np.ndarray:
+    """
+    Colour population and industry values like streets are coloured, green for industry and blue for population
+    :return: array of RGB colours with the shape of the given arrays plus a last axis of size 3
+    """
+    green = (10 + 245 * (1 - industry)).astype(int)
+    blue = (10 + 245 * (1 - population)).astype(int)
+    return np.stack((np.zeros_like(green), green, blue), axis=-1)
+
+
+def noise_heatmap(pop_noise, work_noise, boundary, width: int, height: int, width_scale: float,
+                  height_scale: float) -> Image.Image:
+    """
+    Render the population and work noise as a faded heatmap of the given size. The first row of the image is the
+    bottom of the city, like the rest of the image before it is flipped
+    :param pop_noise: the population noise, e.g. a NoiseSampler
+    :param work_noise: the work noise, e.g. a NoiseSampler
+    """
+    # Sample the centre of each block of step x step pixels
+    step = max(1, math.ceil(max(width, height) / HEATMAP_MAX_SAMPLES))
+    columns, rows = math.ceil(width / step), math.ceil(height / step)
+    xs = boundary[0] + (np.arange(columns) * step + step / 2) / width_scale
+    ys = boundary[1] + (np.arange(rows) * step + step / 2) / height_scale
+
+    population = np.empty((rows, columns))
+    industry = np.empty((rows, columns))
+    # Sample a block of rows at a time to limit the memory used by the noise evaluation
+    block = max(1, (1 << 18) // columns)
+    for row in range(0, rows, block):
+        points = np.stack(np.meshgrid(xs, ys[row:row + block]), axis=-1).reshape(-1, 2)
+        population[row:row + block] = pop_noise.sample_many(points).reshape(-1, columns)
+        industry[row:row + block] = work_noise.sample_many(points).reshape(-1, columns)
+
+    faded = 255 - (255 - noise_colours(population, industry)) * HEATMAP_STRENGTH
+    heatmap = Image.fromarray(np.clip(faded, 0, 255).astype(np.uint8), "RGB")
+    return heatmap.resize((width, height), Image.BILINEAR) if step > 1 else heatmap
+
+
+def display_network(net: Network, geometry: EdgeGeometry, stats: Stats, max_size: int,
+                    centre: Tuple[float, float], network_name: str, output_file: Optional[str] = None,
+                    noise: Optional[Tuple[NoiseSampler, NoiseSampler]] = None):
     """
     :param net: the network to display noisemap for
+    :param geometry: the edge geometry of the network
     :param stats: the stats file describing the network
     :param max_size: maximum width/height of the resulting image
     :param centre: the centre of the network for drawing dot
     :param network_name: the name of the network for drawing in upper-left corner
+    :param output_file: file to save the image to, or None to show it in an image viewer
+    :param noise: the population and work noise to draw as a heatmap under the streets, or None for a white background
     :return:
     """
     # Basics about the city and its size
@@ -67,56 +108,65 @@ def display_network(net: sumolib.net.Net, stats: ET.ElementTree, max_size: int,
     assert font is not None, "[render] No font loaded, cannot continue"
 
     # Make image and prepare for drawing
-    img = Image.new("RGB", (width, height), (255, 255, 255))
+    if noise is not None:
+        img = noise_heatmap(noise[0], noise[1], boundary, width, height, width_scale, height_scale)
+    else:
+        img = Image.new("RGB", (width, height), (255, 255, 255))
     draw = ImageDraw.Draw(img, "RGBA")
 
     # Draw streets
-    if stats.find("streets") is not None:
-        for street_xml in stats.find("streets").findall("street"):
-            edge = net.getEdge(street_xml.attrib["edge"])
-            population = float(street_xml.attrib["population"])
-            industry = float(street_xml.attrib["workPosition"])
-            green = int(10 + 245 * (1 - industry))
-            blue = int(10 + 245 * (1 - population))
-            for pos1, pos2 in [edge.getShape()[i:i + 2] for i in range(0, int(len(edge.getShape()) - 1))]:
-                draw.line((to_png_space(pos1), to_png_space(pos2)), (0, green, blue),
-                          int(1.5 + 3.5 * population ** 1.5))
+    if stats.table("streets") is not None:
+        streets = stats.table("streets")
+        edges = geometry.indices_of(streets["edge"].tolist()).tolist()
+        populations = streets["population"]
+        industries = streets["workPosition"]
+        colours = noise_colours(populations, industries)
+        greens, blues = colours[:, 1].tolist(), colours[:, 2].tolist()
+        widths = (1.5 + 3.5 * populations ** 1.5).astype(int).tolist()
+
+        # Translate all vertices to png space at once
+        png_vertices = (geometry.vertices - (boundary[0], boundary[1])) * (width_scale, height_scale)
+        offsets = geometry.offsets.tolist()
+
+        # All segments of a street have the same colour and width, so each street is drawn as one line through its
+        # vertices. Streets are drawn in order, as streets drawn later cover those below them
+        for edge, green, blue, line_width in zip(edges, greens, blues, widths):
+            draw.line(png_vertices[offsets[edge]:offsets[edge + 1]].ravel().tolist(), (0, green, blue), line_width)
     else:
         logging.warning(f"[render] Could not find any streets in statistics")
 
     # Draw city gates
-    if stats.find("cityGates") is not None:
-        for gate_xml in stats.find("cityGates").findall("entrance"):
-            edge = net.getEdge(gate_xml.attrib["edge"])
-            traffic = max(float(gate_xml.attrib["incoming"]), float(gate_xml.attrib["outgoing"]))
-            x, y = to_png_space(position_on_edge(edge, float(gate_xml.attrib["pos"])))
+    if stats.table("cityGates") is not None:
+        gates = stats.table("cityGates")
+        traffics = np.maximum(gates["incoming"], gates["outgoing"]).tolist()
+        for traffic, pos in zip(traffics, geometry.element_positions(gates).tolist()):
+            x, y = to_png_space(pos)
             r = int(max_size / 600 + traffic / 1.3)
             draw.ellipse((x - r, y - r, x + r, y + r), fill=COLOUR_CITY_GATE)
     else:
         logging.warning(f"[render] Could not find any city-gates in statistics")
 
     # Draw bus stops
-    if stats.find("busStations") is not None:
-        for stop_xml in stats.find("busStations").findall("busStation"):
-            edge = net.getEdge(stop_xml.attrib["edge"])
-            x, y = to_png_space(position_on_edge(edge, float(stop_xml.attrib["pos"])))
+    if stats.table("busStations") is not None:
+        for pos in geometry.element_positions(stats.table("busStations")).tolist():
+            x, y = to_png_space(pos)
             r = max_size / 600
             draw.ellipse((x - r, y - r, x + r, y + r), fill=COLOUR_BUS_STOP)
     else:
         logging.warning(f"[render] Could not find any bus-stations in statistics")
 
     # Draw schools
-    if stats.find("schools") is not None:
-        for school_xml in stats.find("schools").findall("school"):
-            edge = net.getEdge(school_xml.attrib["edge"])
-            capacity = int(school_xml.get('capacity'))
-            x, y = to_png_space(position_on_edge(edge, float(school_xml.get('pos'))))
+    if stats.table("schools") is not None:
+        schools = stats.table("schools")
+        for capacity, pos in zip(schools["capacity"].tolist(), geometry.element_positions(schools).tolist()):
+            x, y = to_png_space(pos)
             r = int((max_size / 275 * (capacity / 500) ** 0.4) * 1.1)
             draw.ellipse((x - r, y - r, x + r, y + r), fill=COLOUR_SCHOOL)
     else:
         logging.warning(f"[render] Could not find any schools in statistics")
 
-    if not any([stats.find(x) for x in {"streets", "cityGates", "busStations", "schools"}]):
+    if not any(stats.table(x) is not None and len(stats.table(x)) > 0
+               for x in {"streets", "cityGates", "busStations", "schools"}):
         logging.error("[render] No elements found in statistics, cannot display network and features")
         exit(1)
 
@@ -129,7 +179,7 @@ def display_network(net: sumolib.net.Net, stats: ET.ElementTree, max_size: int,
     img = img.transpose(FLIP_TOP_BOTTOM)
     draw = ImageDraw.Draw(img, "RGBA")
 
-    Legend(max_size, height, draw, font) \
+    Legend(img, max_size, height, draw, font) \
         .draw_network_name(network_name) \
         .draw_scale_legend(city_size, width_scale) \
         .draw_gradient("Pop, work gradient") \
@@ -138,11 +188,16 @@ def display_network(net: sumolib.net.Net, stats: ET.ElementTree, max_size: int,
         .draw_icon_legend(COLOUR_BUS_STOP, "Bus stop") \
         .draw_icon_legend(COLOUR_CITY_GATE, "City gate")
 
-    img.show()
+    if output_file is not None:
+        logging.info(f"[render] Saving image to {output_file}")
+        img.save(output_file)
+    else:
+        img.show()
 
 
 class Legend:
-    def __init__(self, scale, height, draw, font, margin=10):
+    def __init__(self, img, scale, height, draw, font, margin=10):
+        self.img: Image.Image = img
         self.offset = margin
         self.scale = scale / 800
         self.legend_height = 10 * self.scale
@@ -193,12 +248,13 @@ class Legend:
         h_box = int(self.legend_height)
         w_box = h_box * 2
 
-        for x in range(1, w_box):
-            for y in range(1, h_box):
-                x_intensity = 1 - x / w_box
-                y_intensity = y / h_box
-                point_colour = (0, int(10 + 245 * x_intensity), int(10 + 245 * y_intensity))
-                self.draw.point((self.offset + x, self.y + y), point_colour)
+        if w_box > 1 and h_box > 1:
+            # Industry decreases left to right, population increases top to bottom
+            x_intensity = 1 - np.arange(1, w_box) / w_box
+            y_intensity = np.arange(1, h_box) / h_box
+            green, blue = np.meshgrid((10 + 245 * x_intensity).astype(int), (10 + 245 * y_intensity).astype(int))
+            swatch = np.stack((np.zeros_like(green), green, blue), axis=-1)
+            self.img.paste(Image.fromarray(swatch.astype(np.uint8), "RGB"), (int(self.offset) + 1, int(self.y) + 1))
 
         # draw box
         self.draw.rectangle((self.offset, self.y, self.offset + w_box, self.y + h_box),
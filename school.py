@@ -1,111 +1,105 @@
 import logging
-import os
 import random
-import sys
-import xml.etree.ElementTree as ET
+from typing import Dict, Set, Tuple
 
-from perlin import NoiseSampler, get_edge_pair_centroid
-from utility import k_means_clusters
+import numpy as np
 
-if 'SUMO_HOME' in os.environ:
-    tools = os.path.join(os.environ['SUMO_HOME'], 'tools')
-    sys.path.append(tools)
-else:
-    sys.exit("Please declare environment variable 'SUMO_HOME' to use sumolib")
+from citystats import Stats
+from geometry import EdgeGeometry
+from options import Options
+from utility import k_means_labels
 
-import sumolib
 
-
-def find_school_edges(net: sumolib.net.Net, num_schools: int, pop_noise: NoiseSampler):
+def find_school_edges(geometry: EdgeGeometry, num_schools: int, populations: np.ndarray, max_iter: int = 100,
+                      tol: float = 1e-4, rng=random):
     """
     Uses k-means clustering to partition network into number of clusters equal to number of schools to be placed.
-    Finds the edge in each cluster that allows both pedestrians and passengers with highest perlin noise, and returns a
-    list of all these
+    Finds the edge in each cluster that allows both pedestrians and passengers with highest population noise, and
+    returns a list of all these
     :param num_schools: number of schools that should be placed in total
-    :return: the edges schools
+    :param populations: the population noise of every edge, indexed like geometry, as returned by setup_streets
+    :param max_iter: maximum number of k-means iterations
+    :param tol: relative tolerance for k-means convergence
+    :param rng: the random number generator to use, e.g. a random.Random
+    :return: the indices of the edges schools
     should be placed on
     """
     # Use k-means, to split the net into num_schools number of clusters, each containing approx same number of edges
-    districts = k_means_clusters(net, num_schools)
-
-    school_edges = []
-
-    def find_valid_edge(edges):
-        for edge in edges:
-            if edge.allows("pedestrian") and edge.allows("passenger"):
-                return edge
-        logging.debug(f"[school] Not able to find valid edge for school in cluster")
+    labels = k_means_labels(geometry, num_schools, max_iter, tol, np.random.default_rng(rng.getrandbits(64)))
+    clusters = int(labels.max()) + 1 if len(labels) > 0 else 0
 
-    # Sort each edge in each district based on their noise
-    for district in districts:
-        district.sort(key=lambda x: pop_noise.sample(get_edge_pair_centroid(x.getShape())))
+    # Only consider edges that allow both pedestrians, and passenger cars. This is done to avoid placing schools on
+    # highways (pedestrians not allowed) and also on small paths in forests, parks and so on (passenger cars not allowed)
+    valid = np.flatnonzero(geometry.allows("pedestrian") & geometry.allows("passenger"))
+    valid_labels = labels[valid]
 
-        # Reverse list, so 0 index has the highest noise
-        district.reverse()
+    # Find the highest noise among the valid edges of each cluster, and the edges with that noise. Among equal noise the
+    # last edge is chosen
+    best_noise = np.full(clusters, -np.inf)
+    np.maximum.at(best_noise, valid_labels, populations[valid])
+    is_best = populations[valid] == best_noise[valid_labels]
+    best_edge = np.full(clusters, -1)
+    np.maximum.at(best_edge, valid_labels[is_best], valid[is_best])
 
-        # Get the edge with highest noise, that also allows for both pedestrians, and passenger cars This is done to
-        # avoid placing schools on highways (pedestrians not allowed) and also on small paths in forests,
-        # parks and so on (passenger cars not allowed)
-        valid_edge = (find_valid_edge(district))
-        if valid_edge is not None:
-            school_edges.append(valid_edge)
+    missing = int(np.count_nonzero(best_edge < 0))
+    if missing > 0:
+        logging.debug(f"[school] Not able to find valid edge for school in {missing} cluster(s)")
 
-    return school_edges
+    return best_edge[best_edge >= 0].tolist()
 
 
-def insert_schools(args, new_school_edges: list, stats: ET.ElementTree, school_type: str):
+def insert_schools(options: Options, geometry: EdgeGeometry, new_school_edges: list, stats: Stats,
+                   school_type: str, rng=random):
     """
     Inserts schools in the given stats file, with random fields within certain bounds, either given as a parameter
     from user, or from default values for the school_type
-        :param new_school_edges: edges to place schools on
+        :param geometry: the edge geometry of the network
+        :param new_school_edges: indices of edges to place schools on
         :param stats: stats file to write to
         :param school_type: type of schools that are being placed, different school types have different bounds for random fields
+        :param rng: the random number generator to use, e.g. a random.Random
     """
-    school_open_earliest = int(args["--schools.open"].split(",")[0]) * 3600
-    school_open_latest = int(args["--schools.open"].split(",")[1]) * 3600
-    school_close_earliest = int(args["--schools.close"].split(",")[0]) * 3600
-    school_close_latest = int(args["--schools.close"].split(",")[1]) * 3600
-    school_stepsize = int((float(args["--schools.stepsize"]) * 3600))
+    school_open_earliest = options.schools_open[0] * 3600
+    school_open_latest = options.schools_open[1] * 3600
+    school_close_earliest = options.schools_close[0] * 3600
+    school_close_latest = options.schools_close[1] * 3600
+    school_stepsize = int((options.schools_stepsize * 3600))
+    school_options = options.school(school_type)
     logging.debug(f"[school] For school generation using:\n\tschool_open_earliest:\t {school_open_earliest}\n\t"
                   f"school_open_latest:\t\t {school_open_latest}\n\t"
                   f"school_close_earliest:\t {school_close_earliest}\n\t"
                   f"school_close_latest:\t {school_close_latest}\n\t"
                   f"school_stepsize:\t\t {school_stepsize}")
 
-    xml_schools = stats.find('schools')
-    if xml_schools is None:
-        xml_schools = ET.SubElement(stats.getroot(), "schools")
+    xml_schools = stats.table("schools", create=True)
 
     # Insert schools, with semi-random parameters
     logging.debug(f"[school] Inserting {str(len(new_school_edges))} {school_type}(s)")
+    schools = {name: [] for name in ("edge", "pos", "beginAge", "endAge", "capacity", "opening", "closing")}
     for school_edge in new_school_edges:
-        begin_age = random.randint(int(args[f"--{school_type}.begin-age"].split(",")[0]),
-                                   int(args[f"--{school_type}.begin-age"].split(",")[1]))
-        end_age = random.randint(int(args[f"--{school_type}.end-age"].split(",")[0]) if begin_age + 1 <= int(
-            args[f"--{school_type}.end-age"].split(",")[0]) else begin_age + 1,
-                                 int(args[f"--{school_type}.end-age"].split(",")[1]))
+        begin_age = rng.randint(*school_options.begin_age)
+        end_age = rng.randint(max(school_options.end_age[0], begin_age + 1), school_options.end_age[1])
         logging.debug(f"[school] Using begin_age: {begin_age}, end_age: {end_age} for {school_type}(s)")
 
-        ET.SubElement(xml_schools, "school", attrib={
-            "edge": str(school_edge.getID()),
-            "pos": str(random.randint(0, int(school_edge.getLength()))),
-            "beginAge": str(begin_age),
-            "endAge": str(end_age),
-            "capacity": str(random.randint(int(args[f"--{school_type}.capacity"].split(",")[0]),
-                                           int(args[f"--{school_type}.capacity"].split(",")[1]))),
-            "opening": str(random.randrange(school_open_earliest, school_open_latest, school_stepsize)),
-            "closing": str(random.randrange(school_close_earliest, school_close_latest, school_stepsize))
-        })
+        schools["edge"].append(str(geometry.ids[school_edge]))
+        schools["pos"].append(rng.randint(0, int(geometry.lengths[school_edge])))
+        schools["beginAge"].append(begin_age)
+        schools["endAge"].append(end_age)
+        schools["capacity"].append(rng.randint(*school_options.capacity))
+        schools["opening"].append(rng.randrange(school_open_earliest, school_open_latest, school_stepsize))
+        schools["closing"].append(rng.randrange(school_close_earliest, school_close_latest, school_stepsize))
+    xml_schools.append(**schools)
 
 
-def get_school_count(args, stats: ET.ElementTree, school_type: str):
+def get_school_count(options: Options, stats: Stats, school_type: str):
     """
     If no number is specified for a specific school type, the default ratio between population and school_type is
     used (school_type.ratio)  to calculate number of schools
     :return: the number of schools of a given school_type to be placed
     """
-    if args[f"--{school_type}.count"] == "auto":
-        schools_per_1000_inhabitants = float(args[f"--{school_type}.ratio"])
+    school_options = options.school(school_type)
+    if school_options.count is None:
+        schools_per_1000_inhabitants = school_options.ratio
 
         # Calculate default number of schools, based on population if none input parameter
         xml_general = stats.find('general')
@@ -114,44 +108,116 @@ def get_school_count(args, stats: ET.ElementTree, school_type: str):
 
     else:
         # Else place new number of schools as according to input
-        school_count = int(args[f"--{school_type}.count"])
+        school_count = school_options.count
 
     return school_count
 
 
-def setup_schools(args, net: sumolib.net.Net, stats: ET.ElementTree, pop_noise: NoiseSampler):
+def setup_schools(options: Options, geometry: EdgeGeometry, stats: Stats, populations: np.ndarray, rng=random):
     """
     Removes all existing schools in stats file, finds total number of schools to be placed in the net, splits net
     into k-clusters, and then places a school on the edge with highest perlin noise in each cluster
+    :param populations: the population noise of every edge, indexed like geometry, as returned by setup_streets
+    :param rng: the random number generator to use, e.g. a random.Random
     """
-    xml_schools = stats.find('schools')
+    xml_schools = stats.table('schools')
     # Remove all previous schools if any exists, effectively overwriting these
     if xml_schools is not None:
-        schools = xml_schools.findall('school')
-        for school in schools:
-            xml_schools.remove(school)
+        xml_schools.clear()
 
     # Get number of schools to be placed
-    primary_school_count = int(get_school_count(args, stats, "primary-school"))
-    high_school_count = int(get_school_count(args, stats, "high-school"))
-    college_count = int(get_school_count(args, stats, "college"))
+    primary_school_count = int(get_school_count(options, stats, "primary-school"))
+    high_school_count = int(get_school_count(options, stats, "high-school"))
+    college_count = int(get_school_count(options, stats, "college"))
 
     school_count = primary_school_count + high_school_count + college_count
 
     # Find edges to place schools on
     if 0 < school_count:
-        new_school_edges = find_school_edges(net, school_count, pop_noise)
+        new_school_edges = find_school_edges(geometry, school_count, populations,
+                                             options.schools_kmeans_iter, options.schools_kmeans_tol, rng)
 
     # Place primary schools (if any) on the first edges in new_school_edges
     if 0 < primary_school_count:
-        insert_schools(args, new_school_edges[:primary_school_count], stats, "primary-school")
+        insert_schools(options, geometry, new_school_edges[:primary_school_count], stats, "primary-school", rng)
 
     # Then place high schools (if any) on the next edges in new_school_edges
     if 0 < high_school_count:
-        insert_schools(args, new_school_edges[primary_school_count:primary_school_count + high_school_count], stats,
-                       "high-school")
+        insert_schools(options, geometry, new_school_edges[primary_school_count:primary_school_count + high_school_count],
+                       stats, "high-school", rng)
 
     # Place colleges (if any) on the remaining edges in new_school_edges, as the remaining number of edges should
     # reflect number of colleges
     if 0 < college_count:
-        insert_schools(args, new_school_edges[primary_school_count + high_school_count:school_count], stats, "college")
\ No newline at end of file
+        insert_schools(options, geometry, new_school_edges[primary_school_count + high_school_count:school_count], stats,
+                       "college", rng)
+
+
+def _district(points: np.ndarray, centre: np.ndarray, others: np.ndarray) -> np.ndarray:
+    """
+    :return: sorted indices of the points that are nearer to centre than to any of the others
+    """
+    candidates = np.arange(len(points))
+    distances = np.hypot(*(points - centre).T)
+    other_distances = np.hypot(*(others - centre).T)
+    # The nearest other centres remove the most points, and once the remaining points are closer to centre than half
+    # the distance to the next other centre, no other centre can be nearer to them
+    for other in np.argsort(other_distances):
+        if len(candidates) == 0 or other_distances[other] > 2 * distances[candidates].max():
+            break
+        nearer = distances[candidates] < np.hypot(*(points[candidates] - others[other]).T)
+        candidates = candidates[nearer]
+    return candidates
+
+
+def replace_schools(geometry: EdgeGeometry, stats: Stats, stale: Set[str], populations: np.ndarray,
+                    old_positions: Dict[Tuple[str, float], Tuple[float, float]], rng=random):
+    """
+    Move the schools on changed or removed edges of statistics generated for an earlier version of the network, and
+    keep all other schools. The school districts are those of the existing schools, i.e. each edge belongs to the
+    school nearest to it, and a moved school is placed on the valid edge of its district with the highest population
+    noise. Its other attributes are kept
+    :param stale: the ids of the edges that were changed or removed since the statistics were generated
+    :param populations: the population of every edge, indexed like geometry
+    :param old_positions: the coordinates of the schools when the statistics were generated, by edge and pos
+    :param rng: the random number generator to use, e.g. a random.Random
+    """
+    xml_schools = stats.table("schools")
+    moved = np.flatnonzero(xml_schools.edge_in(stale)) if xml_schools is not None else np.array([], dtype=np.int64)
+    if len(moved) == 0:
+        return
+    kept = np.flatnonzero(~xml_schools.edge_in(stale))
+    edges, positions = xml_schools["edge"], xml_schools["pos"]
+
+    # Schools that cannot be moved are removed once all are moved, so the rows do not change while moving
+    removed = np.zeros(len(xml_schools), dtype=bool)
+    moved_positions = [old_positions.get((edges[school], float(positions[school]))) for school in moved]
+    for school, position in zip(moved.tolist(), moved_positions):
+        if position is None:
+            logging.warning(f"[school] The earlier position of the school on {edges[school]} is unknown, removing it")
+            removed[school] = True
+    moved = moved[~removed[moved]]
+    moved_positions = [position for position in moved_positions if position is not None]
+
+    centres = np.vstack((geometry.element_positions(xml_schools.take(kept)), np.array(moved_positions).reshape(-1, 2)))
+
+    # Valid edges as in find_school_edges, which do not have a school already
+    valid = geometry.allows("pedestrian") & geometry.allows("passenger")
+    valid[geometry.indices_of(edges[kept].tolist())] = False
+
+    logging.debug(f"[school] Moving {len(moved)} school(s) from changed edges")
+    for i, school in enumerate(moved.tolist()):
+        centre = len(kept) + i
+        district = _district(geometry.centroids, centres[centre], np.delete(centres, centre, axis=0))
+        candidates = district[valid[district]]
+        if len(candidates) == 0:
+            logging.debug(f"[school] Not able to find valid edge for school on {edges[school]}, removing it")
+            removed[school] = True
+            continue
+        # Among equal noise the last edge is chosen, like in find_school_edges
+        best = np.flatnonzero(populations[candidates] == populations[candidates].max())
+        edge = int(candidates[best[-1]])
+        valid[edge] = False
+        edges[school] = geometry.ids[edge]
+        xml_schools.set("pos", school, rng.randint(0, int(geometry.lengths[edge])))
+    xml_schools.remove(removed)
@@ -0,0 +1,328 @@
+"""
+A HTTP service generating statistics files, started with randomActivityGen.py --serve. Networks are read from the
+--serve.networks directory and kept in memory between requests, such that a request only pays for generating the
+statistics. Endpoints:
+
+    POST /generate?net=NAME&OPTION=VALUE...
+        Generate statistics for the network DIR/NAME.net.xml (or .net.xml.gz) from the statistics file in the request
+        body. Options are those of randomActivityGen.py without the leading dashes, e.g.
+        seed=2&bus-stop&bus-stop.distance=300. The generated statistics file is streamed back as the response.
+    GET /networks
+        The names of the networks in the directory, as a JSON list.
+    GET /stats
+        Counters of requests, the network cache, and request latency, as a JSON object.
+"""
+import collections
+import io
+import json
+import logging
+import os
+import threading
+import time
+import xml.etree.ElementTree as ET
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+
+from citystats import Stats
+from generator import create_rng, populate
+from geometry import EdgeGeometry
+from netcache import load_network
+from network import Network
+from options import NetCacheOptions, Options
+from utility import verify_stats
+
+# Options a request may give, by prefix. Other options, e.g. files and logging, are those the service was started with
+REQUEST_OPTIONS = ("--centre.", "--gates.", "--schools.", "--primary-school.", "--high-school.", "--college.",
+                   "--bus-stop", "--seed", "--random", "--noise-field", "--precision")
+
+# Options a request may not give although they match REQUEST_OPTIONS, as they refer to files of the service
+SERVICE_OPTIONS = {"--noise-field.dir"}
+
+# Number of recent requests the latency percentiles are computed from
+LATENCY_WINDOW = 1000
+
+# Suffixes of the network files in the directory, the network NAME is the first of NAME.net.xml and NAME.net.xml.gz
+NET_SUFFIXES = (".net.xml", ".net.xml.gz")
+
+
+class UnknownNetworkError(Exception):
+    pass
+
+
+def network_size(net: Network, geometry: EdgeGeometry) -> int:
+    """
+    :return: approximate number of bytes used by the network and its geometry
+    """
+    arrays = [net.edge_from, net.edge_to, net.edge_lengths, net.shape_offsets, net.shape_vertices, net.lane_offsets,
+              net.lane_permissions, net.node_coords, *geometry.arrays().values()]
+    # Python strings take roughly 50 bytes plus their length
+    ids = sum(50 + len(s) for s in net.edge_ids) + sum(50 + len(s) for s in net.node_ids)
+    return sum(np.asarray(array).nbytes for array in arrays) + ids
+
+
+class NetworkCache:
+    """
+    The networks of a directory loaded on demand and kept in memory, evicting the least recently used networks when
+    their total size exceeds max_bytes. A network is loaded again when its file changes. Safe to use from several
+    threads; a network requested by several threads at once is only loaded once.
+    """
+
+    def __init__(self, net_cache: NetCacheOptions, net_dir: str, max_bytes: int):
+        """
+        :param net_cache: where the networks are cached as snapshots between runs of the service
+        :param net_dir: directory with the networks, the network NAME is the file NAME.net.xml or NAME.net.xml.gz
+        """
+        self.net_cache = net_cache
+        self.net_dir = net_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Name -> (modification time of the file, network, geometry, size), least recently used first
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._loading: Dict[str, threading.Lock] = {}
+
+    def names(self):
+        return sorted({name[:-len(suffix)] for name in os.listdir(self.net_dir) for suffix in NET_SUFFIXES
+                       if name.endswith(suffix)})
+
+    def path(self, name: str) -> str:
+        """
+        :return: the path of the network file with the given name
+        :raises UnknownNetworkError: if there is no such network in the directory
+        """
+        if name and os.path.basename(name) == name and not name.startswith("."):
+            for suffix in NET_SUFFIXES:
+                path = os.path.join(self.net_dir, f"{name}{suffix}")
+                if os.path.isfile(path):
+                    return path
+        raise UnknownNetworkError(f"Unknown network {name}")
+
+    def _lookup(self, name: str, mtime: int) -> Optional[Tuple[Network, EdgeGeometry]]:
+        # Must be called with the lock held
+        entry = self._entries.get(name)
+        if entry is None or entry[0] != mtime:
+            return None
+        self._entries.move_to_end(name)
+        self.hits += 1
+        return entry[1], entry[2]
+
+    def get(self, name: str) -> Tuple[Network, EdgeGeometry]:
+        """
+        :return: the network with the given name and its geometry, loading it if it is not in the cache
+        :raises UnknownNetworkError: if there is no such network in the directory
+        """
+        path = self.path(name)
+        mtime = os.stat(path).st_mtime_ns
+        with self._lock:
+            found = self._lookup(name, mtime)
+            if found is not None:
+                return found
+            loading = self._loading.setdefault(name, threading.Lock())
+
+        with loading:
+            # Another thread may have loaded the network while we waited
+            with self._lock:
+                found = self._lookup(name, mtime)
+                if found is not None:
+                    return found
+                self.misses += 1
+
+            start = time.perf_counter()
+            net, geometry = load_network(path, self.net_cache.cache_dir, self.net_cache.max_bytes,
+                                          self.net_cache.max_age)
+            size = network_size(net, geometry)
+            logging.info(f"[service] Loaded network {name} ({size / 1024 ** 2:.1f} MB) in "
+                         f"{time.perf_counter() - start:.2f} s")
+
+            with self._lock:
+                self._entries.pop(name, None)
+                self._entries[name] = (mtime, net, geometry, size)
+                # The network just loaded is kept even if it alone exceeds the limit
+                while len(self._entries) > 1 and self.size() > self.max_bytes:
+                    evicted, _ = self._entries.popitem(last=False)
+                    self.evictions += 1
+                    logging.info(f"[service] Evicting network {evicted} from the cache")
+            return net, geometry
+
+    def size(self) -> int:
+        return sum(entry[3] for entry in self._entries.values())
+
+    def counters(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "size": self.size(),
+                    "max_size": self.max_bytes,
+                    "networks": {name: entry[3] for name, entry in self._entries.items()}}
+
+
+class Service:
+    """
+    The state shared by the requests of the service; the base arguments, the network cache, and the counters
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.cache = NetworkCache(NetCacheOptions.from_args(args), args["--serve.networks"],
+                                  int(float(args["--serve.cache-size"]) * 1024 ** 2))
+        self.requests = 0
+        self.errors = 0
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self._lock = threading.Lock()
+
+    def request_args(self, query: Dict[str, list]) -> dict:
+        """
+        :param query: the parsed query string of a generate request, with blank values kept
+        :return: the arguments of the request, i.e. the base arguments with the options of the query
+        """
+        request_args = dict(self.args)
+        for key, values in query.items():
+            if key == "net":
+                continue
+            option = key if key.startswith("--") else f"--{key}"
+            assert option in self.args and option.startswith(REQUEST_OPTIONS) and option not in SERVICE_OPTIONS, \
+                f"Option {key} cannot be given in a request"
+            value = values[-1]
+            if isinstance(self.args[option], bool):
+                # Flags are given without a value, or as true or false
+                assert value.lower() in ("", "true", "false"), f"Flag {key} must be true or false"
+                request_args[option] = value.lower() != "false"
+            else:
+                request_args[option] = value
+        return request_args
+
+    def record(self, latency: float, ok: bool):
+        with self._lock:
+            self.requests += 1
+            self.errors += not ok
+            self.latencies.append(latency)
+
+    def counters(self) -> dict:
+        with self._lock:
+            latencies = np.array(self.latencies)
+            counters = {"requests": self.requests, "errors": self.errors}
+        if len(latencies) > 0:
+            counters["latency"] = {"window": len(latencies), "mean": float(latencies.mean()),
+                                   "p50": float(np.percentile(latencies, 50)),
+                                   "p95": float(np.percentile(latencies, 95)), "max": float(latencies.max())}
+        counters["cache"] = self.cache.counters()
+        return counters
+
+
+class _ResponseWriter(io.RawIOBase):
+    """
+    Writes the body of a successful response, sending the headers right before the first byte of the body. Errors
+    raised before anything is written can thus still be sent as an error response
+    """
+
+    def __init__(self, handler: BaseHTTPRequestHandler):
+        super().__init__()
+        self.handler = handler
+        self.started = False
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        if not self.started:
+            self.started = True
+            self.handler.send_response(200)
+            self.handler.send_header("Content-Type", "application/xml")
+            self.handler.end_headers()
+        self.handler.wfile.write(b)
+        return len(b)
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    # Responses are not sent with a length, so each connection ends with its response
+    protocol_version = "HTTP/1.0"
+    # Buffer the responses, as statistics files are written in small pieces
+    wbufsize = 1 << 16
+
+    @property
+    def service(self) -> Service:
+        return self.server.service
+
+    def send_json(self, status: int, value):
+        body = json.dumps(value).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_json(self, output: _ResponseWriter, status: int, error: str):
+        """
+        Send an error response, unless the body of a successful response has already been started. The client then
+        only notices the error by the response ending early, as there is no way to change the status anymore
+        """
+        if output.started:
+            logging.error(f"[service] Cannot send error {status} for {self.path}, the response has already started: "
+                          f"{error}")
+        else:
+            self.send_json(status, {"error": error})
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == "/networks":
+            self.send_json(200, self.service.cache.names())
+        elif url.path == "/stats":
+            self.send_json(200, self.service.counters())
+        else:
+            self.send_json(404, {"error": f"Unknown path {url.path}"})
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path != "/generate":
+            self.send_json(404, {"error": f"Unknown path {url.path}"})
+            return
+
+        start = time.perf_counter()
+        output = _ResponseWriter(self)
+        ok = False
+        try:
+            query = parse_qs(url.query, keep_blank_values=True)
+            request_args = self.service.request_args(query)
+            net, geometry = self.service.cache.get(query.get("net", [""])[-1])
+            stats = Stats.read(io.BytesIO(self.rfile.read(int(self.headers.get("Content-Length", 0)))))
+            verify_stats(stats)
+            # Each request has its own random number generator
+            options = Options.from_args(request_args)
+            populate(net, geometry, stats, options, create_rng(options))
+            stats.write(output, options.precision)
+            ok = True
+        except UnknownNetworkError as e:
+            self.send_error_json(output, 404, str(e))
+        except (AssertionError, ValueError, ET.ParseError) as e:
+            self.send_error_json(output, 400, str(e))
+        except Exception as e:
+            logging.exception(f"[service] Request {self.path} failed")
+            self.send_error_json(output, 500, f"{type(e).__name__}: {e}")
+        finally:
+            latency = time.perf_counter() - start
+            self.service.record(latency, ok)
+            logging.info(f"[service] {self.path} {'done' if ok else 'failed'} in {latency:.3f} s")
+
+    def log_message(self, format, *args):
+        logging.debug(f"[service] {self.address_string()} {format % args}")
+
+
+def serve(args):
+    """
+    Serve requests on the address given by --serve, e.g. localhost:8080, until interrupted
+    """
+    host, _, port = args["--serve"].rpartition(":")
+    server = ThreadingHTTPServer((host or "localhost", int(port)), ServiceHandler)
+    server.daemon_threads = True
+    server.service = Service(args)
+    logging.info(f"[service] Serving networks from {args['--serve.networks']} on "
+                 f"http://{server.server_address[0]}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
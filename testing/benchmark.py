@@ -0,0 +1,175 @@
+"""Usage:
+    benchmark.py run [--kinds=LIST] [--sizes=LIST] [--repeat=N] [--net-dir=DIR] [--output=FILE] [--no-render]
+    benchmark.py compare [--baseline=FILE] [--results=FILE] [--threshold=F] [--min-time=S]
+
+Times each stage of the generator, including rendering with display_network, on synthetic networks of increasing
+size, and the time it takes randomActivityGen.py to start. The networks are generated by testing/synthnet.py, so neither SUMO's netgenerate nor real city files are needed.
+Run from the root of the repository, e.g. python -m testing.benchmark run --sizes=1000,10000
+
+Options:
+    --kinds=LIST        Comma separated kinds of networks {grid, radial, random}. [default: grid,radial,random]
+    --sizes=LIST        Comma separated approximate numbers of edges. [default: 1000,10000,100000,1000000]
+    --repeat=N          Run each network N times and keep the fastest time of each stage. [default: 3]
+    --net-dir=DIR       Directory for the generated networks, "auto" is ~/.cache/randomActivityGen/benchmark. [default: auto]
+    --output=FILE       Write the results to FILE as JSON. [default: testing/benchmark-results.json]
+    --no-render         Do not time rendering the network.
+    --baseline=FILE     Results to compare against. [default: testing/benchmark-baseline.json]
+    --results=FILE      Results to compare. [default: testing/benchmark-results.json]
+    --threshold=F       Flag stages that are more than F times slower than the baseline, e.g. 0.25 is 25%. [default: 0.25]
+    --min-time=S        Ignore stages that take less than S seconds in both results, as they are too noisy. [default: 0.05]
+"""
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, Tuple
+
+from docopt import docopt
+
+import randomActivityGen
+from netcache import default_cache_dir, load_network
+from profiling import StageProfiler
+from testing.synthnet import KINDS, generate_network, write_net
+
+# Statistics file used for every benchmark run
+STAT_FILE = "in/example.stat.xml"
+
+# Number of times to start randomActivityGen.py when timing its startup
+STARTUP_REPEAT = 10
+
+# Bump when the generated networks change, such that old networks are generated again
+NETWORK_VERSION = 1
+
+
+def network_file(net_dir: str, kind: str, size: int) -> str:
+    """
+    :return: the path of the synthetic network of the given kind and size, which is generated if it does not exist
+    """
+    path = os.path.join(net_dir, f"{kind}-{size}-v{NETWORK_VERSION}.net.xml")
+    if not os.path.exists(path):
+        print(f"Generating {kind} network with about {size} edges", file=sys.stderr)
+        os.makedirs(net_dir, exist_ok=True)
+        tmp = f"{path}.tmp-{os.getpid()}"
+        write_net(tmp, *generate_network(kind, size))
+        os.replace(tmp, path)
+    return path
+
+
+def run_once(net_file: str, size: int, out_dir: str, render: bool) -> Tuple[StageProfiler, int, int]:
+    """
+    Run the generator on net_file like randomActivityGen.py does, with bus stops enabled and without the network cache.
+    The number of schools grows with the size of the network, as the population of the statistics file is fixed
+    :return: the profiler with the stages of the run, and the number of edges and nodes in the network
+    """
+    argv = [f"--net-file={net_file}", f"--stat-file={STAT_FILE}",
+            f"--output-file={os.path.join(out_dir, 'result.stat.xml')}", "--bus-stop", "--no-net-cache",
+            f"--primary-school.count={max(1, size // 500)}", f"--high-school.count={max(1, size // 2500)}",
+            f"--college.count={max(1, size // 10000)}"]
+    if render:
+        argv.append(f"--display.output={os.path.join(out_dir, 'result.png')}")
+    args = docopt(randomActivityGen.__doc__, argv=argv)
+
+    profiler = StageProfiler()
+    with profiler.stage("net_load"):
+        net, geometry = load_network(net_file, cache_dir=None)
+    randomActivityGen.generate_file(args, net, geometry, profiler)
+    return profiler, len(net.edge_ids), len(net.node_ids)
+
+
+def startup_time() -> dict:
+    """
+    Time starting randomActivityGen.py in a new interpreter until it has parsed its arguments. This is mostly the time
+    spent importing modules, which every run pays
+    :return: the fastest wall and CPU time over STARTUP_REPEAT starts, CPU time is that of the started process
+    """
+    best = {"wall": float("inf"), "cpu": float("inf")}
+    for _ in range(STARTUP_REPEAT):
+        before, wall = os.times(), time.perf_counter()
+        subprocess.run([sys.executable, "randomActivityGen.py", "--version"], check=True, stdout=subprocess.DEVNULL)
+        wall, after = time.perf_counter() - wall, os.times()
+        cpu = after.children_user + after.children_system - before.children_user - before.children_system
+        best = {"wall": min(best["wall"], wall), "cpu": min(best["cpu"], cpu)}
+    print(f"startup: {best['wall']:.3f} s", file=sys.stderr)
+    return {"kind": "startup", "stages": {"startup": best}}
+
+
+def run(kinds, sizes, repeat: int, net_dir: str, render: bool) -> Dict[str, dict]:
+    """
+    Benchmark each kind of network at each size
+    :return: the results of each network by name, and of startup_time, with the fastest wall and CPU time of each stage over all repeats
+    """
+    results = {"startup": startup_time()}
+    for kind in kinds:
+        for size in sizes:
+            net_file = network_file(net_dir, kind, size)
+            stages = {}
+            with tempfile.TemporaryDirectory(prefix="randomActivityGen-benchmark-") as out_dir:
+                for _ in range(repeat):
+                    profiler, edges, nodes = run_once(net_file, size, out_dir, render)
+                    for record in profiler.stages:
+                        best = stages.setdefault(record["stage"], {"wall": record["wall"], "cpu": record["cpu"]})
+                        best["wall"] = min(best["wall"], record["wall"])
+                        best["cpu"] = min(best["cpu"], record["cpu"])
+            name = f"{kind}-{size}"
+            results[name] = {"kind": kind, "size": size, "edges": edges, "nodes": nodes, "stages": stages}
+            print(f"{name}: {edges} edges, " +
+                  ", ".join(f"{stage} {times['wall']:.3f} s" for stage, times in stages.items()), file=sys.stderr)
+    return results
+
+
+def compare(baseline: dict, results: dict, threshold: float, min_time: float) -> bool:
+    """
+    Print the change in wall time of each stage of each network found in both results, flagging slowdowns beyond
+    threshold. Networks or stages only found in one of them are skipped
+    :return: whether no stage was flagged
+    """
+    if baseline["machine"] != results["machine"]:
+        print(f"Warning: baseline is from another machine {baseline['machine']}, times may not be comparable")
+    ok = True
+    for name, result in results["results"].items():
+        if name not in baseline["results"]:
+            continue
+        for stage, times in result["stages"].items():
+            base = baseline["results"][name]["stages"].get(stage)
+            if base is None or max(base["wall"], times["wall"]) < min_time:
+                continue
+            change = times["wall"] / base["wall"] - 1 if base["wall"] > 0 else float("inf")
+            flag = change > threshold
+            ok = ok and not flag
+            print(f"{'SLOWER' if flag else '':6} {name:>16} {stage:>14} {base['wall']:9.3f} s -> {times['wall']:9.3f} s "
+                  f"({change:+.0%})")
+    return ok
+
+
+def main():
+    args = docopt(__doc__)
+    logging.basicConfig(level=logging.WARNING, format="%(levelname)-8s %(message)s")
+
+    if args["run"]:
+        kinds = args["--kinds"].split(",")
+        assert all(kind in KINDS for kind in kinds), f"Kinds of networks must be some of {KINDS}"
+        net_dir = default_cache_dir("benchmark") if args["--net-dir"] == "auto" else args["--net-dir"]
+        results = run(kinds, [int(size) for size in args["--sizes"].split(",")], int(args["--repeat"]), net_dir,
+                      not args["--no-render"])
+        with open(args["--output"], "w") as f:
+            json.dump({"machine": {"python": platform.python_version(), "processor": platform.processor(),
+                                   "cpu_count": os.cpu_count()},
+                       "results": results}, f, indent=2)
+            f.write("\n")
+        print(f"Wrote results to {args['--output']}", file=sys.stderr)
+    else:
+        with open(args["--baseline"]) as f:
+            baseline = json.load(f)
+        with open(args["--results"]) as f:
+            results = json.load(f)
+        if not compare(baseline, results, float(args["--threshold"]), float(args["--min-time"])):
+            print(f"Some stages are more than {float(args['--threshold']):.0%} slower than the baseline")
+            exit(1)
+
+
+if __name__ == "__main__":
+    main()
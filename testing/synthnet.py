@@ -0,0 +1,116 @@
+import math
+from typing import Tuple
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+# Distance in meters between neighbouring junctions
+SPACING = 100.0
+
+# Kinds of synthetic networks, see generate_network
+KINDS = ("grid", "radial", "random")
+
+
+def grid_network(edges: int, rng: np.random.Generator) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Square grid of straight roads. A grid of s x s junctions has 4s(s - 1) edges
+    """
+    side = max(2, math.ceil((1 + math.sqrt(1 + edges)) / 2))
+    x, y = np.meshgrid(np.arange(side), np.arange(side), indexing="ij")
+    nodes = np.column_stack((x.ravel(), y.ravel())) * SPACING
+    index = np.arange(side * side).reshape(side, side)
+    pairs = np.concatenate((np.column_stack((index[:-1, :].ravel(), index[1:, :].ravel())),
+                            np.column_stack((index[:, :-1].ravel(), index[:, 1:].ravel()))))
+    return nodes, pairs, np.full((len(pairs), 2), np.nan)
+
+
+def radial_network(edges: int, rng: np.random.Generator) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Rings of curved roads around a centre, connected by straight spokes. With r rings and 2r spokes there are 8r^2
+    edges
+    """
+    rings = max(1, math.ceil(math.sqrt(edges / 8)))
+    spokes = 2 * rings
+    angles = np.arange(spokes) * 2 * math.pi / spokes
+    radii = np.arange(1, rings + 1) * SPACING
+    # Node 0 is the centre, node 1 + i * spokes + j is on ring i and spoke j
+    nodes = np.vstack(([[0.0, 0.0]], np.column_stack(((radii[:, None] * np.cos(angles)).ravel(),
+                                                         (radii[:, None] * np.sin(angles)).ravel()))))
+    index = 1 + np.arange(rings * spokes).reshape(rings, spokes)
+    spoke_pairs = np.concatenate((np.column_stack((np.zeros(spokes, dtype=np.int64), index[0])),
+                                  np.column_stack((index[:-1].ravel(), index[1:].ravel()))))
+    ring_pairs = np.column_stack((index.ravel(), np.roll(index, -1, axis=1).ravel()))
+
+    # Ring roads bend through the middle of their arc
+    middle = angles + math.pi / spokes
+    ring_bends = np.column_stack(((radii[:, None] * np.cos(middle)).ravel(), (radii[:, None] * np.sin(middle)).ravel()))
+    bends = np.vstack((np.full((len(spoke_pairs), 2), np.nan), ring_bends))
+    return nodes, np.concatenate((spoke_pairs, ring_pairs)), bends
+
+
+def random_network(edges: int, rng: np.random.Generator) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Junctions placed uniformly at random, each connected to its three nearest neighbours by a slightly bent road.
+    This gives about four edges per junction
+    """
+    count = max(4, edges // 4)
+    side = math.sqrt(count) * SPACING
+    nodes = rng.uniform(0, side, (count, 2))
+    _, neighbours = cKDTree(nodes).query(nodes, k=4)
+    pairs = np.column_stack((np.repeat(np.arange(count), 3), neighbours[:, 1:].ravel()))
+    pairs = np.unique(np.sort(pairs, axis=1), axis=0)
+
+    # Move the middle of each road sideways by up to a tenth of its length
+    start, end = nodes[pairs[:, 0]], nodes[pairs[:, 1]]
+    normal = (end - start)[:, ::-1] * np.array([-1.0, 1.0])
+    bends = (start + end) / 2 + normal * rng.uniform(-0.1, 0.1, (len(pairs), 1))
+    return nodes, pairs, bends
+
+
+def generate_network(kind: str, edges: int, seed: int = 0) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Generate a synthetic road network with about the given number of edges. Every road is two edges, one in each
+    direction.
+    :param kind: the layout of the network, one of KINDS
+    :param edges: the approximate number of edges
+    :return: the coordinates of the junctions, the pairs of junctions connected by roads, and the point each road
+        bends through, or NaN for straight roads
+    """
+    assert kind in KINDS, f"Unknown kind of network {kind}, expected one of {KINDS}"
+    return {"grid": grid_network, "radial": radial_network, "random": random_network}[kind](
+        edges, np.random.default_rng(seed))
+
+
+def write_net(path: str, nodes: np.ndarray, pairs: np.ndarray, bends: np.ndarray):
+    """
+    Write a network generated by generate_network as a SUMO .net.xml file. Only the parts read by the generator are
+    written; each edge has a sidewalk and a lane for vehicles, and there are no internal edges or connections.
+    """
+    # Each road gives an edge in each direction
+    froms = np.concatenate((pairs[:, 0], pairs[:, 1]))
+    tos = np.concatenate((pairs[:, 1], pairs[:, 0]))
+    bends = np.concatenate((bends, bends))
+    straight = np.isnan(bends[:, 0])
+    lengths = np.where(straight, np.hypot(*(nodes[tos] - nodes[froms]).T),
+                       np.hypot(*(bends - nodes[froms]).T) + np.hypot(*(nodes[tos] - bends).T))
+    xmin, ymin = nodes.min(axis=0)
+    xmax, ymax = nodes.max(axis=0)
+
+    with open(path, "w") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n\n<net version="1.20">\n\n')
+        f.write(f'    <location netOffset="0.00,0.00" convBoundary="{xmin:.2f},{ymin:.2f},{xmax:.2f},{ymax:.2f}" '
+                f'origBoundary="{xmin:.2f},{ymin:.2f},{xmax:.2f},{ymax:.2f}" projParameter="!"/>\n\n')
+        for i, (a, b, bend, is_straight, length) in enumerate(zip(froms.tolist(), tos.tolist(), bends.tolist(),
+                                                                 straight.tolist(), lengths.tolist())):
+            points = [nodes[a], nodes[b]] if is_straight else [nodes[a], bend, nodes[b]]
+            shape = " ".join(f"{x:.2f},{y:.2f}" for x, y in points)
+            f.write(f'    <edge id="e{i}" from="n{a}" to="n{b}" priority="1">\n'
+                    f'        <lane id="e{i}_0" index="0" allow="pedestrian" speed="2.78" length="{length:.2f}" '
+                    f'shape="{shape}"/>\n'
+                    f'        <lane id="e{i}_1" index="1" disallow="pedestrian" speed="13.89" length="{length:.2f}" '
+                    f'shape="{shape}"/>\n'
+                    f'    </edge>\n')
+        f.write("\n")
+        for i, (x, y) in enumerate(nodes.tolist()):
+            f.write(f'    <junction id="n{i}" type="priority" x="{x:.2f}" y="{y:.2f}"/>\n')
+        f.write("\n</net>\n")
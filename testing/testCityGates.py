@@ -1,7 +1,7 @@
 import math
-import xml.etree.ElementTree as ET
 import numpy as np
 from scipy.stats import t
+from citystats import Stats
 from testing.testInstance import test_instances
 
 # ===================== MEASUREMENTS ======================
@@ -13,14 +13,14 @@ results = []
 for test in test_instances:
     print(test.name)
 
-    real_stats = ET.parse(test.real_stats_file)
-    test.run_tool(0, len(real_stats.find("cityGates").findall("entrance")))
+    real_stats = Stats.read(test.real_stats_file)
+    test.run_tool(0, len(real_stats.table("cityGates")))
 
-    gen_stats = ET.parse(test.gen_stats_out_file)
+    gen_stats = Stats.read(test.gen_stats_out_file)
 
     # Get gate edges
-    real_gate_edges = [xml_gate.get("edge") for xml_gate in real_stats.find("cityGates").findall("entrance")]
-    gen_gate_edges = [xml_gate.get("edge") for xml_gate in gen_stats.find("cityGates").findall("entrance")]
+    real_gate_edges = real_stats.table("cityGates")["edge"].tolist()
+    gen_gate_edges = gen_stats.table("cityGates")["edge"].tolist()
 
     # Normalize gate edges (removing "-")
     real_gate_edges = [edge[1:] if edge[0] == "-" else edge for edge in real_gate_edges]
@@ -0,0 +1,86 @@
+"""
+Checks that network.read_net reads in/example.net.xml as sumolib did before it replaced sumolib.net.readNet; the
+number of edges, nodes and lanes, the boundary, and the ids, nodes, lengths, shapes and lane permissions of some edges.
+When sumolib is installed, every edge is also compared with sumolib.net.readNet.
+Run from the root of the repository: python -m testing.testNetwork
+"""
+import math
+
+from network import ALL_VEHICLE_CLASSES, VEHICLE_CLASSES, read_net, vehicle_class_mask
+
+NET_FILE = "in/example.net.xml"
+
+# Values of in/example.net.xml as read by sumolib.net.readNet
+EDGE_COUNT = 876
+NODE_COUNT = 300
+LANE_COUNT = 1752
+BOUNDARY = [0.0, 0.0, 4343.0, 3176.11]
+TOTAL_LENGTH = 140140.28
+# The lanes of each edge are a sidewalk (allow="pedestrian") and a road (disallow="pedestrian")
+SIDEWALK = vehicle_class_mask(["pedestrian"])
+ROAD = ALL_VEHICLE_CLASSES & ~SIDEWALK
+# Edge id -> (index, from node, to node, length, shape, lane permissions)
+EDGES = {
+    "-100": (0, "99", "68", 221.82, [(2483.05, 1728.545), (2295.8900000000003, 1609.49)], [SIDEWALK, ROAD]),
+    "-2195": (100, "2194", "1836", 81.66, None, [SIDEWALK, ROAD]),
+    "993": (875, None, None, 98.44, None, [SIDEWALK, ROAD]),
+}
+
+
+def check_known_values(net):
+    assert len(net.edge_ids) == EDGE_COUNT, f"{len(net.edge_ids)} edges instead of {EDGE_COUNT}"
+    assert len(net.node_ids) == NODE_COUNT, f"{len(net.node_ids)} nodes instead of {NODE_COUNT}"
+    assert len(net.lane_permissions) == LANE_COUNT, f"{len(net.lane_permissions)} lanes instead of {LANE_COUNT}"
+    assert net.getBoundary() == BOUNDARY, f"Boundary {net.getBoundary()} instead of {BOUNDARY}"
+    assert math.isclose(net.edge_lengths.sum(), TOTAL_LENGTH), f"Total length {net.edge_lengths.sum()}"
+    assert set(net.lane_permissions.tolist()) == {int(SIDEWALK), int(ROAD)}, "Unexpected lane permissions"
+
+    for edge_id, (index, from_node, to_node, length, shape, permissions) in EDGES.items():
+        assert net.edge_index(edge_id) == index, f"Edge {edge_id} has index {net.edge_index(edge_id)}"
+        edge = net.getEdge(edge_id)
+        assert edge.getLength() == length, f"Edge {edge_id} has length {edge.getLength()}"
+        if from_node is not None:
+            assert edge.getFromNode().getID() == from_node and edge.getToNode().getID() == to_node, \
+                f"Edge {edge_id} goes from {edge.getFromNode().getID()} to {edge.getToNode().getID()}"
+        if shape is not None:
+            assert edge.getShape() == shape, f"Edge {edge_id} has shape {edge.getShape()}"
+        lanes = net.lane_permissions[net.lane_offsets[index]:net.lane_offsets[index + 1]]
+        assert lanes.tolist() == [int(mask) for mask in permissions], \
+            f"Edge {edge_id} has lane permissions {[hex(mask) for mask in lanes.tolist()]}"
+        assert [lane.allows("pedestrian") for lane in edge.getLanes()] == [True, False]
+        assert [lane.allows("passenger") for lane in edge.getLanes()] == [False, True]
+
+
+def check_against_sumolib(net, sumo_net):
+    sumo_edges = sumo_net.getEdges()
+    assert [edge.getID() for edge in sumo_edges] == net.edge_ids, "Edge ids or their order differ"
+    assert [node.getID() for node in sumo_net.getNodes()] == net.node_ids, "Node ids or their order differ"
+    assert list(sumo_net.getBoundary()) == net.getBoundary(), "Boundaries differ"
+    for node in net.getNodes():
+        assert node.getCoord() == tuple(sumo_net.getNode(node.getID()).getCoord()[:2]), \
+            f"Node {node.getID()} is at a different position"
+    for sumo_edge, edge in zip(sumo_edges, net.getEdges()):
+        edge_id = edge.getID()
+        assert sumo_edge.getLength() == edge.getLength(), f"Edge {edge_id} has a different length"
+        assert [tuple(pos[:2]) for pos in sumo_edge.getShape()] == edge.getShape(), \
+            f"Edge {edge_id} has a different shape"
+        assert sumo_edge.getFromNode().getID() == edge.getFromNode().getID() and \
+            sumo_edge.getToNode().getID() == edge.getToNode().getID(), f"Edge {edge_id} has different nodes"
+        assert len(sumo_edge.getLanes()) == len(edge.getLanes()), f"Edge {edge_id} has a different number of lanes"
+        for sumo_lane, lane in zip(sumo_edge.getLanes(), edge.getLanes()):
+            for vclass in VEHICLE_CLASSES:
+                assert sumo_lane.allows(vclass) == lane.allows(vclass), \
+                    f"A lane of edge {edge_id} differs in allowing {vclass}"
+
+
+if __name__ == "__main__":
+    net = read_net(NET_FILE)
+    check_known_values(net)
+    print(f"{NET_FILE} matches the known values")
+    try:
+        import sumolib
+    except ImportError:
+        print("sumolib is not installed, skipping the comparison with sumolib.net.readNet")
+    else:
+        check_against_sumolib(net, sumolib.net.readNet(NET_FILE))
+        print(f"{NET_FILE} is read the same as by sumolib.net.readNet")
@@ -0,0 +1,56 @@
+"""
+Checks that perlin.pnoise3_many, the NumPy port of noise.pnoise3 the generator samples noise with, returns exactly what
+the 'noise' lib returns on a grid of points, for several offsets, octaves, persistences and lacunarities. Also checks
+that NoiseSampler.sample_many equals sampling each street with noise.pnoise3 as the generator did before the port.
+Requires the 'noise' lib, see testing/requirements.txt.
+Run from the root of the repository: python -m testing.testNoise
+"""
+import itertools
+
+import noise
+import numpy as np
+
+from perlin import NoiseSampler, pnoise3_many
+from utility import distance, smoothstep
+
+# Grid of points, including negative and non-integral coordinates
+GRID = np.linspace(-40, 40, 81) + 0.123
+# Offsets into the noise, the generator draws them from [0, 65536)
+OFFSETS = (0.0, 17.5, 9999.25, 44178.455, 65535.9)
+OCTAVES = (1, 3, 5)
+# (persistence, lacunarity), the first is the default of noise.pnoise3 and the one the generator uses
+SHAPES = ((0.5, 2.0), (0.7, 1.5))
+
+
+def check_pnoise3_many():
+    x, y = [a.ravel() for a in np.meshgrid(GRID, GRID)]
+    for z, octaves, (persistence, lacunarity) in itertools.product(OFFSETS, OCTAVES, SHAPES):
+        expected = np.array([noise.pnoise3(float(a), float(b), z, octaves=octaves, persistence=persistence,
+                                           lacunarity=lacunarity) for a, b in zip(x, y)])
+        actual = pnoise3_many(x, y, z, octaves=octaves, persistence=persistence, lacunarity=lacunarity)
+        mismatches = np.flatnonzero(actual != expected)
+        assert len(mismatches) == 0, \
+            f"pnoise3_many differs at {len(mismatches)} points for z={z}, octaves={octaves}, " \
+            f"persistence={persistence}, lacunarity={lacunarity}, e.g. ({x[mismatches[0]]}, {y[mismatches[0]]}): " \
+            f"{actual[mismatches[0]]} instead of {expected[mismatches[0]]}"
+
+
+def check_sampler():
+    centre, centre_weight, radius, offset, octaves = (2075.0, 1507.9), 0.5, 2448.6, 44178.455, 3
+    sampler = NoiseSampler(centre, centre_weight, radius, offset, octaves)
+    xy = np.column_stack([a.ravel() for a in np.meshgrid(np.linspace(0, 4343, 60), np.linspace(0, 3176, 60))])
+    scale = 4 / radius
+    expected = []
+    for x, y in xy:
+        noise01 = (noise.pnoise3(x=x * scale, y=y * scale, z=offset, octaves=octaves) + 1) / 2
+        gradient = 1 - distance((x, y), centre) / radius
+        expected.append((smoothstep(noise01) + gradient * centre_weight) / (1 + centre_weight))
+    assert np.array_equal(sampler.sample_many(xy), np.array(expected)), "NoiseSampler.sample_many differs"
+
+
+if __name__ == "__main__":
+    check_pnoise3_many()
+    print(f"pnoise3_many equals noise.pnoise3 on {len(GRID) ** 2} points for each of "
+          f"{len(OFFSETS) * len(OCTAVES) * len(SHAPES)} configurations")
+    check_sampler()
+    print("NoiseSampler.sample_many equals sampling each position with noise.pnoise3")
@@ -1,28 +1,20 @@
 import os
 import pathlib
-import sys
 from typing import List
 
 import numpy as np
 import matplotlib.pyplot as plt
 from scipy.spatial.distance import cdist
 from scipy.optimize import linear_sum_assignment
-import xml.etree.ElementTree as ET
 import seaborn as sns
 import csv
 
 from scipy.stats import ttest_1samp
 
+from citystats import Stats
+from geometry import EdgeGeometry
+from network import Network, read_net
 from testing.testInstance import TestInstance, test_instances
-from utility import position_on_edge
-
-if 'SUMO_HOME' in os.environ:
-    tools = os.path.join(os.environ['SUMO_HOME'], 'tools')
-    sys.path.append(tools)
-else:
-    sys.exit("Please declare environment variable 'SUMO_HOME' to use sumolib")
-
-import sumolib
 
 
 def calc_school_divergence(test: TestInstance, plot: bool) -> List[float]:
@@ -33,16 +25,13 @@ def calc_school_divergence(test: TestInstance, plot: bool) -> List[float]:
     :param plot: whether to plot the city, schools, and assignments
     :return: the divergence for each assigned school
     """
-    net: sumolib.net.Net = sumolib.net.readNet(test.net_file)
+    net = read_net(test.net_file)
+    geometry = EdgeGeometry(net)
 
     # Get mean school coordinates for real and generated statistics
-    gen_coords = np.array(
-        [position_on_edge(net.getEdge((xml_school.get("edge"))), float(xml_school.get("pos"))) for xml_school in
-         ET.parse(test.gen_stats_out_file).find("schools").findall("school")])
+    gen_coords = geometry.element_positions(Stats.read(test.gen_stats_out_file).table("schools"))
 
-    real_coords = np.array(
-        [position_on_edge(net.getEdge((xml_school.get("edge"))), float(xml_school.get("pos"))) for xml_school in
-         ET.parse(test.real_stats_file).find("schools").findall("school")])
+    real_coords = geometry.element_positions(Stats.read(test.real_stats_file).table("schools"))
 
     # Get euclidean distance between all points in both sets as a cost matrix.
     # Note that the ordering is seemingly important for linear_sum_assignment to work.
@@ -62,7 +51,7 @@ def calc_school_divergence(test: TestInstance, plot: bool) -> List[float]:
     return [dist[i, assignment[i]] for i in range(0, min(len(gen_coords), len(real_coords)))]
 
 
-def plot_school_assignment(net: sumolib.net.Net, test_name: str, gen_coords: np.ndarray, real_coords: np.ndarray,
+def plot_school_assignment(net: Network, test_name: str, gen_coords: np.ndarray, real_coords: np.ndarray,
                            assignment: np.ndarray) -> None:
     # Draw streets
     [plt.plot([pos1[0], pos2[0]], [pos1[1], pos2[1]], "grey") for pos1, pos2 in
@@ -152,7 +141,7 @@ def run_multiple_test(test: TestInstance, bound: float, times: int = 1) -> None:
     :return: None
     """
     # Get number of real schools
-    num_real_schools = len(ET.parse(test.real_stats_file).find("schools").findall("school"))
+    num_real_schools = len(Stats.read(test.real_stats_file).table("schools"))
 
     divs = []
     for n in range(0, times):
@@ -173,7 +162,7 @@ def calc_divergence(test: TestInstance) -> List[float]:
     :return: list of divergences
     """
     # Run tool with number of real schools
-    test.run_tool(len(ET.parse(test.real_stats_file).find("schools").findall("school")), 0)
+    test.run_tool(len(Stats.read(test.real_stats_file).table("schools")), 0)
     return calc_school_divergence(test, False)
 
 
@@ -16,29 +16,23 @@ import csv
 import datetime
 import os
 import random
-import sys
 import xml.etree.ElementTree as ET
 
 import matplotlib.pyplot as plt
+import numpy as np
 from PIL import Image, ImageDraw
 from docopt import docopt
 from matplotlib.ticker import FuncFormatter, MultipleLocator
 
-from utility import position_on_edge
-
-if 'SUMO_HOME' in os.environ:
-    tools = os.path.join(os.environ['SUMO_HOME'], 'tools')
-    sys.path.append(tools)
-else:
-    sys.exit("Please declare environment variable 'SUMO_HOME' to use sumolib")
-
-import sumolib
+from geometry import EdgeGeometry
+from network import read_net
 
 
 args = docopt(__doc__)
 
 # Read input files
-net = sumolib.net.readNet(args["--net-file"])
+net = read_net(args["--net-file"])
+geometry = EdgeGeometry(net)
 trips = ET.parse(args["--trips-file"])
 
 # Info about net size and edges
@@ -51,16 +45,19 @@ fname = os.path.basename(args["--trips-file"])
 while "." in fname:
     fname = os.path.splitext(fname)[0]
 
+# Find the departure position of all trips at once
+trips_xml = trips.findall("trip")
+edges = np.array([geometry.index_of(trip_xml.get("from")) for trip_xml in trips_xml], dtype=np.int64)
+depart_times = [float(trip_xml.get("depart")) for trip_xml in trips_xml]
+depart_positions = np.array([float(trip_xml.get("departPos") or geometry.lengths[edge] * random.random())
+                             for trip_xml, edge in zip(trips_xml, edges)])
+positions = geometry.positions_on_edges(edges, depart_positions)
+
 data = []
 with open(os.path.dirname(args["--trips-file"]) + f"/{fname}-trip-starts.csv", "w", newline="") as csv_starts:
     writer_starts = csv.writer(csv_starts)
 
-    for trip_xml in trips.findall("trip"):
-        edge = net.getEdge(trip_xml.get("from"))
-        departTime = float(trip_xml.get("depart"))
-        departPos = float(trip_xml.get("departPos") or edge.getLength() * random.random())
-
-        x, y = position_on_edge(edge, departPos)
+    for (x, y), departTime in zip(positions.tolist(), depart_times):
         x -= offset_x
         y -= offset_y
         datapoint = (x, y, departTime)
@@ -1,35 +1,35 @@
 import logging
-import os
+import random
 import sys
 import xml.etree.ElementTree as ET
 from typing import Tuple
 
 import numpy as np
-from scipy.cluster.vq import kmeans
 
-if 'SUMO_HOME' in os.environ:
-    tools = os.path.join(os.environ['SUMO_HOME'], 'tools')
-    sys.path.append(tools)
-else:
-    sys.exit("Please declare environment variable 'SUMO_HOME' to use sumolib")
+from citystats import Stats
+from streams import STDOUT
 
-import sumolib
 
-
-def find_city_centre(net: sumolib.net.Net) -> Tuple[float, float]:
+def find_city_centre(net) -> Tuple[float, float]:
     """
-    Finds the city centre; average node coord of all nodes in the net
+    Finds the city centre; average node coord of all nodes in the net. The result is remembered in net.derived
     """
-    node_coords = [node.getCoord() for node in net.getNodes()]
-    return float(np.mean([c[0] for c in node_coords])), float(np.mean([c[1] for c in node_coords]))
+    if "centre" not in net.derived:
+        net.derived["centre"] = [float(np.mean(net.node_coords[:, 0])), float(np.mean(net.node_coords[:, 1]))]
+    return net.derived["centre"][0], net.derived["centre"][1]
 
 
-def radius_of_network(net: sumolib.net.Net, centre: Tuple[float, float]):
+def radius_of_network(net, centre: Tuple[float, float]):
     """
     Get distance from centre to outermost node. Use this for computing radius of network.
+    The result for the most recent centre is remembered in net.derived
     :return: the radius of the network
     """
-    return np.max([distance(centre, node.getCoord()) for node in net.getNodes()])
+    cached = net.derived.get("radius")
+    if cached is None or (cached[0], cached[1]) != (centre[0], centre[1]):
+        radius = float(np.max(distance(centre, (net.node_coords[:, 0], net.node_coords[:, 1]))))
+        net.derived["radius"] = cached = [centre[0], centre[1], radius]
+    return cached[2]
 
 
 def distance(pos1: Tuple[float, float], pos2: Tuple[float, float]):
@@ -42,44 +42,138 @@ def distance(pos1: Tuple[float, float], pos2: Tuple[float, float]):
     return np.sqrt((x2 - x1) ** 2 + (y2 - y1) ** 2)
 
 
-def k_means_clusters(net: sumolib.net.Net, k: int):
+# Networks with more edges than this are clustered with mini-batch k-means
+MINI_BATCH_THRESHOLD = 100_000
+MINI_BATCH_SIZE = 4096
+# Mini-batch k-means stops when its smoothed inertia has not improved by more than tol for this many batches
+MINI_BATCH_PATIENCE = 10
+# Number of Lloyd iterations on all points that finish mini-batch k-means
+MINI_BATCH_LLOYD_ITER = 10
+
+
+def _nearest(centroids: np.ndarray, points: np.ndarray) -> np.ndarray:
     """
-    Return k clusters of edges from running k-means on net file
-    :param net: the net whose edges should be partitioned to clusters
-    :param k: how many clusters the network should be divided into
+    :return: the index of the nearest centroid of each point
     """
-    from perlin import get_edge_pair_centroid
-    edges = net.getEdges()
+    # scipy takes long to import, so it is only imported once clusters are computed instead of at startup
+    from scipy.spatial import cKDTree
+    return cKDTree(centroids).query(points)[1]
 
-    centroid_edges = [get_edge_pair_centroid(edge.getShape()) for edge in edges]
-    centroids = kmeans(np.array(centroid_edges), k, iter=25)
 
-    clusters = [[] for _ in range(k)]
-    # Iterate through each edge, to decide which cluster it belongs to
-    for edge in edges:
-        # Find the center point of the edge, and set distance to first centroid returned from kmeans
-        edge_centroid = get_edge_pair_centroid(edge.getShape())
-        minimum = distance(edge_centroid, centroids[0][0])
+def _kmeans_plus_plus(points: np.ndarray, k: int, rng: np.random.Generator) -> np.ndarray:
+    """
+    Choose k initial centroids among points with k-means++ seeding, i.e. each centroid is chosen with probability
+    proportional to the squared distance to the nearest centroid chosen so far
+    """
+    centroids = np.empty((k, 2))
+    centroids[0] = points[rng.integers(len(points))]
+    closest_sq = ((points - centroids[0]) ** 2).sum(axis=1)
+    for i in range(1, k):
+        total = closest_sq.sum()
+        # All points coincide with a chosen centroid, so any point will do
+        index = rng.choice(len(points), p=closest_sq / total) if total > 0 else rng.integers(len(points))
+        centroids[i] = points[index]
+        closest_sq = np.minimum(closest_sq, ((points - centroids[i]) ** 2).sum(axis=1))
+    return centroids
+
+
+def _lloyd(points: np.ndarray, centroids: np.ndarray, max_iter: int, tol: float) -> np.ndarray:
+    """
+    Run Lloyd's k-means algorithm from the given centroids until the total squared movement of the centroids in one
+    iteration is at most tol, or max_iter iterations have been done
+    :return: the final centroids
+    """
+    k = len(centroids)
+    for iteration in range(max_iter):
+        labels = _nearest(centroids, points)
+        counts = np.bincount(labels, minlength=k)
+        sums = np.stack((np.bincount(labels, points[:, 0], k), np.bincount(labels, points[:, 1], k)), axis=1)
+        # Centroids without any points keep their position
+        new_centroids = np.where(counts[:, None] > 0, sums / np.maximum(counts, 1)[:, None], centroids)
+        shift = ((new_centroids - centroids) ** 2).sum()
+        centroids = new_centroids
+        if shift <= tol:
+            logging.debug(f"[k-means] Converged after {iteration + 1} iterations")
+            break
+    return centroids
 
-        correct_index = 0
 
-        # Iterate though each centroid from k-means, and find the centroid to which the current edge has lowest
-        # distance to
-        for i, centroid in enumerate(centroids[0]):
-            if distance(edge_centroid, centroid) < minimum:
-                minimum = distance(edge_centroid, centroid)
-                correct_index = i
+def _mini_batch_kmeans(points: np.ndarray, centroids: np.ndarray, max_iter: int, tol: float,
+                       rng: np.random.Generator) -> np.ndarray:
+    """
+    Run mini-batch k-means from the given centroids. Each iteration moves the centroids towards the points of a small
+    random batch, with a learning rate that decreases as more points have been assigned to a centroid.
+    As the centroids move less with every batch, their movement says little about convergence. Instead, after at least
+    one full pass over the points, it stops when the inertia of the batches, smoothed over recent batches, has not
+    improved by more than a fraction tol for MINI_BATCH_PATIENCE batches, or after max_iter iterations
+    :return: the final centroids
+    """
+    k = len(centroids)
+    seen = np.zeros(k)
+    min_iter = -(-len(points) // MINI_BATCH_SIZE)
+    smoothed = best = None
+    no_improvement = 0
+    for iteration in range(max(max_iter, min_iter)):
+        batch = points[rng.integers(len(points), size=MINI_BATCH_SIZE)]
+        labels = _nearest(centroids, batch)
+        counts = np.bincount(labels, minlength=k)
+        sums = np.stack((np.bincount(labels, batch[:, 0], k), np.bincount(labels, batch[:, 1], k)), axis=1)
+
+        # Mean squared distance of the batch to its centroids, smoothed over about the last MINI_BATCH_PATIENCE batches
+        inertia = float(((batch - centroids[labels]) ** 2).sum(axis=1).mean())
+        alpha = 2 / (MINI_BATCH_PATIENCE + 1)
+        smoothed = inertia if smoothed is None else (1 - alpha) * smoothed + alpha * inertia
+        if best is None or smoothed < best * (1 - tol):
+            best, no_improvement = smoothed, 0
+        else:
+            no_improvement += 1
 
-        clusters[correct_index].append(edge)
+        seen += counts
+        # Equivalent to moving each centroid towards each of its points in turn with learning rate 1 / seen
+        centroids = centroids + (sums - counts[:, None] * centroids) / np.maximum(seen, 1)[:, None]
+        if iteration + 1 >= min_iter and no_improvement >= MINI_BATCH_PATIENCE:
+            logging.debug(f"[k-means] Converged after {iteration + 1} mini-batches")
+            break
+    return centroids
 
-    return clusters
 
+def k_means_labels(geometry, k: int, max_iter: int = 100, tol: float = 1e-4, rng: np.random.Generator = None) \
+        -> np.ndarray:
+    """
+    Partition the edges of the net into k clusters by running k-means on the centroids of the edges. The centroids are
+    seeded with k-means++, and refined with a single run of k-means. For very large networks they are refined with
+    mini-batch k-means first, followed by a few iterations of k-means on all edges
+    :param geometry: the EdgeGeometry of the net whose edges should be partitioned to clusters
+    :param k: how many clusters the network should be divided into
+    :param max_iter: maximum number of k-means iterations
+    :param tol: relative tolerance; k-means stops when the squared movement of the centroids in an iteration is at
+        most tol times the variance of the edge centroids. Mini-batch k-means stops when its smoothed inertia improves
+        by less than a fraction tol, see _mini_batch_kmeans
+    :param rng: random number generator, derived from the random module if not given
+    :return: the cluster of each edge, indexed like geometry. Clusters are numbered from 0 to at most k - 1
+    """
+    if rng is None:
+        rng = np.random.default_rng(random.getrandbits(64))
+    points = geometry.centroids
+    k = min(k, len(points))
+    abs_tol = tol * float(np.mean(np.var(points, axis=0)))
+
+    centroids = _kmeans_plus_plus(points, k, rng)
+    if len(points) > MINI_BATCH_THRESHOLD:
+        centroids = _mini_batch_kmeans(points, centroids, max_iter, tol, rng)
+        centroids = _lloyd(points, centroids, MINI_BATCH_LLOYD_ITER, abs_tol)
+    else:
+        centroids = _lloyd(points, centroids, max_iter, abs_tol)
+
+    # Assign each edge to the cluster of its nearest centroid
+    return _nearest(centroids, points)
 
-def verify_stats(stats: ET.ElementTree):
+
+def verify_stats(stats: Stats):
     """
     Do various verification on the stats file to ensure that it is usable. If population and work hours are missing,
     some default values will be insert as these are required by ActivityGen.
-    :param stats: stats file parsed with ElementTree
+    :param stats: stats file read with Stats.read
     """
     city = stats.getroot()
     assert city.tag == "city", "Stat file does not seem to be a valid stat file. The root element is not city"
@@ -92,6 +186,16 @@ def verify_stats(stats: ET.ElementTree):
     assert general.attrib["inhabitants"] is not None, "Number of inhabitants are required"
     assert general.attrib["households"] is not None, "Number of households are required"
 
+    # Everything placed in the network must be placed on an edge, and everything but streets at a position along it
+    for section, name in (("streets", "Street"), ("cityGates", "City gate"), ("schools", "School"),
+                          ("busStations", "BusStation")):
+        table = stats.table(section)
+        if table is None:
+            continue
+        assert not any(edge is None for edge in table["edge"].tolist()), f"{name} isn't placed on an edge"
+        assert section == "streets" or not np.isnan(table["pos"]).any(), \
+            f"{name} doesn't have a position along the edge"
+
     # It is also required that there are at least one population bracket
     population = city.find("population")
     if population is None:
@@ -119,45 +223,16 @@ def verify_stats(stats: ET.ElementTree):
         ET.SubElement(work_hours, "closing", {"hour": "59400", "proportion": "15"})  # 15% at 16.30
 
 
-def position_on_edge(edge: sumolib.net.edge.Edge, pos: float):
-    """
-    :return: coordinate achieved by moving along the edge by pos meters.
-    """
-    # Go through pair of coords, until meeting an edge, where if we travel through it, we have moved more than pos
-    # meters in total
-    coord1, coord2 = None, None
-    remaining_distance = pos
-    for coord1, coord2 in [edge.getShape()[i:i + 2] for i in range(0, int(len(edge.getShape())-1))]:
-        if 0 < remaining_distance - distance(coord1, coord2):
-            remaining_distance -= distance(coord1, coord2)
-        else:
-            break
-
-    assert coord1 is not None and coord2 is not None, "Coordinates was none, cannot get position on edge"
-
-    # Subtract the vector coord1 from vector coord2
-    vec = np.subtract([coord2[0], coord2[1]], [coord1[0], coord1[1]])
-
-    # Normalize it by dividing by its own length
-    unit_vec = vec / np.linalg.norm(vec)
-
-    # Scale by remaining distance
-    unit_vec_scaled = unit_vec * remaining_distance
-
-    # Add this scaled vector to the start point, to find the correct coord that is at remaining distance from this
-    # coord, to coord2
-    return coord1[0] + unit_vec_scaled[0], coord1[1] + unit_vec_scaled[1]
-
-
 def setup_logging(args: dict):
     """
-    Create a stdout- and file-handler for logging framework.
+    Create a stdout- and file-handler for logging framework. The log is written to stderr instead of stdout when the
+    statistics are written to stdout.
     FIXME: logfile should always print in DEBUG, this seems like a larger hurdle, see:
     https://stackoverflow.com/questions/25187083/python-logging-to-multiple-handlers-at-different-log-levels
     :return:
     """
     logger = logging.getLogger()
-    log_stream_handler = logging.StreamHandler(sys.stdout)
+    log_stream_handler = logging.StreamHandler(sys.stderr if args["--output-file"] == STDOUT else sys.stdout)
     # Write log-level and indent slightly for message
     stream_formatter = logging.Formatter('%(levelname)-8s %(message)s')
 